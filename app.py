@@ -3,6 +3,8 @@ from flask_login import LoginManager, UserMixin, login_user, logout_user, login_
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
+import functools
+import os
 import random
 import json
 
@@ -10,7 +12,9 @@ import json
 # 初始化Flask应用
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///vrchat_memories.db'
+# 可通过环境变量DATABASE_URL指定数据库（如测试使用临时数据库）
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'DATABASE_URL', 'sqlite:///vrchat_memories.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 
@@ -79,7 +83,7 @@ class SharedEvent(db.Model):
     friend_name = db.Column(db.String(80), nullable=False)
     start_time = db.Column(db.DateTime, nullable=False)
     end_time = db.Column(db.DateTime)
-    duration = db.Column(db.Integer)  # 持续时间（秒）
+    duration = db.Column(db.Integer, index=True)  # 持续时间（秒），会话时长排行榜按其排序
     notes = db.Column(db.Text, nullable=True)  # 事件备注
     # 隐私设置：public, friends, private
     privacy = db.Column(db.String(20), default='public')
@@ -100,6 +104,7 @@ class SharedEvent(db.Model):
     sync_hash = db.Column(db.String(100))  # 同步哈希，用于识别真正的共同事件
     sync_status = db.Column(db.String(20), default='pending')  # 同步状态：pending, syncing, synced
     last_synced_at = db.Column(db.DateTime)  # 最后同步时间
+    row_version = db.Column(db.Integer, index=True)  # 行版本号，每次写入时单调递增
     
     # 用于评论同步的关联
     sync_comments = db.relationship(
@@ -118,6 +123,7 @@ class EventTag(db.Model):
         primary_key=True
     )
     tag_name = db.Column(db.String(50), primary_key=True)
+    row_version = db.Column(db.Integer, index=True)  # 行版本号
 
 
 # 事件参与者关联表（多对多关系）
@@ -178,6 +184,7 @@ class EventComment(db.Model):
         nullable=True)  # 支持回复
     is_sync_comment = db.Column(db.Boolean, default=False)  # 是否为同步评论
     sync_reference = db.Column(db.String(100))  # 同步引用，用于标识关联的评论
+    row_version = db.Column(db.Integer, index=True)  # 行版本号
 
     user = db.relationship('User', backref='comments')
     event = db.relationship('SharedEvent', backref='comments')
@@ -248,6 +255,62 @@ class GameLog(db.Model):
     shared_event_id = db.Column(db.Integer, db.ForeignKey('shared_event.id'), nullable=True)
     shared_event = db.relationship('SharedEvent', backref='game_logs')
 
+    __table_args__ = (
+        # 同一条日志重复导入时由唯一索引去重
+        db.Index('uq_game_log_event_hash', 'event_hash', unique=True),
+    )
+
+
+def game_log_event_hash(user_id, timestamp, event_type, player_name,
+                        world_name=None, world_id=None, occurrence=0):
+    """根据日志内容（用户、时间、类型、玩家、世界）计算去重哈希
+
+    occurrence是同一内容在一次导入中的出现序号，大于0时才加入哈希，
+    第一次出现的哈希与不带序号时相同。
+    """
+    import hashlib
+
+    fields = [
+        str(user_id), timestamp.isoformat(), event_type or '',
+        player_name or '', world_name or '', world_id or ''
+    ]
+    if occurrence:
+        fields.append(str(occurrence))
+    return hashlib.sha1('\x1f'.join(fields).encode('utf-8')).hexdigest()
+
+
+class GameLogHasher:
+    """按导入顺序为一个用户的日志计算去重哈希
+
+    日志时间只精确到分钟，加入/离开日志也没有世界信息，好友在同一分钟内跟随用户
+    进入第二个世界时两条日志内容完全相同。同一时间内内容相同的日志按出现次序编号，
+    重复上传同一份日志时编号相同，仍会被去重。
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.timestamp = None
+        self.seen = {}
+
+    def __call__(self, timestamp, event_type, player_name, world_name=None, world_id=None):
+        if timestamp != self.timestamp:
+            self.timestamp = timestamp
+            self.seen = {}
+        key = (event_type, player_name, world_name or '', world_id or '')
+        occurrence = self.seen.get(key, 0)
+        self.seen[key] = occurrence + 1
+        return game_log_event_hash(self.user_id, timestamp, event_type, player_name,
+                                   world_name, world_id, occurrence)
+
+
+@db.event.listens_for(GameLog, 'before_insert')
+def fill_game_log_event_hash(mapper, connection, target):
+    """通过ORM创建的日志（如种子数据）自动填充去重哈希"""
+    if not target.event_hash:
+        target.event_hash = game_log_event_hash(
+            target.user_id, target.timestamp, target.event_type,
+            target.player_name, target.world_name, target.world_id)
+
 
 # ------------------------------
 # 登录管理器回调
@@ -397,6 +460,230 @@ def handle_api_db_operation(
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+# ------------------------------
+# 后台任务队列
+# ------------------------------
+
+class BackgroundTaskQueue:
+    """简单的后台任务队列
+
+    任务在守护线程中按提交顺序执行，每个任务拥有独立的应用上下文和数据库会话。
+    workers大于1时由多个线程并发取任务。
+    线程在第一次提交任务时才启动，导入模块（如运行reset_db.py）不会启动线程。
+    """
+
+    def __init__(self, name, workers=1):
+        import queue
+        import threading
+        self.name = name
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, func, *args, **kwargs):
+        """提交任务"""
+        self._ensure_started()
+        self._queue.put((func, args, kwargs))
+
+    def join(self):
+        """等待所有已提交的任务执行完成"""
+        self._queue.join()
+
+    def _ensure_started(self):
+        import threading
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run, name=f'{self.name}-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            try:
+                with app.app_context():
+                    try:
+                        func(*args, **kwargs)
+                    except Exception as e:
+                        db.session.rollback()
+                        print(f"后台任务错误（{self.name}）: {str(e)}")
+                    finally:
+                        db.session.remove()
+            finally:
+                self._queue.task_done()
+
+
+# 运行中的任务超过该时间没有更新心跳时，视为所在进程已退出，可以被重新领取
+JOB_LEASE_TIMEOUT = timedelta(minutes=10)
+# 两次心跳之间的最小间隔
+JOB_HEARTBEAT_INTERVAL = timedelta(seconds=30)
+
+
+class JobLeaseLost(Exception):
+    """任务的租约已过期并被其他进程重新领取"""
+
+
+def claim_job(model, job_id, **values):
+    """原子地将排队中的任务标记为运行中，返回租约标识
+
+    每个进程启动时都会重新提交未完成的任务，同一任务可能被多次提交；
+    只有条件更新成功的一方执行任务，其余返回None。
+    """
+    import uuid
+    from sqlalchemy import update
+
+    lease_token = uuid.uuid4().hex
+    claimed = db.session.execute(
+        update(model).where(model.id == job_id, model.status == 'queued').values(
+            status='running', lease_token=lease_token, heartbeat_at=datetime.now(),
+            **values)
+    ).rowcount
+    db.session.commit()
+    return lease_token if claimed else None
+
+
+def heartbeat_job(connection, model, job_id, lease_token):
+    """更新任务心跳，租约已被其他进程收回时抛出JobLeaseLost"""
+    from sqlalchemy import update
+
+    updated = connection.execute(
+        update(model.__table__).where(
+            model.__table__.c.id == job_id,
+            model.__table__.c.lease_token == lease_token
+        ).values(heartbeat_at=datetime.now())
+    ).rowcount
+    if not updated:
+        raise JobLeaseLost()
+
+
+def reclaim_expired_jobs(model):
+    """将心跳超时的运行中任务重新标记为排队中，返回所有排队中任务的ID（按创建时间）"""
+    from sqlalchemy import update, or_
+
+    db.session.execute(
+        update(model).where(
+            model.status == 'running',
+            or_(model.heartbeat_at.is_(None),
+                model.heartbeat_at < datetime.now() - JOB_LEASE_TIMEOUT)
+        ).values(status='queued', lease_token=None)
+    )
+    db.session.commit()
+    return db.session.execute(
+        db.select(model.id).where(model.status == 'queued').order_by(model.created_at)
+    ).scalars().all()
+
+
+# ------------------------------
+# 响应压缩
+# ------------------------------
+
+# 非流式响应小于该大小时不压缩
+COMPRESSION_MIN_SIZE = 1024
+GZIP_COMPRESSION_LEVEL = 6
+ZSTD_COMPRESSION_LEVEL = 3
+
+# 不压缩的二进制格式：Parquet的列已经压缩过，Arrow流的压缩收益也抵不上CPU开销
+UNCOMPRESSED_MIMETYPES = ('application/vnd.apache.parquet',
+                          'application/vnd.apache.arrow.stream')
+
+
+def zstd_available():
+    """检查可选依赖zstandard是否已安装"""
+    try:
+        import zstandard  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def negotiate_content_encoding(accept_encoding):
+    """根据Accept-Encoding选择压缩算法：优先zstd（如果可用），其次gzip"""
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+
+    candidates = ['zstd', 'gzip'] if zstd_available() else ['gzip']
+    best = None
+    for encoding in candidates:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+def compress_chunks(chunks, encoding):
+    """流式压缩：逐块压缩输入，只在压缩器产生输出时才交出数据，不缓冲整个响应体"""
+    if encoding == 'zstd':
+        import zstandard
+        compressor = zstandard.ZstdCompressor(
+            level=ZSTD_COMPRESSION_LEVEL).compressobj()
+    else:
+        import zlib
+        # wbits=31：带gzip头和校验的deflate流
+        compressor = zlib.compressobj(
+            GZIP_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response):
+    """按请求的Accept-Encoding压缩响应，同时支持普通响应和流式响应"""
+    if response.status_code != 200 or 'Content-Encoding' in response.headers \
+            or response.mimetype in UNCOMPRESSED_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    encoding = negotiate_content_encoding(
+        request.headers.get('Accept-Encoding', ''))
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        chunks = response.response
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        chunks = [data]
+
+    response.response = compress_chunks(chunks, encoding)
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    return response
+
+
+def compressed_response(view_func):
+    """视图装饰器：对视图返回的响应进行压缩协商"""
+    from functools import wraps
+    from flask import make_response
+
+    @wraps(view_func)
+    def wrapper(*args, **kwargs):
+        return compress_response(make_response(view_func(*args, **kwargs)))
+    return wrapper
+
+
 # ------------------------------
 # 路由定义
 # ------------------------------
@@ -1267,15 +1554,148 @@ def process_event_time(start_time_str, end_time_str):
 
 
 def get_or_create_world(world_name, world_tags):
-    """查找或创建世界"""
+    """查找或创建世界（只flush，由调用方提交事务）"""
     world = World.query.filter_by(world_name=world_name).first()
     if not world:
         world = World(world_name=world_name, tags=world_tags)
         db.session.add(world)
-        db.session.commit()
+        db.session.flush()
     return world
 
 
+# 进程内的世界解析缓存：世界键 -> World.id。
+# 世界键优先使用VRChat的world_id，没有时使用世界名称。
+# 事务中解析到的结果先暂存在session.info中，提交后才写入缓存，回滚时丢弃。
+_world_cache = {}
+
+
+def world_cache_key(world_name, world_id):
+    """世界解析缓存的键"""
+    return ('id', world_id) if world_id else ('name', world_name or '')
+
+
+class WorldResolver:
+    """批量把(世界名称, world_id)解析为World.id，缺失的世界批量创建"""
+
+    def __init__(self):
+        self.resolved = db.session.info.setdefault('pending_world_cache', {})
+
+    def lookup(self, world_name, world_id):
+        """从缓存中查找，未解析过时返回None"""
+        key = world_cache_key(world_name, world_id)
+        return self.resolved.get(key) or _world_cache.get(key)
+
+    def resolve_many(self, worlds):
+        """解析一批世界：先按world_id查找，找不到时按名称查找，都找不到时批量创建
+
+        按名称找到的世界如果还没有world_id，会补上日志中的world_id。
+
+        Args:
+            worlds: (world_name, world_id) 的可迭代对象
+
+        Returns:
+            dict: {(world_name, world_id): World.id}
+        """
+        from sqlalchemy import update, bindparam
+        from sqlalchemy.dialects.sqlite import insert
+
+        result = {}
+        missing = set()
+        for world in set(worlds):
+            world_pk = self.lookup(*world)
+            if world_pk:
+                result[world] = world_pk
+            else:
+                missing.add(world)
+        if not missing:
+            return result
+
+        # 1. 按world_id批量查找
+        by_world_id = {}
+        for chunk in _chunked({world_id for _, world_id in missing if world_id}):
+            by_world_id.update(db.session.query(World.world_id, World.id).filter(
+                World.world_id.in_(chunk)).all())
+
+        # 2. 其余的按名称批量查找（同名的世界取最早创建的）
+        by_name = {}
+        names = {world_name or '' for world_name, world_id in missing
+                 if world_id not in by_world_id}
+        for chunk in _chunked(names):
+            for world_name, world_pk, has_world_id in db.session.query(
+                    World.world_name, db.func.min(World.id),
+                    db.func.max(World.world_id.isnot(None))
+            ).filter(World.world_name.in_(chunk)).group_by(World.world_name):
+                by_name[world_name] = (world_pk, has_world_id)
+
+        found = {}
+        claims = {}
+        unseen = {}
+        for world_name, world_id in missing:
+            if world_id and world_id in by_world_id:
+                found[(world_name, world_id)] = by_world_id[world_id]
+            elif (world_name or '') in by_name:
+                world_pk, has_world_id = by_name[world_name or '']
+                found[(world_name, world_id)] = world_pk
+                if world_id and not has_world_id:
+                    claims[world_pk] = world_id
+            else:
+                unseen[world_cache_key(world_name, world_id)] = (world_name, world_id)
+
+        # 3. 为按名称找到的旧世界补上world_id（已被其他世界使用时跳过）
+        if claims:
+            db.session.execute(
+                update(World.__table__).prefix_with('OR IGNORE').where(
+                    World.__table__.c.id == bindparam('world_pk'),
+                    World.__table__.c.world_id.is_(None)
+                ).values(world_id=bindparam('claimed_world_id')),
+                [{'world_pk': world_pk, 'claimed_world_id': world_id}
+                 for world_pk, world_id in claims.items()])
+
+        # 4. 批量创建缺失的世界（同一个键只创建一个）
+        if unseen:
+            db.session.execute(
+                insert(World.__table__).on_conflict_do_nothing(index_elements=['world_id']),
+                [{'world_name': world_name or '', 'world_id': world_id or None, 'tags': ''}
+                 for world_name, world_id in unseen.values()])
+            created_by_id = dict(db.session.query(World.world_id, World.id).filter(
+                World.world_id.in_([world_id for _, world_id in unseen.values() if world_id])
+            ).all())
+            created_by_name = dict(db.session.query(
+                World.world_name, db.func.max(World.id)
+            ).filter(
+                World.world_name.in_([world_name or '' for world_name, world_id
+                                      in unseen.values() if not world_id])
+            ).group_by(World.world_name).all())
+            for world_name, world_id in missing:
+                if (world_name, world_id) not in found:
+                    found[(world_name, world_id)] = created_by_id[world_id] if world_id \
+                        else created_by_name[world_name or '']
+
+        for world, world_pk in found.items():
+            self.resolved[world_cache_key(*world)] = result[world] = world_pk
+        return result
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def world_cache_after_commit(session):
+    """事务提交后把本次解析的世界写入进程内缓存"""
+    resolved = session.info.pop('pending_world_cache', None)
+    if resolved:
+        _world_cache.update(resolved)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def world_cache_after_rollback(session):
+    """事务回滚后丢弃本次解析的世界（新建的世界已不存在）"""
+    session.info.pop('pending_world_cache', None)
+
+
+@db.event.listens_for(World, 'after_delete')
+def world_cache_after_delete(mapper, connection, target):
+    """删除世界时清空缓存"""
+    _world_cache.clear()
+
+
 @app.route('/event/create', methods=['GET', 'POST'])
 @login_required
 def create_event():
@@ -1603,348 +2023,2890 @@ def get_world_stats():
 
 
 # ------------------------------
-# 好友活动动态路由
+# 近似去重统计（HyperLogLog）
 # ------------------------------
 
-@app.route('/api/feed/friends')
-@login_required
-def get_friends_feed():
-    """获取好友活动动态"""
-    def get_friends_feed_operation():
-        # 获取当前用户的所有好友ID
-        friend_ids = [friend.id for friend in current_user.friends.all()]
+class HyperLogLog:
+    """HyperLogLog基数估计器
 
-        # 获取好友的活动动态
-        feed_items = ActivityFeed.query.filter(
-            ActivityFeed.user_id.in_(friend_ids)
-        ).order_by(ActivityFeed.created_at.desc()).limit(50).all()
+    使用 2^precision 个寄存器，标准误差约为 1.04 / sqrt(2^precision)。
+    寄存器可序列化为bytes，并且任意两个相同精度的草图可以通过逐寄存器取最大值合并。
+    """
 
-        # 序列化活动动态
-        def serialize_feed_item(item):
-            # 获取关联对象的信息
-            target_info = {}
-            if item.target_type == 'event' and item.target_id:
-                event = SharedEvent.query.get(item.target_id)
-                if event:
-                    target_info = {
-                        'id': event.id,
-                        'title': f"与 {event.friend_name.strip()} 在 {event.world.world_name}",
-                        'world_name': event.world.world_name,
-                        'friend_name': event.friend_name
-                    }
-            elif item.target_type == 'comment' and item.target_id:
-                comment = EventComment.query.get(item.target_id)
-                if comment:
-                    target_info = {
-                        'id': comment.id,
-                        'content': comment.content[:50] + '...' if len(comment.content) > 50 else comment.content,
-                        'event_id': comment.event_id
-                    }
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.m)
+        else:
+            self.registers = bytearray(registers)
+
+    @staticmethod
+    def _hash(value):
+        import hashlib
+        digest = hashlib.blake2b(
+            str(value).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def add(self, value):
+        """添加一个元素"""
+        h = self._hash(value)
+        tail_bits = 64 - self.precision
+        index = h >> tail_bits
+        tail = h & ((1 << tail_bits) - 1)
+        rank = tail_bits - tail.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """合并另一个草图（原地修改）"""
+        if other.precision != self.precision:
+            raise ValueError('HyperLogLog精度不一致，无法合并')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """估计不同元素的数量"""
+        import math
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / \
+            sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # 小基数修正：线性计数
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
 
-            return {
-                'id': item.id,
-                'user': {
-                    'id': item.user.id,
-                    'username': item.user.username
-                },
-                'activity_type': item.activity_type,
-                'target_type': item.target_type,
-                'target_id': item.target_id,
-                'target_info': target_info,
-                'created_at': item.created_at.isoformat()
-            }
+    @property
+    def relative_error(self):
+        """标准误差（相对值）"""
+        return 1.04 / (self.m ** 0.5)
 
-        return {
-            'feed': [serialize_feed_item(item) for item in feed_items],
-            'total': len(feed_items)
-        }
+    def to_bytes(self):
+        return bytes(self.registers)
 
-    def success_response(result):
-        return jsonify(
-            {'success': True, 'feed': result['feed'], 'total': result['total']})
 
-    return handle_api_db_operation(
-        operation_func=get_friends_feed_operation,
-        success_response_func=success_response
+class UniqueCountSketch(db.Model):
+    """按用户、指标和日期存储的HyperLogLog草图"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey(
+            'user.id',
+            ondelete='CASCADE'),
+        nullable=False)
+    metric = db.Column(db.String(20), nullable=False)  # players, worlds
+    period = db.Column(db.String(10), nullable=False)  # YYYY-MM-DD
+    precision = db.Column(db.Integer, nullable=False, default=12)
+    registers = db.Column(db.LargeBinary, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now,
+                           onupdate=datetime.now)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'metric', 'period',
+                            name='uq_unique_count_sketch'),
     )
 
 
-@app.route('/feed')
-@login_required
-def friends_feed():
-    """好友活动动态页面"""
-    return render_template('feed.html')
-
+class UniqueSketchAccumulator:
+    """在导入游戏日志时累积HyperLogLog草图，最后一次性写入数据库"""
+
+    def __init__(self, user_id, username, precision=12):
+        self.user_id = user_id
+        self.username = username
+        self.precision = precision
+        self.sketches = {}  # (metric, period) -> HyperLogLog
+
+    def _sketch(self, metric, period):
+        key = (metric, period)
+        if key not in self.sketches:
+            self.sketches[key] = HyperLogLog(self.precision)
+        return self.sketches[key]
+
+    def add(self, timestamp, event_type, world_name, world_id, player_name):
+        """记录一条游戏日志"""
+        period = timestamp.date().isoformat()
+        if event_type == '玩家加入':
+            if player_name and player_name != self.username:
+                self._sketch('players', period).add(player_name)
+        elif event_type == '位置变动':
+            world_key = world_id or world_name
+            if world_key:
+                self._sketch('worlds', period).add(world_key)
+
+    def merge(self, sketches):
+        """合并另一个累积器的草图（如并行解析时各子进程的结果）"""
+        for key, sketch in sketches.items():
+            if key in self.sketches:
+                self.sketches[key].merge(sketch)
+            else:
+                self.sketches[key] = sketch
+
+    def flush(self):
+        """将累积的草图合并到数据库中"""
+        if not self.sketches:
+            return
+        periods = {period for _, period in self.sketches}
+        existing = UniqueCountSketch.query.filter(
+            UniqueCountSketch.user_id == self.user_id,
+            UniqueCountSketch.period.in_(periods)
+        ).all()
+        existing_map = {(s.metric, s.period): s for s in existing}
+
+        for (metric, period), sketch in self.sketches.items():
+            row = existing_map.get((metric, period))
+            if row:
+                merged = HyperLogLog(row.precision, row.registers)
+                merged.merge(sketch)
+                row.registers = merged.to_bytes()
+            else:
+                db.session.add(UniqueCountSketch(
+                    user_id=self.user_id,
+                    metric=metric,
+                    period=period,
+                    precision=self.precision,
+                    registers=sketch.to_bytes()
+                ))
+        self.sketches = {}
 
-# ------------------------------
-# 事件导出路由
-# ------------------------------
 
-@app.route('/api/events/export')
+@app.route('/api/stats/unique')
 @login_required
-def export_events():
-    """导出事件数据"""
-    import csv
-    from io import StringIO
-    from datetime import datetime
+def get_unique_stats():
+    """获取近似去重统计：遇到的不同玩家数和访问的不同世界数
 
-    # 获取参数
-    export_format = request.args.get('format', 'csv').lower()
+    可选参数 start_date / end_date（YYYY-MM-DD），按日期范围合并每日草图。
+    """
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
-    tag = request.args.get('tag')
 
-    def export_events_operation():
-        # 构建事件查询
-        from sqlalchemy import or_
-        query = SharedEvent.query.filter(
-            (SharedEvent.user_id == current_user.id) |
-            (SharedEvent.participants.contains(current_user))
-        )
+    def get_unique_stats_operation():
+        query = UniqueCountSketch.query.filter(
+            UniqueCountSketch.user_id == current_user.id)
 
-        # 应用日期筛选
+        # 日期字符串格式为YYYY-MM-DD，可以直接按字典序比较
         if start_date:
             try:
                 start_dt = datetime.strptime(start_date, '%Y-%m-%d')
-                query = query.filter(SharedEvent.start_time >= start_dt)
+                query = query.filter(
+                    UniqueCountSketch.period >= start_dt.strftime('%Y-%m-%d'))
             except ValueError:
                 pass
 
         if end_date:
             try:
                 end_dt = datetime.strptime(end_date, '%Y-%m-%d')
-                query = query.filter(SharedEvent.end_time <= end_dt)
+                query = query.filter(
+                    UniqueCountSketch.period <= end_dt.strftime('%Y-%m-%d'))
             except ValueError:
                 pass
 
-        # 应用标签筛选
-        if tag:
-            query = filter_events_by_tag(query, tag)
-
-        events = query.order_by(SharedEvent.start_time.desc()).all()
-
-        # 根据格式导出
-        if export_format == 'json':
-            # 导出为JSON
-            import json
-            events_data = []
-            for event in events:
-                events_data.append({
-                    'id': event.id,
-                    'friend_name': event.friend_name,
-                    'world_name': event.world.world_name,
-                    'start_time': event.start_time.isoformat(),
-                    'end_time': event.end_time.isoformat() if event.end_time else None,
-                    'duration': event.duration,
-                    'notes': event.notes,
-                    'privacy': event.privacy,
-                    'custom_tags': [tag.tag_name for tag in event.custom_tags],
-                    'world_tags': event.world.tags.split(',') if event.world.tags else []
-                })
-            return {
-                'format': 'json',
-                'data': json.dumps(events_data, ensure_ascii=False, indent=2),
-                'filename': f'events_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-            }
-        else:
-            # 默认导出为CSV
-            csv_data = StringIO()
-            fieldnames = [
-                'id',
-                'friend_name',
-                'world_name',
-                'start_time',
-                'end_time',
-                'duration',
-                'notes',
-                'privacy',
-                'custom_tags',
-                'world_tags']
-            writer = csv.DictWriter(csv_data, fieldnames=fieldnames)
-
-            writer.writeheader()
-            for event in events:
-                writer.writerow({
-                    'id': event.id,
-                    'friend_name': event.friend_name,
-                    'world_name': event.world.world_name,
-                    'start_time': event.start_time.isoformat(),
-                    'end_time': event.end_time.isoformat() if event.end_time else '',
-                    'duration': event.duration,
-                    'notes': event.notes or '',
-                    'privacy': event.privacy,
-                    'custom_tags': ','.join([tag.tag_name for tag in event.custom_tags]),
-                    'world_tags': event.world.tags or ''
-                })
+        merged = {
+            'players': HyperLogLog(),
+            'worlds': HyperLogLog()
+        }
+        periods = set()
+        for row in query.all():
+            merged[row.metric].merge(HyperLogLog(row.precision, row.registers))
+            periods.add(row.period)
 
-            return {
-                'format': 'csv',
-                'data': csv_data.getvalue(),
-                'filename': f'events_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-            }
+        return {
+            'unique_players': merged['players'].count(),
+            'unique_worlds': merged['worlds'].count(),
+            'relative_error': round(merged['players'].relative_error, 4),
+            'days': len(periods)
+        }
 
     def success_response(result):
-        from flask import Response
-
-        # 设置响应头
-        mimetype = 'application/json' if result['format'] == 'json' else 'text/csv'
-        return Response(
-            result['data'],
-            mimetype=mimetype,
-            headers={
-                'Content-Disposition': f'attachment; filename={result["filename"]}'
-            }
-        )
+        return jsonify({'success': True, 'data': result})
 
     return handle_api_db_operation(
-        operation_func=export_events_operation,
+        operation_func=get_unique_stats_operation,
         success_response_func=success_response
     )
 
 
 # ------------------------------
-# 高级可视化路由
+# 全站排行榜
 # ------------------------------
 
-@app.route('/api/visualization/timeline')
-@login_required
-def get_timeline_data():
-    """获取时间线可视化数据"""
-    def get_timeline_data_operation():
-        # 获取事件数据
-        events = SharedEvent.query.filter(
-            (SharedEvent.user_id == current_user.id) |
-            (SharedEvent.participants.contains(current_user))
-        ).order_by(SharedEvent.start_time).all()
+# 每个排行榜（指标 + 周期）保留的最大条目数
+LEADERBOARD_TOP_K = 100
 
-        # 格式化数据
-        timeline_data = []
-        for event in events:
-            timeline_data.append({
-                'id': event.id,
-                'title': f"与 {event.friend_name.strip()} 在 {event.world.world_name}",
-                'start': event.start_time.isoformat(),
-                'end': event.end_time.isoformat() if event.end_time else None,
-                'duration': event.duration,
-                'world': event.world.world_name,
-                'friend': event.friend_name
-            })
+# 排行榜指标：worlds（最常访问的世界）、sessions（最长的会话）、
+# social（最社交的玩家：周期内一起出现过的不同玩家数）
+LEADERBOARD_METRICS = ('worlds', 'sessions', 'social')
 
-        return timeline_data
 
-    def success_response(result):
-        return jsonify({'success': True, 'data': result})
+class LeaderboardEntry(db.Model):
+    """排行榜条目，在事件写入时增量维护"""
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(20), nullable=False)
+    period_type = db.Column(db.String(10), nullable=False)  # day, week, all
+    period_key = db.Column(db.String(10), nullable=False)  # 2025-01-31, 2025-W05, all
+    subject_id = db.Column(db.Integer, nullable=False)  # 世界ID、事件ID或用户ID
+    subject_label = db.Column(db.String(200))
+    score = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('metric', 'period_type', 'period_key', 'subject_id',
+                            name='uq_leaderboard_subject'),
+        db.Index('ix_leaderboard_rank', 'metric', 'period_type',
+                 'period_key', 'score'),
+    )
 
-    return handle_api_db_operation(
-        operation_func=get_timeline_data_operation,
-        success_response_func=success_response
+
+class LeaderboardCompanion(db.Model):
+    """社交排行榜的明细：每个周期内用户与每个玩家共同出现的公开事件数
+
+    计数从0变为正数时用户的social得分加1，回到0时减1，得分即不同玩家数。
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    period_type = db.Column(db.String(10), nullable=False)
+    period_key = db.Column(db.String(10), nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    companion = db.Column(db.String(80), nullable=False)
+    events = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('period_type', 'period_key', 'user_id', 'companion',
+                            name='uq_leaderboard_companion'),
     )
 
 
+def leaderboard_periods(timestamp):
+    """返回事件时间所属的所有排行榜周期"""
+    return [
+        ('day', timestamp.strftime('%Y-%m-%d')),
+        ('week', timestamp.strftime('%G-W%V')),
+        ('all', 'all')
+    ]
 
 
+def leaderboard_period_range(period_type, period_key):
+    """周期键对应的时间范围[start, end)，all返回(None, None)"""
+    if period_type == 'day':
+        start = datetime.strptime(period_key, '%Y-%m-%d')
+        return start, start + timedelta(days=1)
+    if period_type == 'week':
+        start = datetime.strptime(f'{period_key}-1', '%G-W%V-%u')
+        return start, start + timedelta(days=7)
+    return None, None
 
-@app.route('/api/events/connections')
+
+def session_label(username, friend_name, world_name):
+    """会话时长排行榜的条目标签"""
+    return f"{username} 与 {(friend_name or '').strip()} 在 {world_name}"
+
+
+# 计入排行榜的事件字段，暂存的变化为 (sign,) + 这些字段的值
+LEADERBOARD_EVENT_FIELDS = ('user_id', 'world_id', 'id', 'friend_name',
+                            'start_time', 'duration', 'privacy')
+
+
+def apply_leaderboard_changes(connection, changes):
+    """批量应用事件对排行榜的贡献
+
+    changes中每项为 (sign, user_id, world_id, event_id, friend_name, start_time,
+    duration, privacy)，sign=1加上、sign=-1撤销。非公开事件不计入排行榜。
+    累计型指标合并为每个条目一次upsert；会话时长按事件取最终状态，
+    被撤销的会话在榜上、且原本已满的榜因此不足K名时，从剩余的公开事件中重新计算前K名。
+    """
+    from sqlalchemy import select, delete, bindparam, func, tuple_
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+    changes = [change for change in changes
+               if change[5] is not None and (change[7] or 'public') == 'public']
+    if not changes:
+        return
+
+    table = LeaderboardEntry.__table__
+    world_names = dict(connection.execute(select(World.id, World.world_name).where(
+        World.id.in_({change[2] for change in changes}))).all())
+    usernames = dict(connection.execute(select(User.id, User.username).where(
+        User.id.in_({change[1] for change in changes}))).all())
+
+    counts = {}  # (metric, period_type, period_key, subject_id) -> [增量, 标签]
+    companions = {}  # (period_type, period_key, user_id, 玩家名) -> 事件数增量
+    sessions = {}  # (period_type, period_key, event_id) -> (时长, 标签)，撤销为None
+    for sign, user_id, world_id, event_id, friend_name, start_time, duration, _ in changes:
+        label = session_label(usernames.get(user_id), friend_name, world_names.get(world_id))
+        companion = (friend_name or '').strip()
+        for period_type, period_key in leaderboard_periods(start_time):
+            # 世界访问次数
+            entry = counts.setdefault(
+                ('worlds', period_type, period_key, world_id), [0, world_names.get(world_id)])
+            entry[0] += sign
+            # 共同出现的玩家
+            if companion:
+                key = (period_type, period_key, user_id, companion)
+                companions[key] = companions.get(key, 0) + sign
+            # 会话时长：每个事件一条记录
+            sessions[(period_type, period_key, event_id)] = \
+                (duration, label) if sign > 0 and duration else None
+
+    # social：读取受影响的玩家计数，按计数是否跨过0得到不同玩家数的变化
+    companion_table = LeaderboardCompanion.__table__
+    companions = {key: delta for key, delta in companions.items() if delta}
+    existing = {}
+    for chunk in _chunked(companions, 200):
+        existing.update(((row[0], row[1], row[2], row[3]), row[4]) for row in connection.execute(
+            select(companion_table.c.period_type, companion_table.c.period_key,
+                   companion_table.c.user_id, companion_table.c.companion,
+                   companion_table.c.events).where(
+                tuple_(companion_table.c.period_type, companion_table.c.period_key,
+                       companion_table.c.user_id, companion_table.c.companion).in_(chunk))))
+    companion_rows = []
+    for (period_type, period_key, user_id, companion), delta in companions.items():
+        before = existing.get((period_type, period_key, user_id, companion), 0)
+        after = before + delta
+        companion_rows.append({'period_type': period_type, 'period_key': period_key,
+                               'user_id': user_id, 'companion': companion, 'events': delta})
+        change = (after > 0) - (before > 0)
+        if change:
+            entry = counts.setdefault(
+                ('social', period_type, period_key, user_id), [0, usernames.get(user_id)])
+            entry[0] += change
+    if companion_rows:
+        upsert = sqlite_insert(companion_table)
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=['period_type', 'period_key', 'user_id', 'companion'],
+            set_={'events': companion_table.c.events + upsert.excluded.events}
+        ), companion_rows)
+        connection.execute(delete(companion_table).where(companion_table.c.events <= 0))
+
+    count_rows = [{
+        'metric': metric, 'period_type': period_type, 'period_key': period_key,
+        'subject_id': subject_id, 'subject_label': label, 'score': delta
+    } for (metric, period_type, period_key, subject_id), (delta, label) in counts.items()
+        if delta]
+    if count_rows:
+        upsert = sqlite_insert(table)
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=['metric', 'period_type', 'period_key', 'subject_id'],
+            set_={'score': table.c.score + upsert.excluded.score,
+                  'subject_label': func.coalesce(upsert.excluded.subject_label,
+                                                 table.c.subject_label)}
+        ), count_rows)
+        connection.execute(delete(table).where(
+            table.c.metric.in_(('worlds', 'social')) & (table.c.score <= 0)))
+
+    removed = [{'b_period_type': period_type, 'b_period_key': period_key,
+                'b_subject_id': event_id}
+               for (period_type, period_key, event_id), entry in sessions.items()
+               if entry is None]
+    # 被撤销的会话在榜上的周期，以及这些周期的榜此前是否已满
+    removed_keys = {(row['b_period_type'], row['b_period_key'], row['b_subject_id'])
+                    for row in removed}
+    removed_on_board = set()
+    for chunk in _chunked({row['b_subject_id'] for row in removed}):
+        for period_type, period_key, subject_id in connection.execute(
+                select(table.c.period_type, table.c.period_key, table.c.subject_id).where(
+                    table.c.metric == 'sessions', table.c.subject_id.in_(chunk))):
+            if (period_type, period_key, subject_id) in removed_keys:
+                removed_on_board.add((period_type, period_key))
+
+    def board_size(period_type, period_key):
+        return connection.execute(select(func.count()).where(
+            table.c.metric == 'sessions', table.c.period_type == period_type,
+            table.c.period_key == period_key)).scalar()
+
+    full_before = {period for period in removed_on_board
+                   if board_size(*period) >= LEADERBOARD_TOP_K}
+    if removed:
+        connection.execute(delete(table).where(
+            (table.c.metric == 'sessions') &
+            (table.c.period_type == bindparam('b_period_type')) &
+            (table.c.period_key == bindparam('b_period_key')) &
+            (table.c.subject_id == bindparam('b_subject_id'))
+        ), removed)
+
+    added = [{
+        'metric': 'sessions', 'period_type': period_type, 'period_key': period_key,
+        'subject_id': event_id, 'subject_label': entry[1], 'score': entry[0]
+    } for (period_type, period_key, event_id), entry in sessions.items() if entry]
+    if added:
+        upsert = sqlite_insert(table)
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=['metric', 'period_type', 'period_key', 'subject_id'],
+            set_={'score': upsert.excluded.score,
+                  'subject_label': upsert.excluded.subject_label}
+        ), added)
+
+    # 榜上剩余的会话仍是前K名，只有原本已满的榜跌破K名时才需要从事件中补足
+    for period in {(period_type, period_key) for period_type, period_key, _ in sessions}:
+        if period in full_before and board_size(*period) < LEADERBOARD_TOP_K:
+            rebuild_session_board(connection, *period)
+        else:
+            trim_session_board(connection, *period)
+
+
+def trim_session_board(connection, period_type, period_key):
+    """会话时长排行榜只保留前K名"""
+    from sqlalchemy import select, delete
+
+    table = LeaderboardEntry.__table__
+    session_filter = (table.c.metric == 'sessions') & \
+        (table.c.period_type == period_type) & (table.c.period_key == period_key)
+    threshold = connection.execute(
+        select(table.c.score).where(session_filter).order_by(
+            table.c.score.desc()).offset(LEADERBOARD_TOP_K - 1).limit(1)
+    ).scalar()
+    if threshold is not None:
+        connection.execute(
+            delete(table).where(session_filter & (table.c.score < threshold)))
+
+
+def rebuild_session_board(connection, period_type, period_key):
+    """从剩余的公开事件重新计算一个周期的会话时长前K名（已满的榜因撤销跌破K名时）"""
+    from sqlalchemy import select, delete, func
+
+    table = LeaderboardEntry.__table__
+    events = SharedEvent.__table__
+    worlds = World.__table__
+    users = User.__table__
+
+    query = select(
+        events.c.id, events.c.duration, events.c.friend_name,
+        users.c.username, worlds.c.world_name
+    ).select_from(
+        events.join(worlds, worlds.c.id == events.c.world_id)
+        .join(users, users.c.id == events.c.user_id)
+    ).where(
+        events.c.duration > 0,
+        func.coalesce(events.c.privacy, 'public') == 'public'
+    )
+    start, end = leaderboard_period_range(period_type, period_key)
+    if start is not None:
+        query = query.where(events.c.start_time >= start, events.c.start_time < end)
+    rows = connection.execute(query.order_by(
+        events.c.duration.desc(), events.c.id).limit(LEADERBOARD_TOP_K)).all()
+
+    connection.execute(delete(table).where(
+        (table.c.metric == 'sessions') &
+        (table.c.period_type == period_type) & (table.c.period_key == period_key)))
+    if rows:
+        connection.execute(table.insert(), [{
+            'metric': 'sessions', 'period_type': period_type, 'period_key': period_key,
+            'subject_id': row.id, 'subject_label': session_label(
+                row.username, row.friend_name, row.world_name),
+            'score': row.duration
+        } for row in rows])
+
+
+def stage_leaderboard_change(target, sign, value=None):
+    """把事件的排行榜变化暂存到会话中，提交前统一应用"""
+    from sqlalchemy.orm import object_session
+
+    value = value or (lambda name: getattr(target, name))
+    object_session(target).info.setdefault('pending_leaderboard', []).append(
+        (sign,) + tuple(value(name) for name in LEADERBOARD_EVENT_FIELDS))
+
+
+@db.event.listens_for(SharedEvent, 'after_insert')
+def leaderboard_after_event_insert(mapper, connection, target):
+    """新事件写入时暂存排行榜变化"""
+    stage_leaderboard_change(target, 1)
+
+
+@db.event.listens_for(SharedEvent, 'after_delete')
+def leaderboard_after_event_delete(mapper, connection, target):
+    """事件删除时暂存撤销的排行榜贡献"""
+    stage_leaderboard_change(target, -1)
+
+
+@db.event.listens_for(SharedEvent, 'after_update')
+def leaderboard_after_event_update(mapper, connection, target):
+    """事件的世界、时间、时长或隐私设置变化时，撤销旧贡献并加上新贡献"""
+    state = db.inspect(target)
+    tracked = ('user_id', 'world_id', 'friend_name', 'start_time', 'duration', 'privacy')
+    if not any(state.attrs[name].history.has_changes() for name in tracked):
+        return
+
+    def old_value(name):
+        history = state.attrs[name].history
+        return history.deleted[0] if history.deleted else getattr(target, name)
+
+    stage_leaderboard_change(target, -1, old_value)
+    stage_leaderboard_change(target, 1)
+
+
+@db.event.listens_for(db.session, 'before_commit')
+def leaderboard_before_commit(session):
+    """提交前把本事务暂存的排行榜变化合并应用（先刷新，确保所有变化都已暂存）"""
+    session.flush()
+    changes = session.info.pop('pending_leaderboard', None)
+    if changes:
+        apply_leaderboard_changes(session.connection(), changes)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def leaderboard_after_rollback(session):
+    """事务回滚后丢弃暂存的排行榜变化"""
+    session.info.pop('pending_leaderboard', None)
+
+
+def rebuild_leaderboards():
+    """根据现有事件重建所有排行榜（用于已有数据的数据库）"""
+    from sqlalchemy import select
+
+    LeaderboardEntry.query.delete()
+    LeaderboardCompanion.query.delete()
+    connection = db.session.connection()
+    columns = [getattr(SharedEvent.__table__.c, name) for name in LEADERBOARD_EVENT_FIELDS]
+    result = connection.execute(
+        select(*columns).order_by(SharedEvent.__table__.c.id)).yield_per(1000)
+    for rows in result.partitions():
+        apply_leaderboard_changes(connection, [(1,) + tuple(row) for row in rows])
+    db.session.commit()
+
+
+@app.route('/api/leaderboards')
 @login_required
-def get_event_connections():
-    """获取事件连接关系，识别共同事件的路由"""
-    def get_connections_operation():
-        # 1. 获取当前用户的所有事件
-        from sqlalchemy import or_
-        user_events = SharedEvent.query.filter(
-            or_(
-                SharedEvent.user_id == current_user.id,
-                SharedEvent.participants.contains(current_user)
-            )
-        ).all()
-        
-        # 2. 按事件组分组事件
-        event_groups = {}
-        for event in user_events:
-            if event.event_group_id:
-                if event.event_group_id not in event_groups:
-                    event_groups[event.event_group_id] = []
-                event_groups[event.event_group_id].append(event)
-        
-        # 3. 构建事件连接路由
-        connections = []
-        routes = []
-        
-        for group_id, events in event_groups.items():
-            if len(events) > 1:
-                # 对于每个事件组，创建事件之间的连接
-                for i in range(len(events)):
-                    for j in range(i + 1, len(events)):
-                        event1 = events[i]
-                        event2 = events[j]
-                        
-                        # 创建事件连接
-                        connection = {
-                            'event1': {
-                                'id': event1.id,
-                                'title': f"与 {event1.friend_name.strip()} 在 {event1.world.world_name}",
-                                'start_time': event1.start_time.isoformat(),
-                                'end_time': event1.end_time.isoformat() if event1.end_time else None,
-                                'user_id': event1.user_id
-                            },
-                            'event2': {
-                                'id': event2.id,
-                                'title': f"与 {event2.friend_name.strip()} 在 {event2.world.world_name}",
-                                'start_time': event2.start_time.isoformat(),
-                                'end_time': event2.end_time.isoformat() if event2.end_time else None,
-                                'user_id': event2.user_id
-                            },
-                            'connection_type': 'shared_event_group',
-                            'group_id': group_id,
-                            'sync_hash': event1.sync_hash if event1.sync_hash else 'no_sync_hash'
-                        }
-                        connections.append(connection)
-                
-                # 构建路由
-                route = {
-                    'group_id': group_id,
-                    'events': [{
-                        'id': event.id,
-                        'title': f"与 {event.friend_name.strip()} 在 {event.world.world_name}",
-                        'start_time': event.start_time.isoformat(),
-                        'end_time': event.end_time.isoformat() if event.end_time else None,
-                        'user_id': event.user_id,
-                        'sync_status': event.sync_status
-                    } for event in events],
-                    'connections': [{
-                        'event1_id': connections[i]['event1']['id'],
-                        'event2_id': connections[i]['event2']['id']
-                    } for i in range(len(connections)) if connections[i]['group_id'] == group_id]
-                }
-                routes.append(route)
-        
+def get_leaderboard():
+    """获取全站排行榜，只读取预先计算好的排行榜条目
+
+    参数：metric（worlds/sessions/social）、period（day/week/all）、
+    key（周期键，默认为当前周期）、limit（返回条数）
+    """
+    metric = request.args.get('metric', 'worlds')
+    period_type = request.args.get('period', 'all')
+    limit = min(request.args.get('limit', 10, type=int), LEADERBOARD_TOP_K)
+
+    if metric not in LEADERBOARD_METRICS:
+        return jsonify({'success': False, 'error': '不支持的排行榜指标'}), 400
+
+    current_periods = dict(leaderboard_periods(datetime.now()))
+    if period_type not in current_periods:
+        return jsonify({'success': False, 'error': '不支持的排行榜周期'}), 400
+    period_key = request.args.get('key') or current_periods[period_type]
+
+    def get_leaderboard_operation():
+        entries = LeaderboardEntry.query.filter_by(
+            metric=metric,
+            period_type=period_type,
+            period_key=period_key
+        ).order_by(
+            LeaderboardEntry.score.desc(),
+            LeaderboardEntry.subject_id
+        ).limit(limit).all()
+
         return {
-            'connections': connections,
-            'routes': routes,
-            'total_groups': len(event_groups),
-            'total_connections': len(connections)
+            'metric': metric,
+            'period': period_type,
+            'key': period_key,
+            'entries': [{
+                'rank': rank,
+                'subject_id': entry.subject_id,
+                'label': entry.subject_label,
+                'score': entry.score
+            } for rank, entry in enumerate(entries, 1)]
         }
-    
+
     def success_response(result):
         return jsonify({'success': True, 'data': result})
-    
+
     return handle_api_db_operation(
-        operation_func=get_connections_operation,
+        operation_func=get_leaderboard_operation,
         success_response_func=success_response
     )
 
 
 # ------------------------------
-# 事件提醒路由
+# 好友活动动态路由
 # ------------------------------
 
-class EventReminder(db.Model):
-    """事件提醒模型"""
+# 每个用户动态收件箱保留的最大条目数
+FEED_INBOX_MAX_LENGTH = 500
+
+# 动态扇出在后台线程中执行
+feed_fanout_queue = BackgroundTaskQueue('feed-fanout')
+
+
+class FeedInbox(db.Model):
+    """用户动态收件箱：好友的活动在写入时扇出到每个关注者的收件箱"""
     id = db.Column(db.Integer, primary_key=True)
-    event_id = db.Column(
+    owner_id = db.Column(
         db.Integer,
         db.ForeignKey(
-            'shared_event.id',
+            'user.id',
+            ondelete='CASCADE'),
+        nullable=False)
+    activity_id = db.Column(
+        db.Integer,
+        db.ForeignKey(
+            'activity_feed.id',
+            ondelete='CASCADE'),
+        nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)  # 活动的创建时间
+
+    activity = db.relationship('ActivityFeed')
+
+    __table_args__ = (
+        db.UniqueConstraint('owner_id', 'activity_id', name='uq_feed_inbox_activity'),
+        db.Index('ix_feed_inbox_owner_created', 'owner_id', 'created_at', 'id'),
+    )
+
+
+def fan_out_activities(activity_ids):
+    """将活动写入所有关注者（把活动用户加为好友的用户）的收件箱"""
+    from sqlalchemy import select
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+    activities = ActivityFeed.query.filter(
+        ActivityFeed.id.in_(activity_ids)).all()
+    if not activities:
+        return
+
+    # 一次查询加载所有活动用户的关注者
+    followers = {}
+    for owner_id, friend_id in db.session.execute(
+            select(user_friends.c.user_id, user_friends.c.friend_id).where(
+                user_friends.c.friend_id.in_({a.user_id for a in activities}))):
+        followers.setdefault(friend_id, []).append(owner_id)
+
+    rows = []
+    owner_ids = set()
+    for activity in activities:
+        for owner_id in followers.get(activity.user_id, ()):
+            rows.append({
+                'owner_id': owner_id,
+                'activity_id': activity.id,
+                'created_at': activity.created_at
+            })
+            owner_ids.add(owner_id)
+
+    if rows:
+        db.session.execute(
+            sqlite_insert(FeedInbox.__table__).on_conflict_do_nothing(), rows)
+
+    trim_feed_inboxes(owner_ids)
+    db.session.commit()
+
+
+def trim_feed_inboxes(owner_ids):
+    """保持收件箱长度有界：删除超出上限的旧条目"""
+    from sqlalchemy import select, delete
+
+    for owner_id in owner_ids:
+        keep_ids = select(FeedInbox.id).where(
+            FeedInbox.owner_id == owner_id
+        ).order_by(
+            FeedInbox.created_at.desc(), FeedInbox.id.desc()
+        ).limit(FEED_INBOX_MAX_LENGTH)
+        db.session.execute(
+            delete(FeedInbox).where(
+                FeedInbox.owner_id == owner_id,
+                FeedInbox.id.not_in(keep_ids)
+            )
+        )
+
+
+def sync_friend_inboxes(friendships):
+    """好友关系变化后同步收件箱
+
+    friendships为(owner_id, friend_id)列表。按当前的好友关系处理：owner仍关注friend时
+    补入friend最近的活动，否则从owner的收件箱删除friend的活动。
+    """
+    from sqlalchemy import select, delete, literal
+    from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+    inbox = FeedInbox.__table__
+    activity = ActivityFeed.__table__
+    for owner_id, friend_id in dict.fromkeys(friendships):
+        following = db.session.execute(select(user_friends.c.user_id).where(
+            user_friends.c.user_id == owner_id,
+            user_friends.c.friend_id == friend_id)).first()
+        if following:
+            recent = select(
+                literal(owner_id), activity.c.id, activity.c.created_at
+            ).where(activity.c.user_id == friend_id).order_by(
+                activity.c.created_at.desc(), activity.c.id.desc()
+            ).limit(FEED_INBOX_MAX_LENGTH)
+            db.session.execute(sqlite_insert(inbox).from_select(
+                ['owner_id', 'activity_id', 'created_at'], recent
+            ).on_conflict_do_nothing())
+        else:
+            db.session.execute(delete(inbox).where(
+                inbox.c.owner_id == owner_id,
+                inbox.c.activity_id.in_(
+                    select(activity.c.id).where(activity.c.user_id == friend_id))))
+
+    trim_feed_inboxes({owner_id for owner_id, _ in friendships})
+    db.session.commit()
+
+
+def rebuild_feed_inboxes():
+    """根据现有活动重建所有收件箱（用于已有数据的数据库）"""
+    FeedInbox.query.delete()
+    activity_ids = [activity_id for (activity_id,) in db.session.query(
+        ActivityFeed.id).order_by(ActivityFeed.id)]
+    for i in range(0, len(activity_ids), 500):
+        fan_out_activities(activity_ids[i:i + 500])
+    db.session.commit()
+
+
+@db.event.listens_for(ActivityFeed, 'after_insert')
+def feed_after_activity_insert(mapper, connection, target):
+    """记录新写入的活动，在事务提交后再扇出"""
+    from sqlalchemy.orm import object_session
+    session = object_session(target)
+    session.info.setdefault('pending_feed_fanout', []).append(target.id)
+
+
+@db.event.listens_for(User.friends, 'append')
+@db.event.listens_for(User.friends, 'remove')
+def feed_after_friendship_change(target, value, initiator):
+    """记录好友关系的变化（friended_by一侧的修改也会经反向引用触发）"""
+    from sqlalchemy.orm import object_session
+    session = object_session(target) or object_session(value) or db.session
+    session.info.setdefault('pending_friendship_users', []).append((target, value))
+
+
+@db.event.listens_for(db.session, 'after_flush_postexec')
+def feed_after_flush(session, flush_context):
+    """刷新后用户都已有ID，把变化的好友关系转换为(owner_id, friend_id)"""
+    users = session.info.pop('pending_friendship_users', None)
+    if users:
+        session.info.setdefault('pending_feed_friendships', []).extend(
+            (owner.id, friend.id) for owner, friend in users)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def feed_after_commit(session):
+    """事务提交后将待扇出的活动和好友关系变化交给后台线程"""
+    activity_ids = session.info.pop('pending_feed_fanout', None)
+    if activity_ids:
+        feed_fanout_queue.submit(fan_out_activities, activity_ids)
+    friendships = session.info.pop('pending_feed_friendships', None)
+    if friendships:
+        feed_fanout_queue.submit(sync_friend_inboxes, friendships)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def feed_after_rollback(session):
+    """事务回滚后丢弃待扇出的活动和好友关系变化"""
+    session.info.pop('pending_feed_fanout', None)
+    session.info.pop('pending_friendship_users', None)
+    session.info.pop('pending_feed_friendships', None)
+
+
+@app.route('/api/feed/friends')
+@login_required
+def get_friends_feed():
+    """获取好友活动动态
+
+    从当前用户的收件箱按 (owner_id, created_at) 索引范围读取。
+    参数：limit（每页条数，最多100）、cursor（上一页返回的next_cursor）
+    """
+    limit = min(request.args.get('limit', 50, type=int), 100)
+
+    # 游标格式：<created_at ISO格式>|<收件箱条目ID>
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_time_str, cursor_id_str = cursor.rsplit('|', 1)
+            cursor_time = datetime.fromisoformat(cursor_time_str)
+            cursor_id = int(cursor_id_str)
+        except ValueError:
+            return jsonify({'success': False, 'error': '无效的分页游标'}), 400
+
+    def get_friends_feed_operation():
+        from sqlalchemy.orm import joinedload
+
+        query = FeedInbox.query.options(
+            joinedload(FeedInbox.activity).joinedload(ActivityFeed.user)
+        ).filter(FeedInbox.owner_id == current_user.id)
+
+        if cursor:
+            query = query.filter(
+                (FeedInbox.created_at < cursor_time) |
+                ((FeedInbox.created_at == cursor_time) &
+                 (FeedInbox.id < cursor_id))
+            )
+
+        entries = query.order_by(
+            FeedInbox.created_at.desc(),
+            FeedInbox.id.desc()
+        ).limit(limit).all()
+        feed_items = [entry.activity for entry in entries]
+
+        next_cursor = None
+        if len(entries) == limit:
+            last = entries[-1]
+            next_cursor = f"{last.created_at.isoformat()}|{last.id}"
+
+        # 按目标类型分组，每种类型只用一次IN查询加载全部关联对象
+        target_ids = {'event': set(), 'comment': set()}
+        for item in feed_items:
+            if item.target_type in target_ids and item.target_id:
+                target_ids[item.target_type].add(item.target_id)
+
+        events_map = {}
+        if target_ids['event']:
+            events_map = {event.id: event for event in SharedEvent.query.options(
+                joinedload(SharedEvent.world)
+            ).filter(SharedEvent.id.in_(target_ids['event'])).all()}
+
+        comments_map = {}
+        if target_ids['comment']:
+            comments_map = {comment.id: comment for comment in EventComment.query.filter(
+                EventComment.id.in_(target_ids['comment'])).all()}
+
+        # 序列化活动动态
+        def serialize_feed_item(item):
+            # 获取关联对象的信息
+            target_info = {}
+            if item.target_type == 'event' and item.target_id:
+                event = events_map.get(item.target_id)
+                if event:
+                    target_info = {
+                        'id': event.id,
+                        'title': f"与 {event.friend_name.strip()} 在 {event.world.world_name}",
+                        'world_name': event.world.world_name,
+                        'friend_name': event.friend_name
+                    }
+            elif item.target_type == 'comment' and item.target_id:
+                comment = comments_map.get(item.target_id)
+                if comment:
+                    target_info = {
+                        'id': comment.id,
+                        'content': comment.content[:50] + '...' if len(comment.content) > 50 else comment.content,
+                        'event_id': comment.event_id
+                    }
+
+            return {
+                'id': item.id,
+                'user': {
+                    'id': item.user.id,
+                    'username': item.user.username
+                },
+                'activity_type': item.activity_type,
+                'target_type': item.target_type,
+                'target_id': item.target_id,
+                'target_info': target_info,
+                'created_at': item.created_at.isoformat()
+            }
+
+        return {
+            'feed': [serialize_feed_item(item) for item in feed_items],
+            'total': len(feed_items),
+            'next_cursor': next_cursor
+        }
+
+    def success_response(result):
+        return jsonify({'success': True, 'feed': result['feed'],
+                        'total': result['total'], 'next_cursor': result['next_cursor']})
+
+    return handle_api_db_operation(
+        operation_func=get_friends_feed_operation,
+        success_response_func=success_response
+    )
+
+
+@app.route('/feed')
+@login_required
+def friends_feed():
+    """好友活动动态页面"""
+    return render_template('feed.html')
+
+
+# ------------------------------
+# 事件导出路由
+# ------------------------------
+
+# 导出时每批从数据库读取的事件数，也是每个输出块包含的行数
+EXPORT_BATCH_SIZE = 500
+
+EXPORT_FIELDNAMES = [
+    'id',
+    'friend_name',
+    'world_name',
+    'start_time',
+    'end_time',
+    'duration',
+    'notes',
+    'privacy',
+    'custom_tags',
+    'world_tags']
+
+
+def build_export_query(user_id, start_date=None, end_date=None, tag=None,
+                       since=None):
+    """构建导出事件查询：用户创建或参与的事件，预加载世界和自定义标签
+
+    since：只导出行版本号大于该值的事件（增量导出）
+    """
+    from sqlalchemy.orm import joinedload, selectinload
+
+    query = SharedEvent.query.options(
+        joinedload(SharedEvent.world),
+        selectinload(SharedEvent.custom_tags)
+    ).filter(
+        (SharedEvent.user_id == user_id) |
+        (SharedEvent.participants.any(User.id == user_id))
+    )
+
+    # 应用日期筛选
+    if start_date:
+        try:
+            start_dt = datetime.strptime(start_date, '%Y-%m-%d')
+            query = query.filter(SharedEvent.start_time >= start_dt)
+        except ValueError:
+            pass
+
+    if end_date:
+        try:
+            end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+            query = query.filter(SharedEvent.end_time <= end_dt)
+        except ValueError:
+            pass
+
+    # 应用标签筛选
+    if tag:
+        query = filter_events_by_tag(query, tag)
+
+    # 增量导出
+    if since:
+        query = query.filter(SharedEvent.row_version > since)
+
+    return query.order_by(SharedEvent.start_time.desc(), SharedEvent.id.desc())
+
+
+def serialize_export_event(event):
+    """将事件序列化为导出记录"""
+    return {
+        'id': event.id,
+        'friend_name': event.friend_name,
+        'world_name': event.world.world_name,
+        'start_time': event.start_time.isoformat(),
+        'end_time': event.end_time.isoformat() if event.end_time else None,
+        'duration': event.duration,
+        'notes': event.notes,
+        'privacy': event.privacy,
+        'custom_tags': [tag.tag_name for tag in event.custom_tags],
+        'world_tags': event.world.tags.split(',') if event.world.tags else []
+    }
+
+
+def iter_export_events(query):
+    """按批次流式读取导出事件，每次只在内存中保留一批"""
+    return query.yield_per(EXPORT_BATCH_SIZE)
+
+
+def iter_export_csv(query):
+    """逐块生成CSV导出内容"""
+    import csv
+    from io import StringIO
+
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDNAMES)
+    writer.writeheader()
+
+    rows_in_buffer = 0
+    for event in iter_export_events(query):
+        record = serialize_export_event(event)
+        record['end_time'] = record['end_time'] or ''
+        record['notes'] = record['notes'] or ''
+        record['custom_tags'] = ','.join(record['custom_tags'])
+        record['world_tags'] = event.world.tags or ''
+        writer.writerow(record)
+        rows_in_buffer += 1
+
+        if rows_in_buffer >= EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            rows_in_buffer = 0
+
+    yield buffer.getvalue()
+
+
+def iter_export_json(query):
+    """逐块生成JSON数组导出内容"""
+    chunk = ['[']
+    separator = '\n'
+    for event in iter_export_events(query):
+        chunk.append(separator + '  ' + json.dumps(
+            serialize_export_event(event), ensure_ascii=False))
+        separator = ',\n'
+
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+
+    chunk.append('\n]\n')
+    yield ''.join(chunk)
+
+
+def iter_export_ndjson(query):
+    """逐块生成NDJSON导出内容：每行一个事件"""
+    chunk = []
+    for event in iter_export_events(query):
+        chunk.append(json.dumps(
+            serialize_export_event(event), ensure_ascii=False) + '\n')
+
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+
+    yield ''.join(chunk)
+
+
+# 列式导出每个行组（Parquet row group / Arrow record batch）包含的事件数
+EXPORT_ROW_GROUP_SIZE = 10000
+
+
+class _ChunkSink:
+    """只追加写入的文件对象，供pyarrow写入器使用，写入的数据可以随时取出"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        """取出并清空已写入的数据"""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def columnar_export_available():
+    """检查可选依赖pyarrow是否已安装"""
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def iter_export_columnar(query, file_format):
+    """逐个行组生成Parquet或Arrow IPC（流格式）导出内容
+
+    世界名称和好友名称使用字典编码。需要安装可选依赖pyarrow。
+    """
+    import pyarrow as pa
+
+    dictionary_string = pa.dictionary(pa.int32(), pa.string())
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('friend_name', dictionary_string),
+        ('world_name', dictionary_string),
+        ('start_time', pa.timestamp('us')),
+        ('end_time', pa.timestamp('us')),
+        ('duration', pa.int64()),
+        ('notes', pa.string()),
+        ('privacy', dictionary_string),
+        ('custom_tags', pa.list_(pa.string())),
+        ('world_tags', pa.list_(pa.string())),
+    ])
+
+    sink = _ChunkSink()
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(
+            pa.PythonFile(sink, mode='w'), schema, compression='snappy')
+    else:
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+
+    def empty_columns():
+        return {field.name: [] for field in schema}
+
+    columns = empty_columns()
+    row_count = 0
+    for event in iter_export_events(query):
+        columns['id'].append(event.id)
+        columns['friend_name'].append(event.friend_name)
+        columns['world_name'].append(event.world.world_name)
+        columns['start_time'].append(event.start_time)
+        columns['end_time'].append(event.end_time)
+        columns['duration'].append(event.duration)
+        columns['notes'].append(event.notes)
+        columns['privacy'].append(event.privacy)
+        columns['custom_tags'].append(
+            [tag.tag_name for tag in event.custom_tags])
+        columns['world_tags'].append(
+            event.world.tags.split(',') if event.world.tags else [])
+        row_count += 1
+
+        if row_count >= EXPORT_ROW_GROUP_SIZE:
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+            yield sink.drain()
+            columns = empty_columns()
+            row_count = 0
+
+    if row_count:
+        writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+    writer.close()
+    yield sink.drain()
+
+
+def iter_export_parquet(query):
+    return iter_export_columnar(query, 'parquet')
+
+
+def iter_export_arrow(query):
+    return iter_export_columnar(query, 'arrow')
+
+
+# 导出格式 -> (内容生成函数, MIME类型, 文件扩展名)
+EXPORT_FORMATS = {
+    'csv': (iter_export_csv, 'text/csv', 'csv'),
+    'json': (iter_export_json, 'application/json', 'json'),
+    'ndjson': (iter_export_ndjson, 'application/x-ndjson', 'ndjson'),
+    'parquet': (iter_export_parquet, 'application/vnd.apache.parquet', 'parquet'),
+    'arrow': (iter_export_arrow, 'application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+# 需要可选依赖pyarrow的导出格式
+COLUMNAR_EXPORT_FORMATS = ('parquet', 'arrow')
+
+
+@app.route('/api/events/export')
+@login_required
+@compressed_response
+def export_events():
+    """导出事件数据
+
+    支持格式：csv、json、ndjson、parquet、arrow（后两者需要安装pyarrow）。
+    导出内容由生成器逐块产生并以流式响应返回，内存占用与导出规模无关。
+    """
+    from flask import Response, stream_with_context
+
+    # 获取参数
+    export_format = request.args.get('format', 'csv').lower()
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    tag = request.args.get('tag')
+    since = request.args.get('since', type=int)
+
+    if export_format not in EXPORT_FORMATS:
+        # 未知格式默认导出为CSV
+        export_format = 'csv'
+
+    if export_format in COLUMNAR_EXPORT_FORMATS and not columnar_export_available():
+        return jsonify({'success': False,
+                        'error': 'Parquet/Arrow导出需要安装pyarrow'}), 501
+
+    def export_events_operation():
+        # 先读取当前版本号，客户端下次增量导出时作为since传入
+        row_version = current_row_version()
+        query = build_export_query(
+            current_user.id, start_date, end_date, tag, since)
+        generate, mimetype, extension = EXPORT_FORMATS[export_format]
+        return {
+            'chunks': generate(query),
+            'row_version': row_version,
+            'mimetype': mimetype,
+            'filename': f'events_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+        }
+
+    def success_response(result):
+        # 设置响应头
+        return Response(
+            stream_with_context(result['chunks']),
+            mimetype=result['mimetype'],
+            headers={
+                'Content-Disposition': f'attachment; filename={result["filename"]}',
+                'X-Row-Version': str(result['row_version'])
+            }
+        )
+
+    return handle_api_db_operation(
+        operation_func=export_events_operation,
+        success_response_func=success_response
+    )
+
+
+# ------------------------------
+# 异步导出任务路由
+# ------------------------------
+
+# 导出文件的保留时间，过期后自动删除
+EXPORT_JOB_TTL = timedelta(hours=24)
+
+export_job_queue = BackgroundTaskQueue('export-jobs')
+
+
+class ExportJob(db.Model):
+    """异步导出任务：后台生成导出文件，完成后可断点续传下载"""
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey(
+            'user.id',
+            ondelete='CASCADE'),
+        nullable=False)
+    export_format = db.Column(db.String(20), nullable=False)
+    filters = db.Column(db.Text)  # JSON：start_date, end_date, tag, since
+    # 任务状态：queued, running, done, failed, expired
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    bytes_written = db.Column(db.Integer, default=0)
+    file_path = db.Column(db.String(500))
+    error = db.Column(db.Text)
+    lease_token = db.Column(db.String(32))  # 执行任务的线程领取时生成
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'format': self.export_format,
+            'filters': json.loads(self.filters) if self.filters else {},
+            'status': self.status,
+            'bytes_written': self.bytes_written,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
+            'download_url': url_for('download_export_job', job_id=self.id)
+            if self.status == 'done' else None
+        }
+
+
+def get_export_dir():
+    """导出文件目录：instance/exports"""
+    import os
+    export_dir = os.path.join(app.instance_path, 'exports')
+    os.makedirs(export_dir, exist_ok=True)
+    return export_dir
+
+
+def run_export_job(job_id):
+    """在后台线程中执行导出任务，将导出内容逐块写入文件
+
+    任务先被原子地领取（见claim_job），写入期间定期更新心跳；
+    租约过期被其他进程收回时放弃本次执行。
+    """
+    import os
+    from sqlalchemy import update
+
+    lease_token = claim_job(ExportJob, job_id)
+    if not lease_token:
+        return
+    job = db.session.get(ExportJob, job_id)
+
+    filters = json.loads(job.filters) if job.filters else {}
+    generate, _, extension = EXPORT_FORMATS[job.export_format]
+    file_path = os.path.join(get_export_dir(), f'{job.id}.{extension}')
+    temp_path = f'{file_path}.{lease_token}.part'
+
+    def finish(**values):
+        # 只有仍持有租约时才写入结果
+        db.session.execute(update(ExportJob).where(
+            ExportJob.id == job_id, ExportJob.lease_token == lease_token
+        ).values(finished_at=datetime.now(), **values))
+        db.session.commit()
+
+    try:
+        query = build_export_query(
+            job.user_id,
+            filters.get('start_date'),
+            filters.get('end_date'),
+            filters.get('tag'),
+            filters.get('since')
+        )
+        bytes_written = 0
+        last_heartbeat = datetime.now()
+        with open(temp_path, 'wb') as f:
+            for chunk in generate(query):
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                f.write(chunk)
+                bytes_written += len(chunk)
+                if datetime.now() - last_heartbeat >= JOB_HEARTBEAT_INTERVAL:
+                    # 导出查询仍在读取，心跳使用独立的连接提交
+                    with db.engine.begin() as connection:
+                        heartbeat_job(connection, ExportJob, job_id, lease_token)
+                    last_heartbeat = datetime.now()
+        db.session.rollback()  # 结束导出查询的读事务
+        with db.engine.begin() as connection:
+            heartbeat_job(connection, ExportJob, job_id, lease_token)
+        os.replace(temp_path, file_path)
+
+        finished_at = datetime.now()
+        finish(status='done', file_path=file_path, bytes_written=bytes_written,
+               expires_at=finished_at + EXPORT_JOB_TTL)
+    except JobLeaseLost:
+        db.session.rollback()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    except Exception as e:
+        db.session.rollback()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        finish(status='failed', error=str(e))
+
+
+def expire_export_job(job):
+    """任务已过期时删除导出文件并标记为expired（由调用方提交），返回是否过期"""
+    import os
+
+    if job.status != 'done' or not job.expires_at or job.expires_at >= datetime.now():
+        return False
+    if job.file_path and os.path.exists(job.file_path):
+        os.remove(job.file_path)
+    job.status = 'expired'
+    job.file_path = None
+    return True
+
+
+def expire_export_jobs():
+    """删除过期的导出文件，并将任务标记为expired"""
+    expired_jobs = ExportJob.query.filter(
+        ExportJob.status == 'done',
+        ExportJob.expires_at < datetime.now()
+    ).all()
+    for job in expired_jobs:
+        expire_export_job(job)
+    db.session.commit()
+
+
+def resume_export_jobs():
+    """重新提交排队中和心跳超时（所在进程已退出）的导出任务，并清理过期文件
+
+    导出任务只在内存队列中排队，重启后需要从数据库恢复。其他进程仍在执行的任务
+    心跳未超时，不会被收回；同一任务被多个进程提交时只有一个能领取。
+    """
+    for job_id in reclaim_expired_jobs(ExportJob):
+        export_job_queue.submit(run_export_job, job_id)
+    export_job_queue.submit(expire_export_jobs)
+
+
+@app.route('/api/events/export/jobs', methods=['POST'])
+@login_required
+def create_export_job():
+    """提交异步导出任务，立即返回任务ID"""
+    import uuid
+
+    data = request.get_json(silent=True) or {}
+    export_format = (data.get('format') or 'csv').lower()
+
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'error': '不支持的导出格式'}), 400
+    if export_format in COLUMNAR_EXPORT_FORMATS and not columnar_export_available():
+        return jsonify({'success': False,
+                        'error': 'Parquet/Arrow导出需要安装pyarrow'}), 501
+
+    def create_export_job_operation():
+        job = ExportJob(
+            id=uuid.uuid4().hex,
+            user_id=current_user.id,
+            export_format=export_format,
+            filters=json.dumps({
+                'start_date': data.get('start_date'),
+                'end_date': data.get('end_date'),
+                'tag': data.get('tag'),
+                'since': data.get('since')
+            })
+        )
+        db.session.add(job)
+        return job
+
+    def success_response(job):
+        # 提交后再交给后台线程，保证线程能读到任务记录
+        export_job_queue.submit(run_export_job, job.id)
+        export_job_queue.submit(expire_export_jobs)
+        return jsonify({'success': True, 'job': job.to_dict()}), 202
+
+    return handle_api_db_operation(
+        operation_func=create_export_job_operation,
+        success_response_func=success_response
+    )
+
+
+@app.route('/api/events/export/jobs/<string:job_id>')
+@login_required
+def get_export_job(job_id):
+    """查询导出任务状态"""
+    job = ExportJob.query.filter_by(
+        id=job_id, user_id=current_user.id).first_or_404()
+    if expire_export_job(job):
+        db.session.commit()
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+
+@app.route('/api/events/export/jobs/<string:job_id>/download')
+@login_required
+def download_export_job(job_id):
+    """下载导出文件
+
+    支持HTTP Range（断点续传）和If-None-Match（文件未变化时返回304）。
+    """
+    import os
+    from flask import send_file
+
+    job = ExportJob.query.filter_by(
+        id=job_id, user_id=current_user.id).first_or_404()
+    if expire_export_job(job):
+        db.session.commit()
+
+    if job.status != 'done' or not job.file_path or not os.path.exists(job.file_path):
+        return jsonify({'success': False, 'error': '导出文件尚未生成或已过期',
+                        'status': job.status}), 409
+
+    _, mimetype, extension = EXPORT_FORMATS[job.export_format]
+    created = job.created_at.strftime('%Y%m%d_%H%M%S')
+    # 导出文件生成后不会再改变，任务ID即可作为ETag
+    return send_file(
+        job.file_path,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=f'events_export_{created}.{extension}',
+        conditional=True,
+        etag=job.id,
+        last_modified=job.finished_at
+    )
+
+
+# ------------------------------
+# 账户快照（独立SQLite文件）
+# ------------------------------
+
+# 快照文件包含的表，按导入时的依赖顺序排列
+SNAPSHOT_TABLES = ('user', 'world', 'shared_event', 'event_participants',
+                   'event_tag', 'event_comment', 'game_log')
+
+# 快照读写时每批处理的行数
+SNAPSHOT_BATCH_SIZE = 1000
+
+
+def write_account_snapshot(user_id, dest_path):
+    """将用户可见的事件、世界、标签、评论和游戏日志写入一个新的SQLite文件
+
+    主数据库在一个读事务中读取（WAL模式下是一致的快照，不阻塞写入者），
+    目标文件在一个事务中用executemany批量写入，行数据以游标流式传递。
+
+    Returns:
+        dict: 每个表写入的行数
+    """
+    import sqlite3
+    from sqlalchemy.schema import CreateTable, CreateIndex
+
+    visible_events = ('(user_id = :uid OR id IN '
+                      '(SELECT event_id FROM event_participants WHERE user_id = :uid))')
+    visible_event_ids = f'SELECT id FROM shared_event WHERE {visible_events}'
+    table_filters = {
+        'user': (f'id = :uid OR id IN (SELECT user_id FROM event_participants '
+                 f'WHERE event_id IN ({visible_event_ids})) '
+                 f'OR id IN (SELECT user_id FROM shared_event WHERE {visible_events}) '
+                 f'OR id IN (SELECT user_id FROM event_comment '
+                 f'WHERE event_id IN ({visible_event_ids}))'),
+        'world': f'id IN (SELECT world_id FROM shared_event WHERE {visible_events})',
+        'shared_event': visible_events,
+        'event_participants': f'event_id IN ({visible_event_ids})',
+        'event_tag': f'event_id IN ({visible_event_ids})',
+        'event_comment': f'event_id IN ({visible_event_ids})',
+        'game_log': 'user_id = :uid',
+    }
+
+    source = sqlite3.connect(db.engine.url.database, isolation_level=None)
+    dest = sqlite3.connect(dest_path, isolation_level=None)
+    counts = {}
+    try:
+        # 新文件写入失败时直接丢弃，不需要日志
+        dest.execute('PRAGMA journal_mode=OFF')
+        dest.execute('PRAGMA synchronous=OFF')
+        for name in SNAPSHOT_TABLES:
+            dest.execute(str(CreateTable(db.metadata.tables[name]).compile(
+                dialect=db.engine.dialect)))
+        dest.execute('CREATE TABLE snapshot_info (key TEXT PRIMARY KEY, value TEXT)')
+
+        source.execute('BEGIN')
+        dest.execute('BEGIN')
+        for name in SNAPSHOT_TABLES:
+            table = db.metadata.tables[name]
+            columns = [column.name for column in table.columns]
+            # 不导出密码哈希
+            select_columns = ', '.join(
+                "'' AS password_hash" if name == 'user' and column == 'password_hash'
+                else f'"{column}"' for column in columns)
+            rows = source.execute(
+                f'SELECT {select_columns} FROM "{name}" WHERE {table_filters[name]}',
+                {'uid': user_id})
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            placeholders = ', '.join('?' for _ in columns)
+            counts[name] = dest.executemany(
+                f'INSERT INTO "{name}" ({column_list}) VALUES ({placeholders})',
+                rows).rowcount
+
+        row_version = source.execute(
+            'SELECT value FROM row_version_counter WHERE id = 1').fetchone()
+        username = source.execute(
+            'SELECT username FROM user WHERE id = ?', (user_id,)).fetchone()
+        source.execute('COMMIT')
+
+        # 数据写入后再建索引，速度更快
+        for name in SNAPSHOT_TABLES:
+            for index in db.metadata.tables[name].indexes:
+                dest.execute(str(CreateIndex(index).compile(
+                    dialect=db.engine.dialect)))
+        dest.executemany('INSERT INTO snapshot_info (key, value) VALUES (?, ?)', [
+            ('format_version', '1'),
+            ('user_id', str(user_id)),
+            ('username', username[0] if username else ''),
+            ('row_version', str(row_version[0] if row_version else 0)),
+            ('created_at', datetime.now().isoformat())
+        ])
+        dest.execute('COMMIT')
+    finally:
+        source.close()
+        dest.close()
+
+    return counts
+
+
+def _snapshot_rows(table, rows):
+    """将快照中的原始行转换为可以插入主数据库的字典（解析日期时间列）"""
+    datetime_columns = [column.name for column in table.columns
+                        if isinstance(column.type, db.DateTime)]
+    for row in rows:
+        record = dict(row)
+        for name in datetime_columns:
+            if isinstance(record.get(name), str):
+                record[name] = datetime.fromisoformat(record[name])
+        yield record
+
+
+def _fetch_batches(cursor, size=SNAPSHOT_BATCH_SIZE):
+    """按批次读取游标结果"""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield rows
+
+
+def import_account_snapshot(path, user):
+    """将快照文件中快照所有者的事件、标签、评论和游戏日志批量恢复到当前用户
+
+    世界按world_id或名称匹配已有世界。快照文件由用户上传、内容不可信，
+    只恢复快照所有者本人的参与记录和评论（归属到当前用户），其他用户的行被丢弃。
+    重复导入是幂等的：已存在的事件、评论和日志会被跳过。导入前先转换待转换的日志，
+    导入后推进转换水位线，快照中的日志不会被再次转换。
+    所有写入都在调用方的事务中完成。
+
+    Returns:
+        dict: 每类数据恢复的行数
+    """
+    import sqlite3
+    from sqlalchemy import insert, update, select, bindparam
+
+    source = sqlite3.connect(path)
+    source.row_factory = sqlite3.Row
+    try:
+        try:
+            info = dict(source.execute(
+                'SELECT key, value FROM snapshot_info').fetchall())
+        except sqlite3.DatabaseError:
+            raise ValueError('不是有效的账户快照文件')
+        owner_id = int(info['user_id'])
+
+        # 0. 先转换水位线之后的日志，导入后水位线才能直接越过快照中的日志
+        counts = {'events_converted': convert_user_game_logs(user)}
+        db.session.flush()
+
+        connection = db.session.connection()
+        version = next_row_version(connection)
+
+        # 1. 用户：只有快照所有者映射到当前用户
+        user_map = {owner_id: user.id}
+
+        # 2. 世界：优先按world_id匹配，其次按名称匹配，缺失的批量创建
+        snapshot_worlds = source.execute(
+            'SELECT id, world_name, world_id, tags FROM world').fetchall()
+        by_world_id = {}
+        by_name = {}
+        for chunk in _chunked({row['world_id'] for row in snapshot_worlds if row['world_id']}):
+            for world_pk, world_id in db.session.execute(
+                    select(World.id, World.world_id).where(
+                        World.world_id.in_(chunk)).order_by(World.id)):
+                by_world_id.setdefault(world_id, world_pk)
+        for chunk in _chunked({row['world_name'] for row in snapshot_worlds}):
+            for world_pk, world_name in db.session.execute(
+                    select(World.id, World.world_name).where(
+                        World.world_name.in_(chunk)).order_by(World.id)):
+                by_name.setdefault(world_name, world_pk)
+
+        world_map = {}
+        missing_worlds = []
+        for row in snapshot_worlds:
+            world_pk = by_world_id.get(row['world_id']) if row['world_id'] else None
+            world_pk = world_pk or by_name.get(row['world_name'])
+            if world_pk:
+                world_map[row['id']] = world_pk
+            else:
+                missing_worlds.append(row)
+        if missing_worlds:
+            new_ids = connection.execute(
+                insert(World.__table__).returning(
+                    World.__table__.c.id, sort_by_parameter_order=True),
+                [{'world_name': row['world_name'], 'world_id': row['world_id'],
+                  'tags': row['tags']} for row in missing_worlds]
+            ).scalars().all()
+            world_map.update(zip((row['id'] for row in missing_worlds), new_ids))
+        counts['worlds_created'] = len(missing_worlds)
+
+        # 3. 事件：只恢复快照所有者创建的事件。（世界、开始时间、好友名）相同的事件
+        #    已存在时不再插入，其参与者、标签和评论合并到已有事件
+        event_table = SharedEvent.__table__
+        time_range = source.execute(
+            'SELECT MIN(start_time), MAX(start_time) FROM shared_event WHERE user_id = ?',
+            (owner_id,)).fetchone()
+        existing_events = {}
+        if time_range[0]:
+            existing_events = {
+                (world_id, start_time, friend_name): event_id
+                for event_id, world_id, start_time, friend_name in connection.execute(
+                    select(event_table.c.id, event_table.c.world_id,
+                           event_table.c.start_time, event_table.c.friend_name).where(
+                        event_table.c.user_id == user.id,
+                        event_table.c.start_time.between(
+                            datetime.fromisoformat(time_range[0]),
+                            datetime.fromisoformat(time_range[1]))))}
+
+        event_map = {}
+        new_event_ids = []
+        copresence_seconds = {}
+        counts['events_skipped'] = 0
+        cursor = source.execute(
+            'SELECT * FROM shared_event WHERE user_id = ? ORDER BY id', (owner_id,))
+        for batch in _fetch_batches(cursor):
+            records = []
+            old_ids = []
+            for record in _snapshot_rows(event_table, batch):
+                old_id = record.pop('id')
+                record.update(user_id=user.id,
+                              world_id=world_map[record['world_id']],
+                              event_group_id=None,
+                              row_version=version)
+                key = (record['world_id'], record['start_time'], record['friend_name'])
+                if key in existing_events:
+                    event_map[old_id] = existing_events[key]
+                    counts['events_skipped'] += 1
+                else:
+                    existing_events[key] = None  # 快照内部的重复也只插入一次
+                    records.append(record)
+                    old_ids.append(old_id)
+            if not records:
+                continue
+            new_ids = connection.execute(
+                insert(event_table).returning(
+                    event_table.c.id, sort_by_parameter_order=True),
+                records
+            ).scalars().all()
+            for record, old_id, new_id in zip(records, old_ids, new_ids):
+                existing_events[(record['world_id'], record['start_time'],
+                                 record['friend_name'])] = new_id
+                event_map[old_id] = new_id
+            new_event_ids.extend(new_ids)
+
+            # 核心层插入不会触发ORM事件，手动更新区间索引和排行榜
+            index_event_intervals(connection, [
+                dict(record, id=new_id) for record, new_id in zip(records, new_ids)])
+            apply_leaderboard_changes(connection, [(
+                1, record['user_id'], record['world_id'], new_id, record['friend_name'],
+                record['start_time'], record['duration'], record.get('privacy')
+            ) for record, new_id in zip(records, new_ids)])
+
+            # 与转换相同：好友名是注册用户时加为参与者，并累加共同在场时长
+            registered = dict(connection.execute(
+                select(User.username, User.id).where(
+                    User.username.in_({record['friend_name'] for record in records}))).all())
+            friend_rows = []
+            for record, new_id in zip(records, new_ids):
+                friend_id = registered.get(record['friend_name'])
+                if friend_id and friend_id != user.id:
+                    friend_rows.append({'event_id': new_id, 'user_id': friend_id})
+                    copresence_seconds[friend_id] = \
+                        copresence_seconds.get(friend_id, 0) + (record['duration'] or 0)
+            if friend_rows:
+                connection.execute(
+                    insert(event_participants).prefix_with('OR IGNORE'), friend_rows)
+        # 被跳过的快照事件ID映射到了已有事件，这里只统计新插入的
+        counts['events'] = len(new_event_ids)
+
+        def restored_rows(sql):
+            for batch in _fetch_batches(source.execute(sql)):
+                yield [row for row in batch if row['event_id'] in event_map]
+
+        # 4. 参与者（只恢复快照所有者本人）
+        counts['participants'] = 0
+        for batch in restored_rows('SELECT * FROM event_participants'):
+            records = [{
+                'event_id': event_map[row['event_id']],
+                'user_id': user_map[row['user_id']],
+                'joined_at': datetime.fromisoformat(row['joined_at'])
+                if row['joined_at'] else None
+            } for row in batch if row['user_id'] in user_map]
+            if records:
+                counts['participants'] += connection.execute(
+                    insert(event_participants).prefix_with('OR IGNORE'), records).rowcount
+
+        # 5. 标签
+        counts['tags'] = 0
+        for batch in restored_rows('SELECT * FROM event_tag'):
+            records = [{'event_id': event_map[row['event_id']],
+                        'tag_name': row['tag_name'],
+                        'row_version': version} for row in batch]
+            if records:
+                counts['tags'] += connection.execute(
+                    insert(EventTag.__table__).prefix_with('OR IGNORE'), records).rowcount
+
+        # 6. 评论（只恢复快照所有者本人的）：先插入并记录新ID，再批量恢复回复关系；
+        #    合并到已有事件时，（事件、时间、内容）相同的评论视为已存在
+        comment_table = EventComment.__table__
+        existing_comments = {}
+        merged_event_ids = set(event_map.values()) - set(new_event_ids)
+        for chunk in _chunked(merged_event_ids):
+            for comment_id, event_id, created_at, content in connection.execute(
+                    select(comment_table.c.id, comment_table.c.event_id,
+                           comment_table.c.created_at, comment_table.c.content).where(
+                        comment_table.c.event_id.in_(chunk),
+                        comment_table.c.user_id == user.id)):
+                existing_comments[(event_id, created_at, content)] = comment_id
+
+        comment_map = {}
+        comment_parents = {}
+        counts['comments'] = 0
+        for batch in restored_rows('SELECT * FROM event_comment ORDER BY id'):
+            batch = [row for row in batch if row['user_id'] in user_map]
+            if not batch:
+                continue
+            records = []
+            old_ids = []
+            for record in _snapshot_rows(comment_table, batch):
+                old_id = record.pop('id')
+                record.update(event_id=event_map[record['event_id']],
+                              user_id=user_map[record['user_id']],
+                              row_version=version)
+                existing_id = existing_comments.get(
+                    (record['event_id'], record['created_at'], record['content']))
+                if existing_id:
+                    comment_map[old_id] = existing_id
+                    continue
+                if record['parent_id']:
+                    comment_parents[old_id] = record['parent_id']
+                record['parent_id'] = None
+                records.append(record)
+                old_ids.append(old_id)
+            if not records:
+                continue
+            new_ids = connection.execute(
+                insert(comment_table).returning(
+                    comment_table.c.id, sort_by_parameter_order=True),
+                records
+            ).scalars().all()
+            comment_map.update(zip(old_ids, new_ids))
+            counts['comments'] += len(new_ids)
+        parent_links = [{'comment_id': comment_map[old_id],
+                         'new_parent_id': comment_map[old_parent_id]}
+                        for old_id, old_parent_id in comment_parents.items()
+                        if old_parent_id in comment_map]
+        if parent_links:
+            connection.execute(
+                update(comment_table).where(
+                    comment_table.c.id == bindparam('comment_id')
+                ).values(parent_id=bindparam('new_parent_id')),
+                parent_links
+            )
+
+        # 7. 游戏日志（按哈希去重），同时累积唯一玩家/世界草图
+        log_table = GameLog.__table__
+        counts['game_logs'] = 0
+        hasher = GameLogHasher(user.id)
+        sketches = UniqueSketchAccumulator(user.id, user.username)
+        last_log_time = None
+        cursor = source.execute(
+            'SELECT * FROM game_log WHERE user_id = ? ORDER BY id', (owner_id,))
+        for batch in _fetch_batches(cursor):
+            records = list(_snapshot_rows(log_table, batch))
+            for record in records:
+                record.pop('id')
+                record.update(user_id=user.id,
+                              shared_event_id=event_map.get(record['shared_event_id']))
+                record['event_hash'] = hasher(
+                    record['timestamp'], record['event_type'],
+                    record['player_name'], record['world_name'], record['world_id'])
+                # 草图的合并是幂等的，重复导入不会改变计数
+                sketches.add(record['timestamp'], record['event_type'],
+                             record['world_name'], record['world_id'],
+                             record['player_name'])
+                last_log_time = max(filter(None, (last_log_time, record['timestamp'])))
+            counts['game_logs'] += connection.execute(
+                insert(log_table).prefix_with('OR IGNORE'), records).rowcount
+        sketches.flush()
+
+        # 8. 与转换相同：为新事件匹配事件组，增量更新共同在场社交图
+        group_events(new_event_ids)
+        apply_copresence_change(connection, user.id, copresence_seconds)
+
+        # 9. 快照中的日志已经对应快照中的事件：推进水位线，下次转换不再重放它们
+        state = GameLogConversionState.query.filter_by(user_id=user.id).one()
+        max_log_id = db.session.query(db.func.max(GameLog.id)).filter(
+            GameLog.user_id == user.id).scalar()
+        state.last_log_id = max(state.last_log_id, max_log_id or 0)
+        state.last_timestamp = max(
+            filter(None, (state.last_timestamp, last_log_time)), default=None)
+
+        return counts
+    finally:
+        source.close()
+
+
+@app.route('/api/events/export/sqlite')
+@login_required
+def export_account_snapshot():
+    """导出当前用户的账户快照（独立的SQLite文件）"""
+    import os
+    import tempfile
+    from flask import Response
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite', dir=get_export_dir())
+    os.close(fd)
+    os.remove(path)  # 由sqlite3重新创建空文件
+
+    try:
+        write_account_snapshot(current_user.id, path)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        print(f"快照导出错误: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    def stream_snapshot():
+        # 文件发送完毕（或客户端断开）后删除临时文件
+        try:
+            with open(path, 'rb') as snapshot:
+                for chunk in iter(lambda: snapshot.read(64 * 1024), b''):
+                    yield chunk
+        finally:
+            os.remove(path)
+
+    filename = f'account_snapshot_{datetime.now().strftime("%Y%m%d_%H%M%S")}.sqlite'
+    return Response(
+        stream_snapshot(),
+        mimetype='application/vnd.sqlite3',
+        headers={
+            'Content-Disposition': f'attachment; filename={filename}',
+            'Content-Length': str(os.path.getsize(path))
+        }
+    )
+
+
+@app.route('/api/events/import/sqlite', methods=['POST'])
+@login_required
+def import_account_snapshot_route():
+    """从账户快照文件恢复数据"""
+    import os
+    import tempfile
+
+    snapshot_file = request.files.get('snapshot')
+    if not snapshot_file:
+        return jsonify({'success': False, 'error': '没有提供快照文件'}), 400
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite', dir=get_export_dir())
+    os.close(fd)
+    snapshot_file.save(path)
+
+    with open(path, 'rb') as saved:
+        if saved.read(16) != b'SQLite format 3\x00':
+            os.remove(path)
+            return jsonify({'success': False, 'error': '不是有效的账户快照文件'}), 400
+
+    def import_snapshot_operation():
+        return import_account_snapshot(path, current_user)
+
+    def success_response(counts):
+        return jsonify({'success': True, 'imported': counts})
+
+    try:
+        return handle_api_db_operation(
+            operation_func=import_snapshot_operation,
+            success_response_func=success_response
+        )
+    finally:
+        os.remove(path)
+
+
+# ------------------------------
+# 增量同步（行版本与删除记录）
+# ------------------------------
+
+# 增量同步每页最多返回的变化行数（同一版本号的行总在同一页，可能略多于该值）
+SYNC_DELTA_LIMIT = 1000
+SYNC_DELTA_MAX_LIMIT = 5000
+
+# 删除记录的保留时间：since早于已清理的删除记录时，客户端需要全量重新同步
+SYNC_TOMBSTONE_RETENTION = timedelta(days=30)
+SYNC_TOMBSTONE_PRUNE_INTERVAL = timedelta(hours=1)
+
+sync_maintenance_queue = BackgroundTaskQueue('sync-maintenance')
+_last_tombstone_prune = None
+
+
+class RowVersionCounter(db.Model):
+    """全局行版本计数器（单行表）"""
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    pruned_version = db.Column(db.Integer, default=0)  # 已清理的删除记录的最大版本号
+
+
+class SyncTombstone(db.Model):
+    """删除记录：被删除的事件、标签和评论，供增量同步返回删除的行"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)  # 能看到该行的用户
+    table_name = db.Column(db.String(50), nullable=False)
+    row_key = db.Column(db.String(100), nullable=False)  # 主键，复合主键用冒号连接
+    event_id = db.Column(db.Integer)  # 所属事件
+    row_version = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.now, index=True)
+
+    __table_args__ = (
+        db.Index('ix_sync_tombstone_user_version', 'user_id', 'row_version'),
+    )
+
+
+def next_row_version(connection):
+    """分配下一个行版本号
+
+    计数器的更新与行的写入在同一个事务中，SQLite同一时间只有一个写事务，
+    因此读取到版本号V的读者一定能看到所有版本号不大于V的已提交行。
+    """
+    from sqlalchemy import update, insert
+
+    table = RowVersionCounter.__table__
+    version = connection.execute(
+        update(table).where(table.c.id == 1).values(
+            value=table.c.value + 1).returning(table.c.value)
+    ).scalar()
+    if version is None:
+        connection.execute(insert(table).values(id=1, value=1))
+        version = 1
+    return version
+
+
+def current_row_version():
+    """当前已分配的最大行版本号"""
+    counter = db.session.get(RowVersionCounter, 1)
+    return counter.value if counter else 0
+
+
+def event_audience(connection, event_id):
+    """能看到某个事件的用户：事件创建者和所有参与者"""
+    from sqlalchemy import select
+
+    owner_id = connection.execute(
+        select(SharedEvent.user_id).where(SharedEvent.id == event_id)).scalar()
+    participant_ids = connection.execute(
+        select(event_participants.c.user_id).where(
+            event_participants.c.event_id == event_id)).scalars().all()
+    audience = set(participant_ids)
+    if owner_id is not None:
+        audience.add(owner_id)
+    return audience
+
+
+def record_tombstones(connection, audience, table_name, row_key, event_id):
+    """为每个能看到该行的用户写入删除记录"""
+    from sqlalchemy import insert
+
+    if not audience:
+        return
+    version = next_row_version(connection)
+    connection.execute(insert(SyncTombstone.__table__), [{
+        'user_id': user_id,
+        'table_name': table_name,
+        'row_key': row_key,
+        'event_id': event_id,
+        'row_version': version,
+        'deleted_at': datetime.now()
+    } for user_id in audience])
+
+
+def assign_row_version(mapper, connection, target):
+    """插入或更新时分配新的行版本号"""
+    target.row_version = next_row_version(connection)
+
+
+for _model in (SharedEvent, EventTag, EventComment):
+    db.event.listen(_model, 'before_insert', assign_row_version)
+    db.event.listen(_model, 'before_update', assign_row_version)
+
+
+def bump_event_row_version(connection, event_id):
+    """事件的标签变化时，同时提升事件本身的行版本号"""
+    from sqlalchemy import update
+
+    connection.execute(
+        update(SharedEvent.__table__).where(
+            SharedEvent.__table__.c.id == event_id
+        ).values(row_version=next_row_version(connection))
+    )
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def sync_before_flush(session, flush_context, instances):
+    """删除事件前记录其可见用户（删除时参与者关联会先被删除）"""
+    audiences = session.info.setdefault('deleted_event_audience', {})
+    for obj in session.deleted:
+        if isinstance(obj, SharedEvent):
+            audiences[obj.id] = event_audience(session.connection(), obj.id)
+
+
+@db.event.listens_for(SharedEvent.participants, 'append')
+@db.event.listens_for(SharedEvent.participants, 'remove')
+def sync_after_participant_change(target, value, initiator):
+    """记录已有事件的参与者变化，刷新后再处理（新事件插入时已分配行版本号）"""
+    from sqlalchemy.orm import object_session
+    if target.id is None:
+        return
+    session = object_session(target) or db.session
+    session.info.setdefault('changed_event_participants', []).append((target, value))
+
+
+@db.event.listens_for(db.session, 'after_flush_postexec')
+def sync_after_flush(session, flush_context):
+    """参与者变化后提升事件的行版本号（新参与者能同步到该事件），
+    被移除且不再能看到事件的用户写入删除记录"""
+    changes = session.info.pop('changed_event_participants', None)
+    if not changes:
+        return
+    connection = session.connection()
+    changed = {}
+    for event, user in changes:
+        changed.setdefault(event.id, set()).add(user.id)
+    for event_id, user_ids in changed.items():
+        audience = event_audience(connection, event_id)
+        if not audience:
+            continue  # 事件已被删除，删除记录由sync_after_event_delete写入
+        record_tombstones(connection, user_ids - audience, 'shared_event',
+                          str(event_id), event_id)
+        bump_event_row_version(connection, event_id)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+@db.event.listens_for(db.session, 'after_rollback')
+def sync_after_transaction(session):
+    session.info.pop('deleted_event_audience', None)
+    session.info.pop('changed_event_participants', None)
+
+
+@db.event.listens_for(EventTag, 'after_insert')
+def sync_after_tag_insert(mapper, connection, target):
+    bump_event_row_version(connection, target.event_id)
+
+
+@db.event.listens_for(SharedEvent, 'after_delete')
+def sync_after_event_delete(mapper, connection, target):
+    from sqlalchemy.orm import object_session
+    audiences = object_session(target).info.get('deleted_event_audience', {})
+    audience = audiences.get(target.id) or {target.user_id}
+    record_tombstones(connection, audience, 'shared_event',
+                      str(target.id), target.id)
+
+
+@db.event.listens_for(EventTag, 'after_delete')
+def sync_after_tag_delete(mapper, connection, target):
+    record_tombstones(connection, event_audience(connection, target.event_id),
+                      'event_tag', f'{target.event_id}:{target.tag_name}',
+                      target.event_id)
+    bump_event_row_version(connection, target.event_id)
+
+
+@db.event.listens_for(EventComment, 'after_delete')
+def sync_after_comment_delete(mapper, connection, target):
+    record_tombstones(connection, event_audience(connection, target.event_id),
+                      'event_comment', str(target.id), target.event_id)
+
+
+def prune_sync_tombstones():
+    """删除超过保留时间的删除记录，并记录已清理到的版本号，返回删除的行数"""
+    from sqlalchemy import select, delete, func
+
+    table = SyncTombstone.__table__
+    pruned_version = db.session.execute(select(func.max(table.c.row_version)).where(
+        table.c.deleted_at < datetime.now() - SYNC_TOMBSTONE_RETENTION)).scalar()
+    if pruned_version is None:
+        return 0
+    deleted = db.session.execute(
+        delete(table).where(table.c.row_version <= pruned_version)).rowcount
+    counter = db.session.get(RowVersionCounter, 1)
+    counter.pruned_version = max(counter.pruned_version or 0, pruned_version)
+    db.session.commit()
+    return deleted
+
+
+def schedule_tombstone_prune():
+    """距离上次清理超过间隔时，提交一次后台清理"""
+    global _last_tombstone_prune
+    now = datetime.now()
+    if _last_tombstone_prune and now - _last_tombstone_prune < SYNC_TOMBSTONE_PRUNE_INTERVAL:
+        return
+    _last_tombstone_prune = now
+    sync_maintenance_queue.submit(prune_sync_tombstones)
+
+
+@app.route('/api/sync/delta')
+@login_required
+def get_sync_delta():
+    """增量同步：返回行版本号大于since的事件、标签、评论和删除记录
+
+    客户端保存返回的current_version，下次作为since传入。since为0或不传时返回全部数据。
+    每页最多返回limit行变化，has_more为真时继续用current_version请求下一页。
+    since早于已清理的删除记录时返回reset=True和全部数据，客户端应丢弃本地数据。
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = min(max(request.args.get('limit', SYNC_DELTA_LIMIT, type=int), 1),
+                SYNC_DELTA_MAX_LIMIT)
+
+    def get_sync_delta_operation():
+        from sqlalchemy.orm import joinedload, selectinload
+
+        # 先读取当前版本号，再查询变化的行（见next_row_version的说明）
+        counter = db.session.get(RowVersionCounter, 1)
+        current_version = counter.value if counter else 0
+        reset = bool(since) and since < ((counter.pruned_version or 0) if counter else 0)
+        start = 0 if reset else since
+
+        visible_events = (
+            (SharedEvent.user_id == current_user.id) |
+            (SharedEvent.participants.any(User.id == current_user.id))
+        )
+        # 标签和评论按自身的行版本号查询，再逐行检查所属事件是否可见
+        streams = {
+            'events': (SharedEvent.row_version, SharedEvent.query.options(
+                joinedload(SharedEvent.world),
+                selectinload(SharedEvent.custom_tags)
+            ).filter(visible_events)),
+            'tags': (EventTag.row_version, EventTag.query.join(
+                SharedEvent, SharedEvent.id == EventTag.event_id).filter(visible_events)),
+            'comments': (EventComment.row_version, EventComment.query.join(
+                SharedEvent, SharedEvent.id == EventComment.event_id).filter(visible_events)),
+            'deleted': (SyncTombstone.row_version, SyncTombstone.query.filter(
+                SyncTombstone.user_id == current_user.id)),
+        }
+
+        # 合并各类变化的版本号，取第limit行的版本号作为本页的上界
+        versions = sorted(
+            version
+            for column, query in streams.values()
+            for (version,) in query.filter(column > start, column <= current_version)
+            .with_entities(column).order_by(column).limit(limit + 1))
+        has_more = len(versions) > limit
+        until = versions[limit - 1] if has_more else current_version
+
+        def changed(name):
+            column, query = streams[name]
+            return query.filter(column > start, column <= until).order_by(column)
+
+        events = []
+        for event in changed('events'):
+            record = serialize_export_event(event)
+            record['row_version'] = event.row_version
+            events.append(record)
+
+        return {
+            'since': since,
+            'current_version': until,
+            'has_more': has_more,
+            'reset': reset,
+            'events': events,
+            'tags': [{
+                'event_id': tag.event_id,
+                'tag_name': tag.tag_name,
+                'row_version': tag.row_version
+            } for tag in changed('tags')],
+            'comments': [{
+                'id': comment.id,
+                'event_id': comment.event_id,
+                'user_id': comment.user_id,
+                'content': comment.content,
+                'parent_id': comment.parent_id,
+                'created_at': comment.created_at.isoformat(),
+                'row_version': comment.row_version
+            } for comment in changed('comments')],
+            'deleted': [{
+                'table': tombstone.table_name,
+                'key': tombstone.row_key,
+                'event_id': tombstone.event_id,
+                'row_version': tombstone.row_version
+            } for tombstone in changed('deleted')]
+        }
+
+    def success_response(result):
+        schedule_tombstone_prune()
+        return jsonify({'success': True, 'data': result})
+
+    return handle_api_db_operation(
+        operation_func=get_sync_delta_operation,
+        success_response_func=success_response
+    )
+
+
+# ------------------------------
+# 时间区间索引（SQLite R*Tree）
+# ------------------------------
+
+# R*Tree虚拟表：每个事件一行，两个维度分别是时间区间（秒）和世界ID。
+# R*Tree内部用32位浮点存储坐标，写入时向外取整，所以它只用于筛选候选，
+# 最终结果总是再用shared_event上的精确条件过滤一遍。
+EVENT_INTERVAL_INDEX = 'event_interval_index'
+
+event_interval_index = db.table(
+    EVENT_INTERVAL_INDEX,
+    db.column('id'), db.column('start_min'), db.column('end_max'),
+    db.column('world_min'), db.column('world_max')
+)
+
+# 区间坐标的起点
+INTERVAL_EPOCH = datetime(1970, 1, 1)
+
+# 缓存索引表是否存在（不支持R*Tree的SQLite上会退化为普通查询）
+_interval_index_available = None
+
+
+def interval_seconds(value):
+    """将时间转换为区间索引使用的秒数"""
+    return (value - INTERVAL_EPOCH).total_seconds()
+
+
+def create_interval_index(connection):
+    """创建区间索引虚拟表（已有事件的旧数据库由rebuild_interval_index回填）"""
+    from sqlalchemy import text
+
+    global _interval_index_available
+    try:
+        connection.execute(text(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {EVENT_INTERVAL_INDEX} '
+            f'USING rtree(id, start_min, end_max, world_min, world_max)'))
+    except Exception as e:
+        print(f"区间索引不可用，将使用普通查询: {e}")
+        _interval_index_available = False
+        return
+    _interval_index_available = True
+
+
+def rebuild_interval_index():
+    """根据现有事件重建区间索引（用于已有数据的数据库）"""
+    from sqlalchemy import text
+
+    connection = db.session.connection()
+    connection.execute(text(f'DELETE FROM {EVENT_INTERVAL_INDEX}'))
+    rows = connection.execute(text(
+        'SELECT id, start_time, end_time, world_id FROM shared_event'))
+    index_event_intervals(connection, [{
+        'id': row.id,
+        'start_time': datetime.fromisoformat(row.start_time),
+        'end_time': datetime.fromisoformat(row.end_time) if row.end_time else None,
+        'world_id': row.world_id
+    } for row in rows])
+    db.session.commit()
+
+
+def interval_index_available(connection):
+    """区间索引表是否可用"""
+    from sqlalchemy import text
+
+    global _interval_index_available
+    if _interval_index_available is None:
+        _interval_index_available = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = :name"),
+            {'name': EVENT_INTERVAL_INDEX}).first() is not None
+    return _interval_index_available
+
+
+def index_event_intervals(connection, events):
+    """写入或替换事件的区间索引行
+
+    Args:
+        events: 包含id、start_time、end_time、world_id的字典列表
+    """
+    from sqlalchemy import text
+
+    if not events or not interval_index_available(connection):
+        return
+    connection.execute(text(
+        f'INSERT OR REPLACE INTO {EVENT_INTERVAL_INDEX} '
+        f'(id, start_min, end_max, world_min, world_max) '
+        f'VALUES (:id, :start_min, :end_max, :world_id, :world_id)'),
+        [{
+            'id': event['id'],
+            'start_min': interval_seconds(event['start_time']),
+            # 未结束的事件按时间点处理
+            'end_max': interval_seconds(event['end_time'] or event['start_time']),
+            'world_id': event['world_id']
+        } for event in events])
+
+
+def overlapping_event_ids(start, end, world_id=None):
+    """返回与[start, end]重叠的事件ID子查询（R*Tree筛选，O(log n + k)）
+
+    结果是候选集合，调用方需要配合overlaps_filter做精确过滤。
+    """
+    from sqlalchemy import select
+
+    index = event_interval_index.c
+    query = select(index.id).where(
+        index.start_min <= interval_seconds(end),
+        index.end_max >= interval_seconds(start))
+    if world_id is not None:
+        query = query.where(index.world_min <= world_id, index.world_max >= world_id)
+    return query
+
+
+def overlaps_filter(start, end, world_id=None):
+    """事件与[start, end]重叠的精确过滤条件，索引可用时先用索引筛选候选"""
+    from sqlalchemy import and_
+
+    conditions = [
+        SharedEvent.start_time <= end,
+        db.func.coalesce(SharedEvent.end_time, SharedEvent.start_time) >= start
+    ]
+    if world_id is not None:
+        conditions.append(SharedEvent.world_id == world_id)
+    if interval_index_available(db.session.connection()):
+        conditions.append(
+            SharedEvent.id.in_(overlapping_event_ids(start, end, world_id)))
+    return and_(*conditions)
+
+
+@db.event.listens_for(SharedEvent, 'after_insert')
+def interval_index_after_event_insert(mapper, connection, target):
+    """新事件写入区间索引"""
+    index_event_intervals(connection, [{
+        'id': target.id, 'start_time': target.start_time,
+        'end_time': target.end_time, 'world_id': target.world_id}])
+
+
+@db.event.listens_for(SharedEvent, 'after_update')
+def interval_index_after_event_update(mapper, connection, target):
+    """事件时间或世界变化时更新区间索引"""
+    state = db.inspect(target)
+    if not any(state.attrs[name].history.has_changes()
+               for name in ('start_time', 'end_time', 'world_id')):
+        return
+    interval_index_after_event_insert(mapper, connection, target)
+
+
+@db.event.listens_for(SharedEvent, 'after_delete')
+def interval_index_after_event_delete(mapper, connection, target):
+    """事件删除时移除区间索引行"""
+    from sqlalchemy import delete
+
+    if interval_index_available(connection):
+        connection.execute(delete(event_interval_index).where(
+            event_interval_index.c.id == target.id))
+
+
+@app.route('/api/events/overlap')
+@login_required
+def get_overlapping_events():
+    """查询与时间范围[from, to]重叠的可见事件，可选按世界过滤"""
+    try:
+        range_start = datetime.fromisoformat(request.args['from'])
+        range_end = datetime.fromisoformat(request.args['to'])
+        world_id = request.args.get('world_id', type=int)
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'error': '需要有效的from和to参数'}), 400
+
+    def overlap_operation():
+        events = SharedEvent.query.options(
+            db.joinedload(SharedEvent.world)
+        ).filter(
+            overlaps_filter(range_start, range_end, world_id),
+            (SharedEvent.user_id == current_user.id) |
+            SharedEvent.participants.any(User.id == current_user.id)
+        ).order_by(SharedEvent.start_time).all()
+        return [serialize_export_event(event) for event in events]
+
+    def success_response(result):
+        return jsonify({'success': True, 'data': result})
+
+    return handle_api_db_operation(
+        operation_func=overlap_operation,
+        success_response_func=success_response
+    )
+
+
+@app.route('/api/events/at')
+@login_required
+def get_companions_at():
+    """查询某一时刻和我在一起的好友（覆盖该时刻的可见事件）"""
+    try:
+        moment = datetime.fromisoformat(request.args['time'])
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'error': '需要有效的time参数'}), 400
+
+    def companions_operation():
+        events = SharedEvent.query.options(
+            db.joinedload(SharedEvent.world)
+        ).filter(
+            overlaps_filter(moment, moment),
+            (SharedEvent.user_id == current_user.id) |
+            SharedEvent.participants.any(User.id == current_user.id)
+        ).order_by(SharedEvent.start_time).all()
+        return {
+            'time': moment.isoformat(),
+            'companions': sorted({event.friend_name.strip() for event in events}),
+            'events': [serialize_export_event(event) for event in events]
+        }
+
+    def success_response(result):
+        return jsonify({'success': True, 'data': result})
+
+    return handle_api_db_operation(
+        operation_func=companions_operation,
+        success_response_func=success_response
+    )
+
+
+# ------------------------------
+# 共同在场社交图
+# ------------------------------
+
+# 社交图接口默认返回的邻居和推荐数量
+COPRESENCE_DEFAULT_LIMIT = 10
+
+
+class CoPresenceEdge(db.Model):
+    """共同在场边：user_id的事件记录中与neighbor_id共同在场的总秒数
+
+    边是有向的（按事件所有者记录），两个人都转换了日志时各自记录一次，
+    查询时取两个方向的较大值作为共同在场时长，避免重复计算。
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    shared_seconds = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'neighbor_id', name='uq_copresence_edge'),
+        db.Index('ix_copresence_neighbor', 'neighbor_id', 'user_id'),
+    )
+
+
+def copresence_matrix_available():
+    """检查可选依赖scipy是否已安装（批量重算使用稀疏矩阵）"""
+    try:
+        import scipy.sparse  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def apply_copresence_change(connection, user_id, seconds_by_neighbor):
+    """累加user_id与各个邻居的共同在场秒数（转换日志时增量调用）"""
+    from sqlalchemy.dialects.sqlite import insert
+
+    rows = [{'user_id': user_id, 'neighbor_id': neighbor_id,
+             'shared_seconds': seconds, 'updated_at': datetime.now()}
+            for neighbor_id, seconds in seconds_by_neighbor.items()
+            if neighbor_id != user_id and seconds > 0]
+    if not rows:
+        return
+    statement = insert(CoPresenceEdge.__table__)
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=['user_id', 'neighbor_id'],
+        set_={
+            'shared_seconds': CoPresenceEdge.__table__.c.shared_seconds +
+            statement.excluded.shared_seconds,
+            'updated_at': statement.excluded.updated_at
+        }
+    ), rows)
+
+
+def rebuild_copresence_graph():
+    """根据全部事件的参与者批量重算共同在场图
+
+    (事件所有者, 参与者, 时长)三元组组成COO稀疏矩阵，转换为CSR时自动合并
+    重复的坐标；没有安装scipy时用字典累加，结果相同。
+    """
+    from sqlalchemy import insert, text
+
+    connection = db.session.connection()
+    triples = connection.execute(text(
+        'SELECT e.user_id, p.user_id, e.duration FROM shared_event AS e '
+        'JOIN event_participants AS p ON p.event_id = e.id '
+        'WHERE p.user_id != e.user_id AND e.duration > 0')).all()
+
+    if copresence_matrix_available() and triples:
+        import numpy as np
+        from scipy.sparse import coo_matrix
+
+        user_ids, positions = np.unique(
+            np.array([[owner, other] for owner, other, _ in triples]),
+            return_inverse=True)
+        positions = positions.reshape(-1, 2)
+        matrix = coo_matrix(
+            (np.array([seconds for _, _, seconds in triples], dtype=np.int64),
+             (positions[:, 0], positions[:, 1])),
+            shape=(len(user_ids), len(user_ids))
+        ).tocsr().tocoo()
+        edges = zip(user_ids[matrix.row].tolist(), user_ids[matrix.col].tolist(),
+                    matrix.data.tolist())
+    else:
+        totals = {}
+        for owner, other, seconds in triples:
+            totals[(owner, other)] = totals.get((owner, other), 0) + seconds
+        edges = ((owner, other, seconds) for (owner, other), seconds in totals.items())
+
+    now = datetime.now()
+    CoPresenceEdge.query.delete()
+    rows = [{'user_id': owner, 'neighbor_id': other, 'shared_seconds': seconds,
+             'updated_at': now} for owner, other, seconds in edges]
+    if rows:
+        connection.execute(insert(CoPresenceEdge.__table__), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def copresence_weights(user_ids):
+    """读取与给定用户相连的所有边，返回对称权重 {(a, b): 秒数}（a < b）"""
+    from sqlalchemy import or_
+
+    weights = {}
+    edges = db.session.query(
+        CoPresenceEdge.user_id, CoPresenceEdge.neighbor_id,
+        CoPresenceEdge.shared_seconds
+    ).filter(or_(CoPresenceEdge.user_id.in_(user_ids),
+                 CoPresenceEdge.neighbor_id.in_(user_ids)))
+    for owner, other, seconds in edges:
+        pair = (min(owner, other), max(owner, other))
+        weights[pair] = max(weights.get(pair, 0), seconds)
+    return weights
+
+
+@app.route('/api/social/copresence')
+@login_required
+def get_copresence_neighbors():
+    """返回共同在场时间最长的邻居和二度人脉推荐（只读取社交图表）"""
+    limit = max(1, min(request.args.get(
+        'limit', COPRESENCE_DEFAULT_LIMIT, type=int), 100))
+
+    def copresence_operation():
+        user_id = current_user.id
+
+        # 1. 一度邻居
+        neighbors = {}
+        for (a, b), seconds in copresence_weights([user_id]).items():
+            neighbors[b if a == user_id else a] = seconds
+
+        # 2. 二度人脉：通过共同邻居连接、但本人没有直接共同在场的用户，
+        # 分数为经过每个共同邻居的两段时长中较短者之和
+        suggestions = {}
+        if neighbors:
+            for (a, b), seconds in copresence_weights(list(neighbors)).items():
+                for via, candidate in ((a, b), (b, a)):
+                    if via in neighbors and candidate != user_id \
+                            and candidate not in neighbors:
+                        entry = suggestions.setdefault(
+                            candidate, {'score': 0, 'via': set()})
+                        entry['score'] += min(neighbors[via], seconds)
+                        entry['via'].add(via)
+
+        top_neighbors = sorted(
+            neighbors.items(), key=lambda item: item[1], reverse=True)[:limit]
+        top_suggestions = sorted(
+            suggestions.items(), key=lambda item: item[1]['score'], reverse=True)[:limit]
+
+        referenced = {user for user, _ in top_neighbors} | \
+            {user for user, _ in top_suggestions}
+        for _, entry in top_suggestions:
+            referenced |= entry['via']
+        usernames = dict(db.session.query(User.id, User.username).filter(
+            User.id.in_(referenced)).all()) if referenced else {}
+
+        return {
+            'neighbors': [{
+                'user_id': neighbor_id,
+                'username': usernames.get(neighbor_id),
+                'shared_minutes': seconds // 60
+            } for neighbor_id, seconds in top_neighbors],
+            'suggestions': [{
+                'user_id': candidate_id,
+                'username': usernames.get(candidate_id),
+                'score_minutes': entry['score'] // 60,
+                'mutual_neighbors': sorted(usernames.get(via) for via in entry['via'])
+            } for candidate_id, entry in top_suggestions]
+        }
+
+    def success_response(result):
+        return jsonify({'success': True, 'data': result})
+
+    return handle_api_db_operation(
+        operation_func=copresence_operation,
+        success_response_func=success_response
+    )
+
+
+# ------------------------------
+# 高级可视化路由
+# ------------------------------
+
+# 时间线默认和最大的数据点数量（原始事件数或时间桶数）
+TIMELINE_DEFAULT_RESOLUTION = 200
+TIMELINE_MAX_RESOLUTION = 1000
+
+
+@app.route('/api/visualization/timeline')
+@login_required
+@compressed_response
+def get_timeline_data():
+    """获取时间线可视化数据
+
+    查询参数from/to（ISO格式）限定时间范围，resolution限定返回的数据点数量。
+    范围内的事件数不超过resolution时返回原始事件，否则按时间桶聚合返回
+    每个桶的事件数、总时长和主要世界，返回的数据量与历史总量无关。
+    """
+    import math
+    from sqlalchemy import func, Integer
+
+    try:
+        range_start = request.args.get('from')
+        range_end = request.args.get('to')
+        range_start = datetime.fromisoformat(range_start) if range_start else None
+        range_end = datetime.fromisoformat(range_end) if range_end else None
+        resolution = int(request.args.get('resolution', TIMELINE_DEFAULT_RESOLUTION))
+    except ValueError:
+        return jsonify({'success': False, 'error': '无效的时间范围或分辨率'}), 400
+    resolution = max(1, min(resolution, TIMELINE_MAX_RESOLUTION))
+
+    def get_timeline_data_operation():
+        visible = (SharedEvent.user_id == current_user.id) | \
+            SharedEvent.participants.any(User.id == current_user.id)
+
+        # 未指定范围时使用全部事件的时间跨度
+        start, end = range_start, range_end
+        if start is None or end is None:
+            first, last = db.session.query(
+                func.min(SharedEvent.start_time), func.max(SharedEvent.start_time)
+            ).filter(visible).one()
+            start = start or first
+            end = end or last
+
+        result = {
+            'from': start.isoformat() if start else None,
+            'to': end.isoformat() if end else None,
+            'resolution': resolution,
+            'mode': 'events',
+            'bucket_seconds': None,
+            'total': 0,
+            'items': []
+        }
+        if start is None or end is None or start > end:
+            return result
+
+        in_range = (SharedEvent.start_time >= start) & (SharedEvent.start_time <= end)
+        total = db.session.query(func.count(SharedEvent.id)).filter(
+            visible, in_range).scalar()
+        result['total'] = total
+
+        # 放大到事件数不超过分辨率时返回原始事件
+        if total <= resolution:
+            events = SharedEvent.query.options(
+                db.joinedload(SharedEvent.world)
+            ).filter(visible, in_range).order_by(SharedEvent.start_time).all()
+            result['items'] = [{
+                'id': event.id,
+                'title': f"与 {event.friend_name.strip()} 在 {event.world.world_name}",
+                'start': event.start_time.isoformat(),
+                'end': event.end_time.isoformat() if event.end_time else None,
+                'duration': event.duration,
+                'world': event.world.world_name,
+                'friend': event.friend_name
+            } for event in events]
+            return result
+
+        # 否则在数据库中按时间桶和世界聚合
+        span = max((end - start).total_seconds(), 1)
+        bucket_seconds = max(1, math.ceil(span / resolution))
+        bucket = db.cast(
+            (func.julianday(SharedEvent.start_time) - func.julianday(start))
+            * 86400 / bucket_seconds, Integer)
+        rows = db.session.query(
+            bucket, SharedEvent.world_id,
+            func.count(SharedEvent.id), func.sum(func.coalesce(SharedEvent.duration, 0))
+        ).filter(visible, in_range).group_by(bucket, SharedEvent.world_id).all()
+
+        buckets = {}
+        for index, world_id, count, duration in rows:
+            # 范围终点恰好落在最后一个桶的边界上
+            index = min(index, resolution - 1)
+            entry = buckets.setdefault(index, {'count': 0, 'duration': 0, 'worlds': {}})
+            entry['count'] += count
+            entry['duration'] += duration
+            entry['worlds'][world_id] = entry['worlds'].get(world_id, 0) + duration
+
+        dominant = {index: max(entry['worlds'], key=entry['worlds'].get)
+                    for index, entry in buckets.items()}
+        world_names = dict(db.session.query(World.id, World.world_name).filter(
+            World.id.in_(set(dominant.values()))).all())
+
+        result['mode'] = 'buckets'
+        result['bucket_seconds'] = bucket_seconds
+        for index in sorted(buckets):
+            entry = buckets[index]
+            bucket_start = start + timedelta(seconds=index * bucket_seconds)
+            result['items'].append({
+                'start': bucket_start.isoformat(),
+                'end': (bucket_start + timedelta(seconds=bucket_seconds)).isoformat(),
+                'count': entry['count'],
+                'duration': entry['duration'],
+                'world': world_names.get(dominant[index])
+            })
+        return result
+
+    def success_response(result):
+        return jsonify({'success': True, 'data': result})
+
+    return handle_api_db_operation(
+        operation_func=get_timeline_data_operation,
+        success_response_func=success_response
+    )
+
+
+
+
+
+@app.route('/api/events/connections')
+@login_required
+@compressed_response
+def get_event_connections():
+    """获取事件连接关系，识别共同事件的路由
+
+    format=compact时每个事件组只返回一次：成员事件ID列表和按成员下标表示的边，
+    事件详情在events中只出现一次。
+    """
+    compact = request.args.get('format') == 'compact'
+
+    def serialize_connection_event(event):
+        return {
+            'id': event.id,
+            'title': f"与 {event.friend_name.strip()} 在 {event.world.world_name}",
+            'start_time': event.start_time.isoformat(),
+            'end_time': event.end_time.isoformat() if event.end_time else None,
+            'user_id': event.user_id
+        }
+
+    def get_connections_operation():
+        # 1. 只加载属于事件组的可见事件，按组排序并预加载世界
+        user_events = SharedEvent.query.options(
+            db.joinedload(SharedEvent.world)
+        ).filter(
+            SharedEvent.event_group_id.isnot(None),
+            (SharedEvent.user_id == current_user.id) |
+            SharedEvent.participants.any(User.id == current_user.id)
+        ).order_by(SharedEvent.event_group_id, SharedEvent.id).all()
+
+        # 2. 按事件组分组事件
+        event_groups = {}
+        for event in user_events:
+            event_groups.setdefault(event.event_group_id, []).append(event)
+
+        # 3. 一次遍历构建每个组的连接
+        total_connections = 0
+        if compact:
+            groups = []
+            events = {}
+            for group_id, members in event_groups.items():
+                if len(members) < 2:
+                    continue
+                edges = [[i, j] for i in range(len(members))
+                         for j in range(i + 1, len(members))]
+                total_connections += len(edges)
+                for event in members:
+                    record = serialize_connection_event(event)
+                    record['sync_status'] = event.sync_status
+                    events[event.id] = record
+                groups.append({
+                    'group_id': group_id,
+                    'events': [event.id for event in members],
+                    'edges': edges,
+                    'sync_hash': members[0].sync_hash or 'no_sync_hash'
+                })
+            return {
+                'format': 'compact',
+                'groups': groups,
+                'events': events,
+                'total_groups': len(event_groups),
+                'total_connections': total_connections
+            }
+
+        connections = []
+        routes = []
+        for group_id, members in event_groups.items():
+            if len(members) < 2:
+                continue
+            serialized = [serialize_connection_event(event) for event in members]
+            group_connections = []
+            for i in range(len(members)):
+                for j in range(i + 1, len(members)):
+                    connections.append({
+                        'event1': serialized[i],
+                        'event2': serialized[j],
+                        'connection_type': 'shared_event_group',
+                        'group_id': group_id,
+                        'sync_hash': members[i].sync_hash or 'no_sync_hash'
+                    })
+                    group_connections.append({
+                        'event1_id': members[i].id,
+                        'event2_id': members[j].id
+                    })
+
+            routes.append({
+                'group_id': group_id,
+                'events': [dict(record, sync_status=event.sync_status)
+                           for record, event in zip(serialized, members)],
+                'connections': group_connections
+            })
+
+        return {
+            'connections': connections,
+            'routes': routes,
+            'total_groups': len(event_groups),
+            'total_connections': len(connections)
+        }
+    
+    def success_response(result):
+        return jsonify({'success': True, 'data': result})
+    
+    return handle_api_db_operation(
+        operation_func=get_connections_operation,
+        success_response_func=success_response
+    )
+
+
+# ------------------------------
+# 事件提醒路由
+# ------------------------------
+
+class EventReminder(db.Model):
+    """事件提醒模型"""
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(
+        db.Integer,
+        db.ForeignKey(
+            'shared_event.id',
             ondelete='CASCADE'),
         nullable=False)
     user_id = db.Column(
@@ -2203,80 +5165,276 @@ def update_notes(event_id):
         event.notes = cleaned_notes
         return '备注更新成功'
 
-    # 调用错误处理函数
-    return handle_db_operation(
-        operation_func=update_notes_operation,
-        success_redirect='event_detail',
-        success_message='备注更新成功！',
-        success_redirect_args={'event_id': event_id}
-    )
+    # 调用错误处理函数
+    return handle_db_operation(
+        operation_func=update_notes_operation,
+        success_redirect='event_detail',
+        success_message='备注更新成功！',
+        success_redirect_args={'event_id': event_id}
+    )
+
+
+# ------------------------------
+# 游戏日志导入和转换路由
+# ------------------------------
+
+def import_log_entries(logs_data, user, progress=None):
+    """写入JSON格式的游戏日志条目，返回写入统计"""
+    sketches = UniqueSketchAccumulator(user.id, user.username)
+    writer = GameLogBulkWriter(on_flush=progress.on_flush if progress else None)
+    for log_entry in logs_data:
+        # 解析日志条目
+        timestamp_str = log_entry.get('timestamp')
+        event_type = log_entry.get('event_type')
+        world_name = log_entry.get('world_name')
+        world_id = log_entry.get('world_id')
+        player_name = log_entry.get('player_name')
+        is_friend = log_entry.get('is_friend', False)
+        if progress:
+            progress.lines_parsed += 1
+
+        # 验证必填字段
+        if not all([timestamp_str, event_type, player_name]):
+            continue
+
+        # 转换时间字符串为datetime对象
+        try:
+            # 处理不同的时间格式
+            if ' ' in timestamp_str and '/' in timestamp_str:
+                # 格式：12/28 01:53
+                timestamp = datetime.strptime(timestamp_str, '%m/%d %H:%M')
+                # 设置当前年份
+                timestamp = timestamp.replace(year=datetime.now().year)
+            else:
+                # ISO格式或其他格式
+                timestamp = datetime.fromisoformat(timestamp_str)
+        except ValueError:
+            continue
+
+        # 创建游戏日志记录
+        writer.add({
+            'user_id': user.id,
+            'timestamp': timestamp,
+            'event_type': event_type,
+            'world_name': world_name,
+            'world_id': world_id,
+            'player_name': player_name,
+            'is_friend': bool(is_friend)
+        })
+        sketches.add(timestamp, event_type, world_name, world_id, player_name)
+
+    writer.flush()
 
+    # 更新去重统计草图
+    sketches.flush()
+
+    return writer.stats()
 
-# ------------------------------
-# 游戏日志导入和转换路由
-# ------------------------------
 
 @app.route('/api/gamelog/import', methods=['POST'])
 @login_required
 def import_game_logs():
-    """导入真实游戏日志数据"""
+    """导入真实游戏日志数据（后台执行），立即返回任务"""
     # 从请求中获取日志数据
     logs_data = request.get_json()
     if not logs_data:
         return jsonify({'success': False, 'error': '没有提供日志数据'}), 400
 
-    # 使用API错误处理包装的数据库操作
-    def import_logs_operation():
-        imported_count = 0
-        for log_entry in logs_data:
-            # 解析日志条目
-            timestamp_str = log_entry.get('timestamp')
-            event_type = log_entry.get('event_type')
-            world_name = log_entry.get('world_name')
-            world_id = log_entry.get('world_id')
-            player_name = log_entry.get('player_name')
-            is_friend = log_entry.get('is_friend', False)
-
-            # 验证必填字段
-            if not all([timestamp_str, event_type, player_name]):
+    return enqueue_ingest_job('import', json.dumps(logs_data, ensure_ascii=False), 'json')
+
+
+# 每个世界的在线人数曲线默认和最大的数据点数量，超过时按时间桶取峰值
+CONCURRENCY_DEFAULT_RESOLUTION = 500
+CONCURRENCY_MAX_RESOLUTION = 2000
+
+
+@app.route('/api/gamelog/concurrency')
+@login_required
+@compressed_response
+def get_world_concurrency():
+    """根据游戏日志计算世界内同时在线人数曲线和峰值
+
+    按时间顺序流式扫描当前用户的加入/离开日志，每个世界只维护当前人数和峰值。
+    可选参数 world：只返回指定世界（world_id或世界名称）的曲线；
+    from/to（ISO格式）限定时间范围，resolution限定每个世界曲线的数据点数量，
+    数据点超过resolution时按时间桶返回每个桶内的最高人数。
+    """
+    import math
+    from sqlalchemy import func
+
+    world_filter = request.args.get('world')
+    try:
+        range_start = request.args.get('from')
+        range_end = request.args.get('to')
+        range_start = datetime.fromisoformat(range_start) if range_start else None
+        range_end = datetime.fromisoformat(range_end) if range_end else None
+        resolution = int(request.args.get('resolution', CONCURRENCY_DEFAULT_RESOLUTION))
+    except ValueError:
+        return jsonify({'success': False, 'error': '无效的时间范围或分辨率'}), 400
+    resolution = max(1, min(resolution, CONCURRENCY_MAX_RESOLUTION))
+
+    def get_concurrency_operation():
+        tracked_types = ['位置变动', '玩家加入', '玩家离开']
+        user_logs = (GameLog.user_id == current_user.id) & \
+            GameLog.event_type.in_(tracked_types)
+
+        # 未指定范围时使用全部日志的时间跨度
+        start, end = range_start, range_end
+        if start is None or end is None:
+            first, last = db.session.query(
+                func.min(GameLog.timestamp), func.max(GameLog.timestamp)
+            ).filter(user_logs).one()
+            start = start or first
+            end = end or last
+        if start is None or end is None or start > end:
+            return {'from': None, 'to': None, 'resolution': resolution,
+                    'bucket_seconds': None, 'worlds': [], 'peak': 0}
+        bucket_seconds = max(1, math.ceil(
+            max((end - start).total_seconds(), 1) / resolution))
+
+        # 进入世界时人数重新计算，从范围起点之前最近的一次位置变动开始扫描即可
+        scan_start = db.session.query(func.max(GameLog.timestamp)).filter(
+            GameLog.user_id == current_user.id,
+            GameLog.event_type == '位置变动',
+            GameLog.timestamp <= start
+        ).scalar() or start
+        rows = db.session.query(
+            GameLog.timestamp,
+            GameLog.event_type,
+            GameLog.world_name,
+            GameLog.world_id,
+            GameLog.player_name
+        ).filter(
+            user_logs,
+            GameLog.timestamp >= scan_start,
+            GameLog.timestamp <= end
+        ).order_by(GameLog.timestamp, GameLog.id).yield_per(1000)
+
+        worlds = {}  # world_key -> 当前人数、峰值和曲线
+        current_world = None  # 批量导入的加入/离开日志没有世界信息，沿用最近的位置变动
+        in_range = False  # 范围起点之前的日志只用于恢复当前人数
+
+        def record(state, timestamp, count):
+            """记录范围内的人数变化：峰值和曲线（超过分辨率后改为按桶取峰值）"""
+            if count > state['peak']:
+                state['peak'] = count
+                state['peak_time'] = timestamp
+            if world_filter and world_filter not in (state['world_key'], state['world_name']):
+                return
+            if state['buckets'] is None:
+                state['series'].append((timestamp, count))
+                if len(state['series']) <= resolution:
+                    return
+                points, state['series'] = state['series'], None
+                state['buckets'] = {}
+            else:
+                points = [(timestamp, count)]
+            for time, value in points:
+                index = min(int((time - start).total_seconds() // bucket_seconds),
+                            resolution - 1)
+                state['buckets'][index] = max(state['buckets'].get(index, 0), value)
+
+        def enter_range():
+            # 范围起点处仍有人数的世界以起点时间记录当前人数
+            nonlocal in_range
+            in_range = True
+            for state in worlds.values():
+                if state['current']:
+                    record(state, start, state['current'])
+
+        def set_count(world_key, timestamp, count):
+            state = worlds[world_key]
+            if count == state['current']:
+                return
+            state['current'] = count
+            if in_range:
+                record(state, timestamp, count)
+
+        for timestamp, event_type, world_name, world_id, player_name in rows:
+            if not in_range and timestamp >= start:
+                enter_range()
+            world_key = world_id or world_name
+
+            if event_type == '位置变动':
+                if not world_key:
+                    continue
+                # 离开上一个世界：不再能观察到其中的玩家
+                if current_world and current_world != world_key:
+                    set_count(current_world, timestamp, 0)
+                if world_key not in worlds:
+                    worlds[world_key] = {
+                        'world_key': world_key,
+                        'world_name': world_name,
+                        'world_id': world_id,
+                        'current': 0,
+                        'peak': 0,
+                        'peak_time': None,
+                        'series': [],
+                        'buckets': None
+                    }
+                current_world = world_key
+                # 进入世界时只有自己，其他玩家随后以加入事件出现
+                set_count(world_key, timestamp, 1)
                 continue
 
-            # 转换时间字符串为datetime对象
-            try:
-                # 处理不同的时间格式
-                if ' ' in timestamp_str and '/' in timestamp_str:
-                    # 格式：12/28 01:53
-                    timestamp = datetime.strptime(timestamp_str, '%m/%d %H:%M')
-                    # 设置当前年份
-                    timestamp = timestamp.replace(year=datetime.now().year)
-                else:
-                    # ISO格式或其他格式
-                    timestamp = datetime.fromisoformat(timestamp_str)
-            except ValueError:
+            world_key = world_key or current_world
+            if world_key not in worlds:
                 continue
 
-            # 创建游戏日志记录
-            game_log = GameLog(
-                user_id=current_user.id,
-                timestamp=timestamp,
-                event_type=event_type,
-                world_name=world_name,
-                world_id=world_id,
-                player_name=player_name,
-                is_friend=is_friend
-            )
-            db.session.add(game_log)
-            imported_count += 1
+            if event_type == '玩家加入':
+                # 自己已在位置变动时计入
+                if player_name != current_user.username:
+                    set_count(world_key, timestamp,
+                              worlds[world_key]['current'] + 1)
+            elif player_name == current_user.username:
+                set_count(world_key, timestamp, 0)
+                if world_key == current_world:
+                    current_world = None
+            else:
+                set_count(world_key, timestamp,
+                          max(worlds[world_key]['current'] - 1, 0))
+        if not in_range:
+            enter_range()
+
+        result = []
+        for world_key, state in worlds.items():
+            if world_filter and world_filter not in (world_key, state['world_name']):
+                continue
+            if not state['peak']:
+                continue  # 范围内没有出现过
+            if state['buckets'] is None:
+                series = [{'time': time.isoformat(), 'count': count}
+                          for time, count in state['series']]
+            else:
+                series = [{
+                    'time': (start + timedelta(seconds=index * bucket_seconds)).isoformat(),
+                    'count': state['buckets'][index]
+                } for index in sorted(state['buckets'])]
+            result.append({
+                'world_key': world_key,
+                'world_name': state['world_name'],
+                'world_id': state['world_id'],
+                'peak': state['peak'],
+                'peak_time': state['peak_time'].isoformat() if state['peak_time'] else None,
+                'bucket_seconds': bucket_seconds if state['buckets'] is not None else None,
+                'series': series
+            })
+        result.sort(key=lambda item: item['peak'], reverse=True)
 
-        return imported_count
+        return {
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'resolution': resolution,
+            'bucket_seconds': bucket_seconds,
+            'worlds': result,
+            'peak': max((item['peak'] for item in result), default=0)
+        }
 
-    # 成功响应函数
-    def success_response(imported_count):
-        return jsonify({'success': True, 'imported_count': imported_count})
+    def success_response(result):
+        return jsonify({'success': True, 'data': result})
 
-    # 调用API错误处理函数
     return handle_api_db_operation(
-        operation_func=import_logs_operation,
+        operation_func=get_concurrency_operation,
         success_response_func=success_response
     )
 
@@ -2296,7 +5454,7 @@ def find_matching_event_group(event):
     # 3. 查找同一世界、时间窗口内的事件组
     # 先查找匹配的事件
     matching_events = SharedEvent.query.filter(
-        SharedEvent.world_id == world.id,
+        overlaps_filter(start_time_window, end_time_window, world.id),
         SharedEvent.start_time.between(start_time_window, end_time_window),
         SharedEvent.end_time.between(start_time_window, end_time_window),
         SharedEvent.user_id != event.user_id,  # 排除当前用户的其他事件
@@ -2323,389 +5481,1098 @@ def find_matching_event_group(event):
     return None
 
 
-def match_events_to_groups():
-    """将所有事件匹配到合适的事件组"""
-    # 1. 获取所有事件
-    all_events = SharedEvent.query.all()
+def _chunked(values, size=500):
+    """将列表按固定大小分块（避免IN列表超过SQLite的参数上限）"""
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
 
-    # 2. 重置所有事件的事件组ID
-    for event in all_events:
-        event.event_group_id = None
-    db.session.commit()
 
-    # 3. 构建事件间的匹配关系，使用事件ID作为键
-    event_matches = {}
-    event_id_map = {event.id: event for event in all_events}
+def load_grouping_candidates(event_ids):
+    """加载与给定事件同一世界、时间范围内的所有事件（只加载分组需要的列）
 
-    for i, event1 in enumerate(all_events):
-        for event2 in all_events[i + 1:]:
-            # 跳过同一用户的事件
-            if event1.user_id == event2.user_id:
-                continue
+    Returns:
+        (affected, candidates): 给定事件的ID集合，和 {事件ID: 行} 候选事件
+    """
+    columns = (SharedEvent.id, SharedEvent.user_id, SharedEvent.world_id,
+               SharedEvent.friend_name, SharedEvent.start_time,
+               SharedEvent.end_time, SharedEvent.event_group_id)
+    affected = {}
+    for chunk in _chunked(event_ids):
+        for row in db.session.query(*columns).filter(SharedEvent.id.in_(chunk)):
+            affected[row.id] = row
+
+    # 每个世界只查询受影响事件覆盖的时间范围
+    spans = {}
+    for row in affected.values():
+        end_time = row.end_time or row.start_time
+        low, high = spans.get(row.world_id, (row.start_time, end_time))
+        spans[row.world_id] = (min(low, row.start_time), max(high, end_time))
+
+    candidates = dict(affected)
+    for world_id, (low, high) in spans.items():
+        for row in db.session.query(*columns).filter(overlaps_filter(low, high, world_id)):
+            candidates[row.id] = row
+    return set(affected), candidates
+
+
+def load_participant_index(event_ids):
+    """参与者集合索引：{事件ID: 参与者用户名集合}，一次查询代替逐事件懒加载"""
+    index = {}
+    for chunk in _chunked(event_ids):
+        rows = db.session.query(event_participants.c.event_id, User.username).join(
+            User, User.id == event_participants.c.user_id
+        ).filter(event_participants.c.event_id.in_(chunk))
+        for event_id, username in rows:
+            index.setdefault(event_id, set()).add(username)
+    return index
+
+
+def sweep_matching_pairs(candidates, participants, affected):
+    """按世界排序扫描，找出时间重叠且参与者匹配的事件对（至少一个属于affected）
+
+    每个世界按开始时间排序，用按结束时间排序的堆维护当前仍在进行的事件，
+    总复杂度为O(n log n + k)，k为重叠的事件对数。
+    """
+    import heapq
+
+    by_world = {}
+    for row in candidates.values():
+        by_world.setdefault(row.world_id, []).append(row)
+
+    pairs = []
+    for rows in by_world.values():
+        rows.sort(key=lambda row: (row.start_time, row.id))
+        active = []  # (结束时间, 事件ID, 行)
+        for row in rows:
+            # 移除已经结束的事件
+            while active and active[0][0] < row.start_time:
+                heapq.heappop(active)
+
+            row_participants = participants.get(row.id, set())
+            for _, _, other in active:
+                if row.id not in affected and other.id not in affected:
+                    continue
+                # 跳过同一用户的事件
+                if row.user_id == other.user_id:
+                    continue
+                other_participants = participants.get(other.id, set())
+                if row_participants & other_participants or \
+                   row.friend_name in other_participants or \
+                   other.friend_name in row_participants:
+                    pairs.append((other.id, row.id))
+
+            heapq.heappush(active, (row.end_time or row.start_time, row.id, row))
+    return pairs
+
+
+class DisjointSet:
+    """并查集（路径压缩 + 按大小合并），用于事件的传递性分组"""
+    __slots__ = ('parent', 'size')
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, item):
+        """查找所在集合的代表元素"""
+        parent = self.parent
+        if item not in parent:
+            parent[item] = item
+            self.size[item] = 1
+            return item
+        root = item
+        while parent[root] != root:
+            root = parent[root]
+        while parent[item] != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    def union(self, first, second):
+        """合并两个元素所在的集合"""
+        first, second = self.find(first), self.find(second)
+        if first == second:
+            return first
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size[second]
+        return first
+
+    def sets(self):
+        """返回 {代表元素: 成员列表}"""
+        result = {}
+        for item in self.parent:
+            result.setdefault(self.find(item), []).append(item)
+        return result
 
-            # 检查世界是否相同
-            if event1.world_id != event2.world_id:
-                continue
 
-            # 检查时间重叠（只要有重叠就匹配）
-            # 两个事件有重叠的条件：event1的结束时间 >= event2的开始时间 且 event1的开始时间 <=
-            # event2.end_time
-            if not (event1.end_time >=
-                    event2.start_time and event1.start_time <= event2.end_time):
-                continue
+def group_events(event_ids):
+    """只为给定的事件（如本次转换新建的事件）分配事件组
 
-            # 检查参与者是否匹配
-            event1_participants = [p.username for p in event1.participants]
-            event2_participants = [p.username for p in event2.participants]
-
-            if set(event1_participants).intersection(set(event2_participants)) or \
-               event1.friend_name in event2_participants or \
-               event2.friend_name in event1_participants:
-                # 事件匹配，建立双向关系
-                if event1.id not in event_matches:
-                    event_matches[event1.id] = set()
-                if event2.id not in event_matches:
-                    event_matches[event2.id] = set()
-                event_matches[event1.id].add(event2.id)
-                event_matches[event2.id].add(event1.id)
-
-    # 4. 为匹配的事件创建事件组
-    processed_event_ids = set()
-
-    for event_id, match_ids in event_matches.items():
-        if event_id in processed_event_ids:
+    匹配关系是传递的（A~B、B~C则A、B、C同组）：已有事件组的成员预先合并，
+    再按匹配的事件对合并。一个集合关联多个已有事件组时合并到ID最小的组，
+    其余的组被吸收并删除；没有任何匹配的事件不创建单独的事件组。
+    """
+    from sqlalchemy import update, delete, insert, bindparam
+
+    affected, candidates = load_grouping_candidates(event_ids)
+    if not affected:
+        return
+    participants = load_participant_index(candidates)
+
+    # 1. 已有事件组的成员属于同一集合，再按匹配的事件对合并
+    components = DisjointSet()
+    group_roots = {}
+    for event_id, row in candidates.items():
+        components.find(event_id)
+        if row.event_group_id:
+            if row.event_group_id in group_roots:
+                components.union(group_roots[row.event_group_id], event_id)
+            else:
+                group_roots[row.event_group_id] = event_id
+    for event1_id, event2_id in sweep_matching_pairs(candidates, participants, affected):
+        components.union(event1_id, event2_id)
+
+    # 2. 为每个包含受影响事件且至少两个成员的集合确定事件组
+    assignments = {}  # 事件ID -> 事件组ID
+    absorbed = {}  # 被吸收的事件组ID -> 合并后的事件组ID
+    ungrouped_sets = []
+    for members in components.sets().values():
+        if len(members) < 2 or not affected.intersection(members):
+            continue
+        existing = sorted({candidates[m].event_group_id for m in members
+                           if candidates[m].event_group_id})
+        if not existing:
+            ungrouped_sets.append(members)
             continue
+        group_id = existing[0]
+        for other_group_id in existing[1:]:
+            absorbed[other_group_id] = group_id
+        for member_id in members:
+            if candidates[member_id].event_group_id != group_id:
+                assignments[member_id] = group_id
+
+    # 3. 批量创建新的事件组
+    if ungrouped_sets:
+        now = datetime.now()
+        group_ids = db.session.execute(
+            insert(EventGroup.__table__).returning(
+                EventGroup.__table__.c.id, sort_by_parameter_order=True),
+            [{'created_at': now} for _ in ungrouped_sets]
+        ).scalars().all()
+        for members, group_id in zip(ungrouped_sets, group_ids):
+            for member_id in members:
+                assignments[member_id] = group_id
+
+    # 4. 批量写回：被吸收的组整体迁移（包括不在候选范围内的成员），再更新单个事件
+    table = SharedEvent.__table__
+    if absorbed:
+        db.session.execute(
+            update(table).where(table.c.event_group_id == bindparam('old_group_id'))
+            .values(event_group_id=bindparam('new_group_id')),
+            [{'old_group_id': old, 'new_group_id': new}
+             for old, new in absorbed.items()]
+        )
+        db.session.execute(delete(EventGroup.__table__).where(
+            EventGroup.__table__.c.id.in_(list(absorbed))))
+    if assignments:
+        db.session.execute(
+            update(table).where(table.c.id == bindparam('event_id'))
+            .values(event_group_id=bindparam('group_id')),
+            [{'event_id': event_id, 'group_id': group_id}
+             for event_id, group_id in assignments.items()]
+        )
+
+    # 会话中已加载的事件对象需要重新读取事件组
+    if absorbed or assignments:
+        for event in list(db.session.identity_map.values()):
+            if isinstance(event, SharedEvent):
+                db.session.expire(event, ['event_group_id'])
+
 
-        # 创建新的事件组
-        event_group = EventGroup()
-        db.session.add(event_group)
-        db.session.flush()  # 立即获取事件组ID
-
-        # 将事件及其匹配项关联到事件组
-        group_event_ids = {event_id} | match_ids
-        for group_event_id in group_event_ids:
-            if group_event_id in event_id_map:
-                group_event = event_id_map[group_event_id]
-                group_event.event_group_id = event_group.id
-                processed_event_ids.add(group_event_id)
-
-    # 5. 为没有匹配项的事件创建单独的事件组
-    for event in all_events:
-        if event.id not in processed_event_ids:
-            event_group = EventGroup()
-            db.session.add(event_group)
-            db.session.flush()  # 立即获取事件组ID
-            event.event_group_id = event_group.id
-            processed_event_ids.add(event.id)
+def match_events_to_groups():
+    """将所有事件重新匹配到事件组（全量，用于生成模拟数据等场景）"""
+    from sqlalchemy import update, delete, select
+
+    # 1. 重置所有事件的事件组ID
+    db.session.execute(update(SharedEvent.__table__).values(event_group_id=None))
+    db.session.expire_all()
 
+    # 2. 按世界排序扫描重新分组
+    group_events([event_id for event_id, in db.session.query(SharedEvent.id)])
+
+    # 3. 删除不再包含任何事件的事件组
+    db.session.execute(delete(EventGroup.__table__).where(
+        ~EventGroup.__table__.c.id.in_(
+            select(SharedEvent.__table__.c.event_group_id).where(
+                SharedEvent.__table__.c.event_group_id.isnot(None)))))
     db.session.commit()
 
 
+class ConversionWorldState:
+    """日志转换中一个世界的会话状态：在场的其他玩家和用户自己进入的时间"""
+    __slots__ = ('world_name', 'world_id', 'players', 'own_start')
+
+    def __init__(self, world_name, world_id, players=None, own_start=None):
+        self.world_name = world_name
+        self.world_id = world_id
+        self.players = players or {}  # player_name -> (加入时间, 是否好友)
+        self.own_start = own_start
+
+
+class LogConversionEngine:
+    """单遍的日志会话状态机
+
+    按时间顺序逐条处理加入、离开和位置变动日志，每个世界只保存一个
+    ConversionWorldState。其他玩家离开时生成一段共同在场；用户自己离开时，
+    仍在世界中的玩家在这一刻结束共同在场。每段共同在场通过
+    on_event(world, player_name, start_time, end_time, is_friend)回调输出。
+    """
+    __slots__ = ('username', 'worlds', 'on_event')
+
+    def __init__(self, username, on_event, worlds=None):
+        self.username = username
+        self.on_event = on_event
+        self.worlds = worlds or {}  # (world_name, world_id) -> ConversionWorldState
+
+    def process(self, timestamp, event_type, world_name, world_id, player_name, is_friend):
+        """处理一条日志"""
+        key = (world_name, world_id)
+        world = self.worlds.get(key)
+        if world is None:
+            world = self.worlds[key] = ConversionWorldState(world_name, world_id)
+
+        if event_type == '位置变动':
+            # 用户自己进入世界
+            if player_name == self.username:
+                world.own_start = timestamp
+
+        elif event_type == '玩家加入':
+            if player_name != self.username:
+                world.players[player_name] = (timestamp, is_friend)
+
+        elif event_type == '玩家离开':
+            if player_name != self.username:
+                player = world.players.pop(player_name, None)
+                # 不输出结束早于开始的区间（乱序的日志）
+                if player and player[0] <= timestamp:
+                    self.on_event(world, player_name, player[0], timestamp, player[1])
+            elif world.own_start is not None:
+                # 用户自己离开：与仍在世界中的玩家的共同在场在此刻结束
+                for other_name, (start_time, other_is_friend) in world.players.items():
+                    overlap_start = max(world.own_start, start_time)
+                    if overlap_start < timestamp:
+                        self.on_event(world, other_name, overlap_start, timestamp,
+                                      other_is_friend)
+                world.players.clear()
+                world.own_start = None
+
+
+def replay_game_logs(username, on_event, worlds, logs, last_timestamp=None):
+    """按时间顺序重放新日志，返回(未关闭的会话, 最后处理的日志时间)
+
+    logs按(timestamp, id)排序。早于last_timestamp的日志是转换之后才上传的旧日志，
+    不能接在保存的未关闭会话上（旧的离开会与新的加入配对），这部分用一个独立的
+    状态机单独重放，结束时仍未关闭的会话直接丢弃。
+    """
+    late_engine = LogConversionEngine(username, on_event)
+    engine = LogConversionEngine(username, on_event, worlds)
+    for log in logs:
+        if last_timestamp is not None and log.timestamp < last_timestamp:
+            late_engine.process(log.timestamp, log.event_type, log.world_name,
+                                log.world_id, log.player_name, log.is_friend)
+        else:
+            engine.process(log.timestamp, log.event_type, log.world_name,
+                           log.world_id, log.player_name, log.is_friend)
+            last_timestamp = log.timestamp
+    return engine.worlds, last_timestamp
+
+
+class GameLogConversionState(db.Model):
+    """每个用户的日志转换水位线
+
+    记录已转换的最大日志ID、最后处理的日志时间和转换结束时仍未关闭的会话
+    （各世界中的玩家、用户自己进入的时间），下次转换只处理新日志并从这些会话继续。
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True)
+    last_log_id = db.Column(db.Integer, nullable=False, default=0)
+    last_timestamp = db.Column(db.DateTime)
+    open_sessions = db.Column(db.Text)  # JSON格式的未关闭会话
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def load_worlds(self):
+        """还原未关闭的会话：{(world_name, world_id): ConversionWorldState}"""
+        data = json.loads(self.open_sessions) if self.open_sessions else {}
+        worlds = {}
+        for world in data.get('worlds', []):
+            worlds[(world['world_name'], world['world_id'])] = ConversionWorldState(
+                world['world_name'], world['world_id'],
+                {name: (datetime.fromisoformat(start_time), is_friend)
+                 for name, (start_time, is_friend) in world['players'].items()},
+                datetime.fromisoformat(world['own_start']) if world['own_start'] else None)
+        return worlds
+
+    def save_worlds(self, worlds):
+        """保存未关闭的会话（既没有玩家、用户也不在其中的世界不保存）"""
+        self.open_sessions = json.dumps({'worlds': [{
+            'world_name': world.world_name,
+            'world_id': world.world_id,
+            'players': {name: [start_time.isoformat(), is_friend]
+                        for name, (start_time, is_friend) in world.players.items()},
+            'own_start': world.own_start.isoformat() if world.own_start else None
+        } for world in worlds.values() if world.players or world.own_start]},
+            ensure_ascii=False)
+
+
+def convert_user_game_logs(user, progress=None):
+    """将用户的游戏日志转换为SharedEvent，返回新创建的事件数（不提交事务）
+
+    只处理上次转换之后导入的日志，并从上次未关闭的会话继续；
+    比已处理的日志更早的新日志单独重放（见replay_game_logs）。
+    """
+    # 1. 读取转换水位线
+    state = GameLogConversionState.query.filter_by(user_id=user.id).first()
+    if not state:
+        state = GameLogConversionState(user_id=user.id, last_log_id=0)
+        db.session.add(state)
+    elif state.last_timestamp is None and state.last_log_id:
+        # 旧版本的水位线没有记录时间，用已转换日志的最大时间补上
+        state.last_timestamp = db.session.query(db.func.max(GameLog.timestamp)).filter(
+            GameLog.user_id == user.id, GameLog.id <= state.last_log_id).scalar()
+
+    # 2. 获取所有注册用户，用于识别好友关系
+    all_users = User.query.all()
+    username_to_user = {registered.username: registered for registered in all_users}
+
+    new_events = []
+    # 与注册用户的共同在场秒数，用于增量更新社交图
+    copresence_seconds = {}
+
+    # 状态机输出的共同在场片段，处理完日志后批量解析世界再创建事件
+    segments = []
+
+    def collect_segment(world, player_name, start_time, end_time, is_friend):
+        segments.append((world.world_name, world.world_id, player_name,
+                         start_time, end_time, is_friend))
+
+    def create_event(world_pk, player_name, start_time, end_time, is_friend):
+        """为一段共同在场创建SharedEvent"""
+        duration = int((end_time - start_time).total_seconds())
+        event = SharedEvent(
+            user_id=user.id,
+            world_id=world_pk,
+            friend_name=player_name,
+            start_time=start_time,
+            end_time=end_time,
+            duration=duration
+        )
+        db.session.add(event)
+
+        # 添加参与者：当前用户和对方玩家（如果是注册用户）
+        event.participants.append(user)
+        other_user = username_to_user.get(player_name)
+        if other_user:
+            event.participants.append(other_user)
+            copresence_seconds[other_user.id] = \
+                copresence_seconds.get(other_user.id, 0) + duration
+
+            # 确保好友关系正确
+            if is_friend and other_user not in user.friends:
+                user.friends.append(other_user)
+                other_user.friends.append(user)
+
+        new_events.append(event)
+
+    # 3. 按时间顺序单遍处理水位线之后的日志（从上次未关闭的会话继续）
+    game_logs = db.session.query(
+        GameLog.id, GameLog.timestamp, GameLog.event_type, GameLog.world_name,
+        GameLog.world_id, GameLog.player_name, GameLog.is_friend
+    ).filter(
+        GameLog.user_id == user.id,
+        GameLog.id > state.last_log_id
+    ).order_by(GameLog.timestamp, GameLog.id).all()
+
+    worlds, last_timestamp = replay_game_logs(
+        user.username, collect_segment, state.load_worlds(), game_logs,
+        state.last_timestamp)
+    last_log_id = max([state.last_log_id] + [log.id for log in game_logs])
+    if progress:
+        progress.report(lines_parsed=len(game_logs))
+
+    # 批量解析（或创建）涉及的世界，再创建事件
+    world_ids = WorldResolver().resolve_many(
+        (world_name, world_id) for world_name, world_id, *_ in segments)
+    for world_name, world_id, *segment in segments:
+        create_event(world_ids[(world_name, world_id)], *segment)
+
+    # 4. 只为本次新创建的事件匹配事件组
+    db.session.flush()
+    group_events([event.id for event in new_events])
+
+    # 5. 增量更新共同在场社交图
+    apply_copresence_change(db.session.connection(), user.id, copresence_seconds)
+
+    # 6. 推进水位线并保存未关闭的会话
+    state.last_log_id = last_log_id
+    state.last_timestamp = last_timestamp
+    state.save_worlds(worlds)
+
+    if progress:
+        progress.report(events_converted=len(new_events))
+    return len(new_events)
+
+
 @app.route('/api/gamelog/convert', methods=['POST'])
 @login_required
 def convert_game_logs():
-    """将游戏日志转换为SharedEvent"""
-    # 使用API错误处理包装的数据库操作
-    def convert_logs_operation():
-        # 1. 获取当前用户的所有游戏日志
-        game_logs = GameLog.query.filter_by(
-            user_id=current_user.id).order_by(
-            GameLog.timestamp).all()
-
-        # 2. 获取所有注册用户，用于识别好友关系
-        all_users = User.query.all()
-        username_to_user = {user.username: user for user in all_users}
-
-        # 3. 按世界分组，跟踪每个世界中的玩家会话
-        world_sessions = {}
-        converted_count = 0
-
-        for log in game_logs:
-            world_key = f"{log.world_name}_{log.world_id}"
-            player_name = log.player_name
-
-            # 初始化世界会话
-            if world_key not in world_sessions:
-                world_sessions[world_key] = {
-                    'world_name': log.world_name,
-                    'world_id': log.world_id,
-                    'players': {},  # player_name -> {start_time, is_friend}
-                    'events': []
-                }
-
-            world_session = world_sessions[world_key]
-
-            if log.event_type == '位置变动':
-                # 当前用户加入世界，记录世界信息
-                # 确保player_name是当前用户自己
-                if player_name == current_user.username:
-                    # 处理当前用户加入世界的逻辑
-                    # 确保当前用户不在玩家列表中，避免重复
-                    if player_name not in world_session['players']:
-                        world_session['players'][player_name] = {
-                            'start_time': log.timestamp,
-                            'is_friend': False
-                        }
-
-            elif log.event_type == '玩家加入':
-                # 记录玩家加入时间和好友状态
-                world_session['players'][player_name] = {
-                    'start_time': log.timestamp,
-                    'is_friend': log.is_friend
-                }
-
-            elif log.event_type == '玩家离开':
-                # 1. 只有当离开的玩家不是当前用户自己时，才可能创建事件
-                if player_name != current_user.username:
-                    # 2. 确保player_name在world_session['players']中
-                    if player_name in world_session['players']:
-                        # 玩家离开，创建SharedEvent
-                        player_info = world_session['players'].pop(player_name)
+    """提交日志转换任务（后台执行），立即返回任务
 
-                        # 计算持续时间
-                        duration = int(
-                            (log.timestamp - player_info['start_time']).total_seconds())
+    同一用户已有排队或运行中的转换任务时直接返回该任务。
+    """
+    active_job = IngestJob.query.filter(
+        IngestJob.user_id == current_user.id,
+        IngestJob.job_type == 'convert',
+        IngestJob.status.in_(('queued', 'running'))
+    ).first()
+    if active_job:
+        return jsonify({'success': True, 'job': active_job.to_dict()}), 202
 
-                        # 查找或创建世界
-                        world = get_or_create_world(world_session['world_name'], '')
+    return enqueue_ingest_job('convert')
 
-                        # 创建SharedEvent
-                        event = SharedEvent(
-                            user_id=current_user.id,
-                            world_id=world.id,
-                            friend_name=player_name,
-                            start_time=player_info['start_time'],
-                            end_time=log.timestamp,
-                            duration=duration
-                        )
 
-                        # 添加参与者：当前用户和对方玩家（如果是注册用户）
-                        event.participants.append(current_user)
-                        if player_name in username_to_user:
-                            other_user = username_to_user[player_name]
-                            event.participants.append(other_user)
+# ------------------------------
+# 游戏日志文本解析（流式）
+# ------------------------------
+
+# 批量导入时每次写入数据库的行数（可通过app.config覆盖）
+GAMELOG_IMPORT_CHUNK_SIZE = 1000
 
-                            # 确保好友关系正确
-                            if player_info['is_friend'] and other_user not in current_user.friends:
-                                current_user.friends.append(other_user)
-                                other_user.friends.append(current_user)
 
-                        db.session.add(event)
-                        converted_count += 1
-                else:
-                    # 如果离开的是当前用户自己，从玩家列表中移除自己（如果存在）
-                    if player_name in world_session['players']:
-                        world_session['players'].pop(player_name)
-
-        # 4. 为当前用户处理自己的加入和离开事件
-        # 跟踪当前用户在每个世界的会话
-        current_user_sessions = {}
-
-        for log in game_logs:
-            world_key = f"{log.world_name}_{log.world_id}"
-            player_name = log.player_name
-
-            # 只处理当前用户自己的位置变动事件
-            if log.event_type == '位置变动' and player_name == current_user.username:
-                # 当前用户加入世界
-                current_user_sessions[world_key] = {
-                    'start_time': log.timestamp,
-                    'world_name': log.world_name,
-                    'world_id': log.world_id
-                }
-
-            # 当前用户离开世界（当看到自己的离开事件时）
-            elif log.event_type == '玩家离开' and player_name == current_user.username:
-                if world_key in current_user_sessions:
-                    session = current_user_sessions.pop(world_key)
-
-                    # 查找该世界中当前用户离开时的其他玩家
-                    if world_key in world_sessions:
-                        world_session = world_sessions[world_key]
-                        # 为每个仍在世界中的玩家创建事件，但排除当前用户自己
-                        for other_player_name, other_player_info in world_session['players'].items(
-                        ):
-                            # 跳过当前用户自己
-                            if other_player_name == current_user.username:
-                                continue
-                                
-                            # 计算重叠时间
-                            overlap_start = max(
-                                session['start_time'], other_player_info['start_time'])
-                            overlap_end = log.timestamp
-
-                            if overlap_start < overlap_end:
-                                duration = int(
-                                    (overlap_end - overlap_start).total_seconds())
-
-                                # 查找或创建世界
-                                world = get_or_create_world(
-                                    session['world_name'], '')
-
-                                # 创建SharedEvent
-                                event = SharedEvent(
-                                    user_id=current_user.id,
-                                    world_id=world.id,
-                                    friend_name=other_player_name,
-                                    start_time=overlap_start,
-                                    end_time=overlap_end,
-                                    duration=duration
-                                )
-
-                                # 添加参与者
-                                event.participants.append(current_user)
-                                if other_player_name in username_to_user:
-                                    other_user = username_to_user[other_player_name]
-                                    event.participants.append(other_user)
-
-                                    # 确保好友关系正确
-                                    if other_player_info['is_friend'] and other_user not in current_user.friends:
-                                        current_user.friends.append(other_user)
-                                        other_user.friends.append(current_user)
-
-                                db.session.add(event)
-                                converted_count += 1
-
-        # 5. 将新创建的事件匹配到事件组
-        match_events_to_groups()
-
-        return converted_count
-
-    # 成功响应函数
-    def success_response(converted_count):
-        return jsonify({'success': True, 'converted_count': converted_count})
-
-    # 调用API错误处理函数
-    return handle_api_db_operation(
-        operation_func=convert_logs_operation,
-        success_response_func=success_response
-    )
+# 批量写入的列（未提供的列使用默认值）
+GAMELOG_BULK_COLUMNS = ('user_id', 'timestamp', 'event_type', 'world_name', 'world_id',
+                        'player_name', 'is_friend', 'player_is_registered',
+                        'event_hash', 'created_at')
+
+
+@functools.lru_cache(maxsize=4096)
+def _sqlite_datetime(value):
+    """按SQLAlchemy的SQLite日期时间存储格式格式化（日志时间大量重复，缓存结果）"""
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+class GameLogBulkWriter:
+    """游戏日志批量写入器
+
+    行以字典形式累积，每满chunk_size行用一次DBAPI executemany写入并提交，
+    每个块是一个独立的事务，不经过ORM的工作单元和逐行的类型处理。
+    写入使用INSERT OR IGNORE，event_hash重复的行（重复上传的日志）会被跳过；
+    没有event_hash的行按添加顺序由GameLogHasher计算。
+    on_flush(writer)在每个块提交前调用，可以把进度和块一起提交，抛出异常则回滚该块。
+    """
+
+    def __init__(self, chunk_size=None, on_flush=None):
+        import time
+
+        self.chunk_size = chunk_size or app.config.get(
+            'GAMELOG_IMPORT_CHUNK_SIZE', GAMELOG_IMPORT_CHUNK_SIZE)
+        self.on_flush = on_flush
+        self.hashers = {}  # user_id -> GameLogHasher
+        self.rows = []
+        self.written = 0
+        self.skipped = 0
+        self.started_at = time.perf_counter()
+
+    def add(self, row):
+        """添加一行（GameLog列名到值的字典）"""
+        if not row.get('event_hash'):
+            hasher = self.hashers.get(row['user_id'])
+            if hasher is None:
+                hasher = self.hashers[row['user_id']] = GameLogHasher(row['user_id'])
+            row['event_hash'] = hasher(row['timestamp'], row['event_type'],
+                                       row['player_name'], row.get('world_name'),
+                                       row.get('world_id'))
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """写入并提交当前块"""
+        if not self.rows:
+            return
+        created_at = _sqlite_datetime(datetime.now())
+        parameters = [(
+            row['user_id'], _sqlite_datetime(row['timestamp']), row['event_type'],
+            row.get('world_name'), row.get('world_id'), row['player_name'],
+            bool(row.get('is_friend')), bool(row.get('player_is_registered')),
+            row['event_hash'], created_at
+        ) for row in self.rows]
+        result = db.session.connection().exec_driver_sql(
+            f"INSERT OR IGNORE INTO game_log ({', '.join(GAMELOG_BULK_COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in GAMELOG_BULK_COLUMNS)})",
+            parameters)
+        self.written += result.rowcount
+        self.skipped += len(self.rows) - result.rowcount
+        self.rows = []
+        if self.on_flush:
+            self.on_flush(self)
+        db.session.commit()
+
+    def stats(self):
+        """写入行数、耗时和吞吐量（行/秒）"""
+        import time
+
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            'rows': self.written,
+            'skipped': self.skipped,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': int(self.written / elapsed) if elapsed > 0 else self.written,
+            'chunk_size': self.chunk_size
+        }
+
+
+def iter_log_lines(stream, encoding='utf-8'):
+    """逐行读取日志流（上传文件、原始请求体或文本），内存占用与文件大小无关"""
+    import io
+
+    if isinstance(stream, str):
+        stream = io.StringIO(stream)
+    elif not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding=encoding, errors='replace')
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def is_log_record_start(line):
+    """以日期格式（如 12/28）开头的行是新记录的开始，其余行是上一条记录的续行"""
+    return '/' in line and len(line.split()[0]) >= 5
+
+
+def iter_log_records(lines):
+    """将多行记录合并为单行：以日期格式（如 12/28）开头的行是新记录的开始"""
+    current_line = []
+    for line in lines:
+        if is_log_record_start(line):
+            if current_line:
+                yield ' '.join(current_line)
+            current_line = [line]
+        elif current_line:
+            # 追加到当前记录
+            current_line.append(line)
+
+    if current_line:
+        yield ' '.join(current_line)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_log_timestamp(date_part, time_part, year):
+    """解析日志时间（精确到分钟，同一分钟的大量日志共用缓存结果）"""
+    try:
+        return datetime.strptime(
+            f"{date_part} {time_part}", '%m/%d %H:%M').replace(year=year)
+    except ValueError:
+        return None
+
+
+def parse_log_record(full_line, year=None):
+    """解析一条日志记录，格式如：
+    12/28 01:53 位置变动 メゾン荘 201号室 #53949 friends+
+    12/28 01:52 玩家离开 💚 SaKi43
+
+    Returns:
+        dict: timestamp、event_type、world_name、world_id、player_name、is_friend，
+        无法解析时返回None
+    """
+    parts = full_line.split()
+    if len(parts) < 4:
+        return None
+
+    # 解析时间
+    timestamp = _parse_log_timestamp(parts[0], parts[1], year or datetime.now().year)
+    if timestamp is None:
+        return None
+
+    # 解析事件类型
+    event_type = parts[2]
+    if event_type not in ['位置变动', '玩家加入', '玩家离开']:
+        return None
+
+    player_name = ''
+    world_name = ''
+    world_id = ''
+    is_friend = False
+
+    if event_type == '位置变动':
+        # 格式：位置变动 メゾン荘 201号室 #53949 friends+
+        world_parts = parts[3:]
+        for i, part in enumerate(world_parts):
+            if part.startswith('#'):
+                world_id = part
+                world_name = ' '.join(world_parts[:i])
+                if i + 1 < len(world_parts) and world_parts[i + 1] == 'friends+':
+                    is_friend = True
+                break
+        else:
+            world_name = ' '.join(world_parts)
+
+        player_name = '系统'
+
+    else:  # 玩家加入或玩家离开
+        # 格式：玩家离开 💚 SaKi43
+        player_parts = parts[3:]
+        if len(player_parts) >= 2:
+            if player_parts[0] == '💚':
+                is_friend = True
+                player_name = ' '.join(player_parts[1:])
+            else:
+                player_name = ' '.join(player_parts)
+        elif len(player_parts) == 1:
+            player_name = player_parts[0]
+
+    return {
+        'timestamp': timestamp,
+        'event_type': event_type,
+        'world_name': world_name,
+        'world_id': world_id,
+        'player_name': player_name,
+        'is_friend': is_friend
+    }
+
+
+# ------------------------------
+# 游戏日志文本解析（多进程）
+# ------------------------------
+
+# 上传超过该大小时改用多进程并行解析
+GAMELOG_PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+
+# 每个解析任务处理的字节数
+GAMELOG_PARSE_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def get_upload_dir():
+    """上传暂存目录：instance/uploads"""
+    import os
+    upload_dir = os.path.join(app.instance_path, 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+    return upload_dir
+
+
+def spool_upload(source, file_name):
+    """将上传内容（文本或二进制流）写入暂存目录，返回文件路径（调用方负责删除）"""
+    import os
+    import shutil
+
+    path = os.path.join(get_upload_dir(), file_name)
+    try:
+        with open(path, 'wb') as spool_file:
+            if isinstance(source, str):
+                spool_file.write(source.encode('utf-8'))
+            else:
+                shutil.copyfileobj(source, spool_file, 1024 * 1024)
+    except BaseException:
+        # 上传中断（如客户端断开）时不留下不完整的文件
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path
+
+
+def log_chunk_ranges(size, chunk_bytes=None):
+    """将文件按字节切分为[start, end)范围，边界由parse_log_range对齐到行"""
+    chunk_bytes = chunk_bytes or app.config.get(
+        'GAMELOG_PARSE_CHUNK_BYTES', GAMELOG_PARSE_CHUNK_BYTES)
+    return [(start, min(start + chunk_bytes, size))
+            for start in range(0, size, chunk_bytes)]
+
+
+def iter_range_lines(path, start, end):
+    """读取在[start, end)内开始的记录的所有行
+
+    - 从start-1处读到行尾对齐：恰好从start开始的行保留，跨越start的行属于上一块
+    - 块开头的续行属于上一块最后一条记录，跳过
+    - 块内最后一条记录的续行即使超过end也继续读取，直到下一条记录开始
+    """
+    with open(path, 'rb') as log_file:
+        if start > 0:
+            log_file.seek(start - 1)
+            log_file.readline()
+        started = False
+        while True:
+            offset = log_file.tell()
+            raw_line = log_file.readline()
+            if not raw_line:
+                break
+            line = raw_line.decode('utf-8', errors='replace').strip()
+            if not line:
+                continue
+            if is_log_record_start(line):
+                if offset >= end:
+                    break
+                started = True
+            elif not started:
+                continue
+            yield line
+
+
+def parse_log_range(path, start, end, year, user_id, username):
+    """在子进程中解析一个字节范围：返回解析后的记录列表和该范围的去重草图
+
+    记录已填好user_id，可以直接交给GameLogBulkWriter。event_hash的出现序号依赖
+    之前所有块的内容，由写入器按文件顺序计算。
+    """
+    sketches = UniqueSketchAccumulator(user_id, username)
+    records = []
+    for full_line in iter_log_records(iter_range_lines(path, start, end)):
+        record = parse_log_record(full_line, year)
+        if not record:
+            continue
+
+        record['user_id'] = user_id
+        sketches.add(record['timestamp'], record['event_type'],
+                     record['world_name'], record['world_id'],
+                     record['player_name'])
+        records.append(record)
+    return records, sketches.sketches
+
+
+def iter_parallel_log_records(path, year, user_id, username, workers=None):
+    """用进程池并行解析日志文件，按文件顺序逐块产出(记录列表, 草图)
+
+    同时在途的任务数限制为进程数的两倍，内存占用与文件大小无关。
+    """
+    import os
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or app.config.get('GAMELOG_PARSE_WORKERS') or os.cpu_count() or 1
+    ranges = log_chunk_ranges(os.path.getsize(path))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for start, end in ranges:
+            pending.append(pool.submit(
+                parse_log_range, path, start, end, year, user_id, username))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def import_log_file(path, user, progress=None):
+    """解析并写入日志文本文件，返回写入统计
+
+    文件不小于GAMELOG_PARALLEL_MIN_BYTES时用多进程并行解析，否则逐行流式解析。
+    """
+    import os
+
+    sketches = UniqueSketchAccumulator(user.id, user.username)
+    writer = GameLogBulkWriter(on_flush=progress.on_flush if progress else None)
+    year = datetime.now().year
+
+    if os.path.getsize(path) >= app.config.get(
+            'GAMELOG_PARALLEL_MIN_BYTES', GAMELOG_PARALLEL_MIN_BYTES):
+        for records, chunk_sketches in iter_parallel_log_records(
+                path, year, user.id, user.username):
+            if progress:
+                progress.lines_parsed += len(records)
+            for record in records:
+                writer.add(record)
+            sketches.merge(chunk_sketches)
+    else:
+        with open(path, 'rb') as log_file:
+            for full_line in iter_log_records(iter_log_lines(log_file)):
+                record = parse_log_record(full_line, year)
+                if not record:
+                    continue
+                if progress:
+                    progress.lines_parsed += 1
+
+                record['user_id'] = user.id
+                writer.add(record)
+                sketches.add(record['timestamp'], record['event_type'],
+                             record['world_name'], record['world_id'],
+                             record['player_name'])
+
+    writer.flush()
+
+    # 更新去重统计草图
+    sketches.flush()
+
+    return writer.stats()
 
 
 @app.route('/api/gamelog/bulk_import', methods=['POST'])
 @login_required
 def bulk_import_game_logs():
-    """批量导入游戏日志文本数据"""
-    """批量导入游戏日志文本数据，格式如：
+    """批量导入游戏日志文本数据（后台执行），格式如：
     12/28 01:53 位置变动 メゾン荘 201号室 #53949 friends+
     12/28 01:52 玩家离开 💚 SaKi43
+
+    支持三种输入：multipart上传的文件（字段log_file）、原始请求体（text/plain等），
+    以及兼容旧版的表单字段log_text。上传内容写入暂存文件后立即返回任务。
     """
-    log_text = request.form.get('log_text', '')
-    if not log_text:
+    if request.mimetype == 'multipart/form-data':
+        log_file = request.files.get('log_file')
+        log_source = log_file.stream if log_file else request.form.get('log_text', '')
+    elif request.mimetype == 'application/x-www-form-urlencoded':
+        log_source = request.form.get('log_text', '')
+    else:
+        log_source = request.stream
+
+    if isinstance(log_source, str) and not log_source.strip():
         return jsonify({'success': False, 'error': '没有提供日志文本'}), 400
 
-    # 使用API错误处理包装的数据库操作
-    def bulk_import_operation():
-        # 预处理：将多行记录合并为单行
-        processed_lines = []
-        current_line = []
+    return enqueue_ingest_job('bulk_import', log_source, 'log')
 
-        for line in log_text.strip().split('\n'):
-            line = line.strip()
-            if not line:
-                continue
 
-            # 检查是否是新记录的开始（以日期格式开头，如 12/28）
-            if '/' in line and len(line.split()[0]) >= 5:
-                # 保存当前记录（如果有）
-                if current_line:
-                    processed_lines.append(' '.join(current_line))
-                # 开始新记录
-                current_line = [line]
-            else:
-                # 追加到当前记录
-                if current_line:
-                    current_line.append(line)
+# ------------------------------
+# 后台导入任务
+# ------------------------------
 
-        # 保存最后一条记录
-        if current_line:
-            processed_lines.append(' '.join(current_line))
+# 导入任务的工作线程数（SQLite同一时间只有一个写入者，多线程主要用于重叠解析）
+INGEST_WORKER_COUNT = 1
 
-        imported_count = 0
+ingest_job_queue = BackgroundTaskQueue('ingest-jobs', workers=INGEST_WORKER_COUNT)
 
-        for full_line in processed_lines:
-            full_line = full_line.strip()
-            if not full_line:
-                continue
 
-            # 解析日志行
-            parts = full_line.split()
-            if len(parts) < 4:
-                continue
+class IngestJobCancelled(Exception):
+    """导入任务被用户取消"""
 
-            # 解析时间
-            date_part = parts[0]
-            time_part = parts[1]
-            try:
-                timestamp_str = f"{date_part} {time_part}"
-                timestamp = datetime.strptime(timestamp_str, '%m/%d %H:%M')
-                timestamp = timestamp.replace(year=datetime.now().year)
-            except ValueError:
-                continue
 
-            # 解析事件类型
-            event_type = parts[2]
-            if event_type not in ['位置变动', '玩家加入', '玩家离开']:
-                continue
+class IngestJob(db.Model):
+    """后台导入/转换任务：上传内容暂存到文件，由工作线程处理并记录进度"""
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey(
+            'user.id',
+            ondelete='CASCADE'),
+        nullable=False)
+    job_type = db.Column(db.String(20), nullable=False)  # import, bulk_import, convert
+    # 任务状态：queued, running, done, failed, cancelled
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    source_path = db.Column(db.String(500))
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    lines_parsed = db.Column(db.Integer, default=0)
+    rows_inserted = db.Column(db.Integer, default=0)
+    rows_skipped = db.Column(db.Integer, default=0)
+    events_converted = db.Column(db.Integer, default=0)
+    write_seconds = db.Column(db.Float)  # 日志写入耗时（GameLogBulkWriter.stats）
+    error = db.Column(db.Text)
+    lease_token = db.Column(db.String(32))  # 执行任务的线程领取时生成
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_ingest_job_user_created', 'user_id', 'created_at'),
+    )
 
-            player_name = ''
-            world_name = ''
-            world_id = ''
-            is_friend = False
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'status': self.status,
+            'cancel_requested': self.cancel_requested,
+            'progress': {
+                'lines_parsed': self.lines_parsed or 0,
+                'rows_inserted': self.rows_inserted or 0,
+                'rows_skipped': self.rows_skipped or 0,
+                'events_converted': self.events_converted or 0
+            },
+            'stats': {
+                'rows': self.rows_inserted or 0,
+                'skipped': self.rows_skipped or 0,
+                'seconds': self.write_seconds,
+                'rows_per_second': int((self.rows_inserted or 0) / self.write_seconds)
+                if self.write_seconds else None
+            } if self.write_seconds is not None else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'status_url': url_for('get_ingest_job', job_id=self.id)
+        }
 
-            if event_type == '位置变动':
-                # 解析世界信息
-                # 格式：位置变动 メゾン荘 201号室 #53949 friends+
-                world_parts = parts[3:]
-                for i, part in enumerate(world_parts):
-                    if part.startswith('#'):
-                        world_id = part
-                        world_name = ' '.join(world_parts[:i])
-                        if i + \
-                                1 < len(world_parts) and world_parts[i + 1] == 'friends+':
-                            is_friend = True
-                        break
-                else:
-                    world_name = ' '.join(world_parts)
-
-                player_name = '系统'
-
-            else:  # 玩家加入或玩家离开
-                # 解析玩家信息
-                # 格式：玩家离开 💚 SaKi43
-                player_parts = parts[3:]
-                if len(player_parts) >= 2:
-                    if player_parts[0] == '💚':
-                        is_friend = True
-                        player_name = ' '.join(player_parts[1:])
-                    else:
-                        is_friend = False
-                        player_name = ' '.join(player_parts)
-                elif len(player_parts) == 1:
-                    player_name = player_parts[0]
-
-            # 创建游戏日志记录
-            game_log = GameLog(
-                user_id=current_user.id,
-                timestamp=timestamp,
-                event_type=event_type,
-                world_name=world_name,
-                world_id=world_id,
-                player_name=player_name,
-                is_friend=is_friend
-            )
-            db.session.add(game_log)
-            imported_count += 1
 
-        return imported_count
+class IngestJobProgress:
+    """任务进度：计数和心跳随写入块一起提交，每次提交前检查取消请求和租约"""
+
+    def __init__(self, job_id, lease_token):
+        self.job_id = job_id
+        self.lease_token = lease_token
+        self.lines_parsed = 0
 
-    # 成功响应函数
-    def success_response(imported_count):
-        return jsonify({'success': True, 'imported_count': imported_count})
+    def report(self, **counts):
+        """检查取消请求和租约，更新计数和心跳（由调用方的事务提交）"""
+        cancel_requested, lease_token = db.session.query(
+            IngestJob.cancel_requested, IngestJob.lease_token).filter(
+            IngestJob.id == self.job_id).one()
+        if lease_token != self.lease_token:
+            raise JobLeaseLost()
+        if cancel_requested:
+            raise IngestJobCancelled()
+        job = db.session.get(IngestJob, self.job_id)
+        job.heartbeat_at = datetime.now()
+        for name, value in counts.items():
+            setattr(job, name, value)
+
+    def on_flush(self, writer):
+        """GameLogBulkWriter的块回调"""
+        self.report(lines_parsed=self.lines_parsed, rows_inserted=writer.written,
+                    rows_skipped=writer.skipped)
+
+
+def enqueue_ingest_job(job_type, source=None, extension=None):
+    """创建任务并提交到工作线程，返回202响应
+
+    有上传内容时先写入instance/uploads，任务记录提交后再交给工作线程。
+    上传内容为空时返回400；任务记录没有提交成功时删除暂存文件。
+    """
+    import os
+    import uuid
+
+    job_id = uuid.uuid4().hex
+    source_path = spool_upload(source, f'{job_id}.{extension}') \
+        if source is not None else None
+    if source_path and os.path.getsize(source_path) == 0:
+        os.remove(source_path)
+        return jsonify({'success': False, 'error': '上传内容为空'}), 400
+
+    enqueued = False
+
+    def enqueue_ingest_job_operation():
+        job = IngestJob(id=job_id, user_id=current_user.id, job_type=job_type,
+                        source_path=source_path)
+        db.session.add(job)
+        return job
+
+    def success_response(job):
+        nonlocal enqueued
+        ingest_job_queue.submit(run_ingest_job, job.id)
+        enqueued = True
+        return jsonify({'success': True, 'job': job.to_dict()}), 202
+
+    try:
+        return handle_api_db_operation(
+            operation_func=enqueue_ingest_job_operation,
+            success_response_func=success_response
+        )
+    finally:
+        if source_path and not enqueued and os.path.exists(source_path):
+            os.remove(source_path)
+
+
+def run_ingest_job(job_id):
+    """在工作线程中执行导入/转换任务
+
+    任务先被原子地领取（见claim_job），进度和心跳随每个写入块提交；
+    租约过期被其他进程收回时放弃本次执行。
+    日志按event_hash去重、转换按水位线增量进行，中断或取消后重新执行是安全的。
+    """
+    import os
+    from sqlalchemy import update
+
+    lease_token = claim_job(IngestJob, job_id, started_at=datetime.now())
+    if not lease_token:
+        return
+    job = db.session.get(IngestJob, job_id)
+    job_type, source_path = job.job_type, job.source_path
+    progress = IngestJobProgress(job_id, lease_token)
+    user = db.session.get(User, job.user_id)
+
+    error = None
+    try:
+        progress.report()  # 排队期间已被取消的任务不再执行
+        stats = None
+        if job_type == 'convert':
+            convert_user_game_logs(user, progress)
+        elif job_type == 'import':
+            with open(source_path, encoding='utf-8') as source_file:
+                stats = import_log_entries(json.load(source_file), user, progress)
+        else:
+            stats = import_log_file(source_path, user, progress)
+        # 最后一次检查取消请求，与任务结果（写入统计）一起提交
+        if stats:
+            progress.report(rows_inserted=stats['rows'], rows_skipped=stats['skipped'],
+                            write_seconds=stats['seconds'])
+        else:
+            progress.report()
+        status = 'done'
+    except JobLeaseLost:
+        db.session.rollback()
+        return
+    except IngestJobCancelled:
+        db.session.rollback()
+        status = 'cancelled'
+    except Exception as e:
+        db.session.rollback()
+        print(f"导入任务失败（{job_id}）: {str(e)}")
+        status = 'failed'
+        error = str(e)
+
+    # 只有仍持有租约时才写入结果并删除暂存文件
+    finished = db.session.execute(update(IngestJob).where(
+        IngestJob.id == job_id, IngestJob.lease_token == lease_token
+    ).values(status=status, error=error, finished_at=datetime.now())).rowcount
+    db.session.commit()
+    if finished and source_path and os.path.exists(source_path):
+        os.remove(source_path)
+
+
+def resume_ingest_jobs():
+    """重新提交排队中和心跳超时（所在进程已退出）的任务
+
+    其他进程仍在执行的任务心跳未超时，不会被收回；同一任务被多个进程提交时只有一个能领取。
+    """
+    for job_id in reclaim_expired_jobs(IngestJob):
+        ingest_job_queue.submit(run_ingest_job, job_id)
+
+
+@app.route('/api/gamelog/jobs')
+@login_required
+def list_ingest_jobs():
+    """列出最近的导入/转换任务"""
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    jobs = IngestJob.query.filter_by(user_id=current_user.id).order_by(
+        IngestJob.created_at.desc()).limit(limit).all()
+    return jsonify({'success': True, 'data': [job.to_dict() for job in jobs]})
+
+
+@app.route('/api/gamelog/jobs/<string:job_id>')
+@login_required
+def get_ingest_job(job_id):
+    """查询导入/转换任务的状态和进度"""
+    job = IngestJob.query.filter_by(
+        id=job_id, user_id=current_user.id).first_or_404()
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+
+@app.route('/api/gamelog/jobs/<string:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_ingest_job(job_id):
+    """取消任务：排队中的任务不再执行，运行中的任务在下一个写入块提交前停止"""
+    job = IngestJob.query.filter_by(
+        id=job_id, user_id=current_user.id).first_or_404()
+
+    if job.status not in ('queued', 'running'):
+        return jsonify({'success': False, 'error': '任务已结束，无法取消',
+                        'status': job.status}), 409
+
+    def cancel_ingest_job_operation():
+        job.cancel_requested = True
+        return job
+
+    def success_response(job):
+        return jsonify({'success': True, 'job': job.to_dict()}), 202
 
-    # 调用API错误处理函数
     return handle_api_db_operation(
-        operation_func=bulk_import_operation,
+        operation_func=cancel_ingest_job_operation,
         success_response_func=success_response
     )
 
@@ -3126,6 +6993,114 @@ def generate_mock_data():
 # 应用初始化
 # ------------------------------
 
+class DataMigration(db.Model):
+    """一次性数据回填（重建排行榜、收件箱等派生数据）的完成记录
+
+    init_db在每个进程和脚本中都会执行，根据这里的记录而不是派生表是否为空
+    判断回填是否需要执行。派生数据的计算方式改变时使用新的名称，回填会再执行一次。
+    """
+    name = db.Column(db.String(80), primary_key=True)
+    completed_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+
+def run_data_migration(name, func, fresh=False):
+    """执行尚未完成的数据回填并记录完成
+
+    新建的数据库中派生数据都由写入时的增量维护产生，不需要回填，只记录完成。
+    多个进程同时启动时回填可能各执行一次，回填本身都是先清空再重建的，结果相同。
+    """
+    from sqlalchemy.dialects.sqlite import insert
+
+    if db.session.get(DataMigration, name):
+        return
+    if not fresh:
+        print(f"正在执行数据回填: {name}...")
+        func()
+    db.session.execute(insert(DataMigration).values(
+        name=name, completed_at=datetime.now()).on_conflict_do_nothing())
+    db.session.commit()
+
+
+def upgrade_schema():
+    """为已存在的表补充模型中新增的列和索引
+
+    create_all只会创建缺失的表，不会修改已有的表。这里只做新增列和索引这类
+    兼容的变更（SQLite的ALTER TABLE ADD COLUMN），不会删除或修改已有列。
+    """
+    from sqlalchemy import inspect, text, select, update
+
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {
+                column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(
+                    f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                print(f"已为表 {table.name} 添加列 {column.name}")
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+        # 增加行版本号之前就存在的行：统一分配一个新版本号，增量同步才能返回它们
+        version = None
+        for model in (SharedEvent, EventTag, EventComment):
+            table = model.__table__
+            if not connection.execute(select(table.c.row_version).where(
+                    table.c.row_version.is_(None)).limit(1)).first():
+                continue
+            version = version or next_row_version(connection)
+            connection.execute(update(table).where(
+                table.c.row_version.is_(None)).values(row_version=version))
+            print(f"已为表 {table.name} 补充行版本号")
+
+
+def backfill_game_log_hashes():
+    """为旧数据库中没有去重哈希的日志补充哈希
+
+    按用户和时间顺序用GameLogHasher计算；与已有哈希冲突的行继续增加出现序号，
+    保证执行一次后不再有缺少哈希的行（否则每次启动都会重新补充）。
+    """
+    from sqlalchemy import text
+
+    select_missing = text(
+        'SELECT id, user_id, timestamp, event_type, player_name, world_name, world_id '
+        'FROM game_log WHERE event_hash IS NULL ORDER BY user_id, timestamp, id')
+    update_hash = text(
+        'UPDATE OR IGNORE game_log SET event_hash = :event_hash WHERE id = :id')
+
+    connection = db.session.connection()
+    hashers = {}
+    parameters = []
+    for row in connection.execute(select_missing).all():
+        hasher = hashers.setdefault(row.user_id, GameLogHasher(row.user_id))
+        parameters.append({'id': row.id, 'event_hash': hasher(
+            datetime.fromisoformat(row.timestamp), row.event_type,
+            row.player_name, row.world_name, row.world_id)})
+    if parameters:
+        connection.execute(update_hash, parameters)
+
+    # 与已有哈希冲突的行
+    for row in connection.execute(select_missing).all():
+        timestamp = datetime.fromisoformat(row.timestamp)
+        occurrence = 1
+        while True:
+            event_hash = game_log_event_hash(
+                row.user_id, timestamp, row.event_type, row.player_name,
+                row.world_name, row.world_id, occurrence)
+            if connection.execute(update_hash, {'id': row.id,
+                                                'event_hash': event_hash}).rowcount:
+                break
+            occurrence += 1
+    db.session.commit()
+
+
 def init_db():
     """初始化数据库"""
     with app.app_context():
@@ -3133,6 +7108,11 @@ def init_db():
         print("正在初始化数据库...")
         try:
             db.create_all()  # 创建所有数据库表
+            upgrade_schema()  # 为已有的表补充新增的列和索引
+            with db.engine.begin() as connection:
+                create_interval_index(connection)  # 时间区间索引（R*Tree）
+            # WAL模式：读取快照等长时间读事务不会阻塞写入
+            db.session.execute(db.text('PRAGMA journal_mode=WAL'))
             print("数据库表创建成功")
         except Exception as e:
             print(f"数据库表创建失败: {e}")
@@ -3141,8 +7121,9 @@ def init_db():
             raise
 
         # 如果没有数据，生成模拟数据
+        fresh = not User.query.first()
         try:
-            if not User.query.first():
+            if fresh:
                 print("生成模拟数据...")
                 generate_mock_data()
                 print("模拟数据生成完成")
@@ -3152,6 +7133,28 @@ def init_db():
             traceback.print_exc()
             raise
 
+        # 旧数据库重建排行榜（v2：非公开事件不计入，social按不同玩家数计分）
+        run_data_migration('leaderboards-v2', rebuild_leaderboards, fresh)
+
+        # 旧数据库中的日志补充去重哈希
+        if GameLog.query.filter(GameLog.event_hash.is_(None)).first():
+            print("正在补充游戏日志去重哈希...")
+            backfill_game_log_hashes()
+
+        # 旧数据库补建时间区间索引（SQLite不支持R*Tree时使用普通查询，不需要回填）
+        if interval_index_available(db.session.connection()):
+            run_data_migration('interval-index', rebuild_interval_index, fresh)
+
+        # 旧数据库补建共同在场社交图
+        run_data_migration('copresence-graph', rebuild_copresence_graph, fresh)
+
+        # 旧数据库补建动态收件箱
+        run_data_migration('feed-inboxes', rebuild_feed_inboxes, fresh)
+
+        # 重新提交上次退出时未完成的导入和导出任务
+        resume_ingest_jobs()
+        resume_export_jobs()
+
 
 # 数据库初始化标志
 _db_initialized = False
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+压缩基准测试：比较导出/API响应在不压缩、gzip和zstd下的大小和CPU开销
+
+用法：python benchmark_compression.py [事件数量]
+"""
+
+import sys
+import json
+import time
+import random
+from datetime import datetime, timedelta
+
+from app import (compress_chunks, zstd_available, EXPORT_BATCH_SIZE,
+                 GZIP_COMPRESSION_LEVEL, ZSTD_COMPRESSION_LEVEL)
+
+
+def generate_export_chunks(event_count):
+    """生成与NDJSON导出结构相同的模拟数据块"""
+    rng = random.Random(42)
+    worlds = [("The Black Cat", "Social,Music,Dance"), ("Murder 4", "Game,Horror"),
+              ("Treehouse in the Shade", "Social,Relaxing"),
+              ("Zen Garden", "Relaxing,Meditation,Nature")]
+    friends = [f"Player_{i}" for i in range(200)]
+    base_time = datetime(2025, 1, 1)
+
+    chunk = []
+    for event_id in range(1, event_count + 1):
+        world_name, world_tags = rng.choice(worlds)
+        start_time = base_time + timedelta(minutes=rng.randint(0, 525600))
+        duration = rng.randint(60, 7200)
+        chunk.append(json.dumps({
+            'id': event_id,
+            'friend_name': rng.choice(friends),
+            'world_name': world_name,
+            'start_time': start_time.isoformat(),
+            'end_time': (start_time + timedelta(seconds=duration)).isoformat(),
+            'duration': duration,
+            'notes': None,
+            'privacy': 'public',
+            'custom_tags': [],
+            'world_tags': world_tags.split(',')
+        }, ensure_ascii=False) + '\n')
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+
+
+def run_benchmark(event_count):
+    chunks = list(generate_export_chunks(event_count))
+    raw_size = sum(len(chunk) for chunk in chunks)
+
+    encodings = [('gzip', GZIP_COMPRESSION_LEVEL)]
+    if zstd_available():
+        encodings.append(('zstd', ZSTD_COMPRESSION_LEVEL))
+    else:
+        print("未安装zstandard，跳过zstd测试")
+
+    print(f"事件数: {event_count}, 原始大小: {raw_size / 1024 / 1024:.2f} MiB, "
+          f"数据块: {len(chunks)}")
+    print(f"{'编码':<8}{'级别':>6}{'压缩后(KiB)':>14}{'节省':>10}{'CPU(ms)':>10}{'吞吐(MiB/s)':>14}")
+
+    for encoding, level in encodings:
+        cpu_start = time.process_time()
+        compressed_size = sum(len(data) for data in compress_chunks(chunks, encoding))
+        cpu_ms = (time.process_time() - cpu_start) * 1000
+        saved = 1 - compressed_size / raw_size
+        throughput = raw_size / 1024 / 1024 / (cpu_ms / 1000) if cpu_ms else float('inf')
+        print(f"{encoding:<8}{level:>6}{compressed_size / 1024:>14.1f}"
+              f"{saved:>10.1%}{cpu_ms:>10.1f}{throughput:>14.1f}")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    run_benchmark(count)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+日志转换基准测试：比较旧的两遍转换算法和单遍状态机（LogConversionEngine）
+
+旧算法按原convert_game_logs的逻辑重新实现（两遍扫描、字符串世界键），
+只把创建SharedEvent换成计数，两种算法都不访问数据库。
+
+用法：python benchmark_convert.py [日志行数]
+"""
+
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+from app import LogConversionEngine
+
+USERNAME = 'bench_user'
+
+
+def generate_logs(line_count):
+    """生成模拟日志：用户不断进出世界，期间其他玩家加入和离开"""
+    rng = random.Random(42)
+    worlds = [(f"World {i}", f"#{10000 + i}") for i in range(50)]
+    players = [f"Player_{i}" for i in range(2000)]
+    timestamp = datetime(2025, 1, 1)
+
+    logs = []
+    while len(logs) < line_count:
+        world_name, world_id = rng.choice(worlds)
+        timestamp += timedelta(minutes=rng.randint(1, 30))
+        logs.append((timestamp, '位置变动', world_name, world_id, USERNAME, False))
+
+        present = []
+        for _ in range(rng.randint(5, 40)):
+            timestamp += timedelta(seconds=rng.randint(10, 300))
+            if present and rng.random() < 0.4:
+                player = present.pop(rng.randrange(len(present)))
+                logs.append((timestamp, '玩家离开', world_name, world_id, player, False))
+            else:
+                player = rng.choice(players)
+                present.append(player)
+                logs.append((timestamp, '玩家加入', world_name, world_id, player,
+                             rng.random() < 0.2))
+
+        timestamp += timedelta(seconds=rng.randint(10, 300))
+        logs.append((timestamp, '玩家离开', world_name, world_id, USERNAME, False))
+    return logs[:line_count]
+
+
+def legacy_convert(logs, username):
+    """旧算法：第一遍处理其他玩家，第二遍处理用户自己的进出"""
+    world_sessions = {}
+    converted_count = 0
+
+    for timestamp, event_type, world_name, world_id, player_name, is_friend in logs:
+        world_key = f"{world_name}_{world_id}"
+        if world_key not in world_sessions:
+            world_sessions[world_key] = {
+                'world_name': world_name,
+                'world_id': world_id,
+                'players': {},
+                'events': []
+            }
+        world_session = world_sessions[world_key]
+
+        if event_type == '位置变动':
+            if player_name == username and player_name not in world_session['players']:
+                world_session['players'][player_name] = {
+                    'start_time': timestamp, 'is_friend': False}
+        elif event_type == '玩家加入':
+            world_session['players'][player_name] = {
+                'start_time': timestamp, 'is_friend': is_friend}
+        elif event_type == '玩家离开':
+            if player_name != username:
+                if player_name in world_session['players']:
+                    player_info = world_session['players'].pop(player_name)
+                    int((timestamp - player_info['start_time']).total_seconds())
+                    converted_count += 1
+            elif player_name in world_session['players']:
+                world_session['players'].pop(player_name)
+
+    current_user_sessions = {}
+    for timestamp, event_type, world_name, world_id, player_name, is_friend in logs:
+        world_key = f"{world_name}_{world_id}"
+        if event_type == '位置变动' and player_name == username:
+            current_user_sessions[world_key] = {
+                'start_time': timestamp, 'world_name': world_name, 'world_id': world_id}
+        elif event_type == '玩家离开' and player_name == username:
+            if world_key in current_user_sessions:
+                session = current_user_sessions.pop(world_key)
+                if world_key in world_sessions:
+                    for other_name, other_info in world_sessions[world_key]['players'].items():
+                        if other_name == username:
+                            continue
+                        overlap_start = max(session['start_time'], other_info['start_time'])
+                        if overlap_start < timestamp:
+                            int((timestamp - overlap_start).total_seconds())
+                            converted_count += 1
+
+    return converted_count
+
+
+def engine_convert(logs, username):
+    """单遍状态机"""
+    converted = [0]
+
+    def on_event(world, player_name, start_time, end_time, is_friend):
+        int((end_time - start_time).total_seconds())
+        converted[0] += 1
+
+    engine = LogConversionEngine(username, on_event)
+    process = engine.process
+    for log in logs:
+        process(*log)
+    return converted[0]
+
+
+def run_benchmark(line_count):
+    print(f"生成 {line_count} 行模拟日志...")
+    logs = generate_logs(line_count)
+    print(f"{'算法':<10}{'事件数':>10}{'耗时(s)':>10}{'吞吐(行/秒)':>16}")
+
+    for name, convert in (('旧算法', legacy_convert), ('状态机', engine_convert)):
+        started = time.perf_counter()
+        event_count = convert(logs, USERNAME)
+        elapsed = time.perf_counter() - started
+        print(f"{name:<10}{event_count:>10}{elapsed:>10.2f}{line_count / elapsed:>16,.0f}")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    run_benchmark(count)
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+"""
+重建共同在场社交图：根据全部事件的参与者批量重算 CoPresenceEdge 表
+（安装了scipy时使用稀疏矩阵计算）
+"""
+
+from app import app, db, rebuild_copresence_graph, copresence_matrix_available
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        db.create_all()
+        engine = 'scipy稀疏矩阵' if copresence_matrix_available() else '纯Python'
+        print(f"开始重建共同在场社交图（{engine}）...")
+        edge_count = rebuild_copresence_graph()
+        print(f"重建完成，共 {edge_count} 条边")
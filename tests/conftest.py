@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# 测试直接导入仓库根目录下的app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 测试使用临时数据库，必须在导入app之前设置
+TEST_DATABASE = os.path.join(tempfile.mkdtemp(prefix='vrchat-memories-test-'), 'test.db')
+os.environ['DATABASE_URL'] = 'sqlite:///' + TEST_DATABASE
+
+
+@pytest.fixture
+def client():
+    """每个测试使用重新初始化（含模拟数据）的数据库和测试客户端"""
+    import app as app_module
+
+    with app_module.app.app_context():
+        app_module.db.session.remove()
+        app_module.db.engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(TEST_DATABASE + suffix):
+            os.remove(TEST_DATABASE + suffix)
+    app_module._world_cache.clear()
+
+    app_module.app.config['TESTING'] = True
+    app_module.init_db()
+    app_module._db_initialized = True
+    return app_module.app.test_client()
+
+
+def register(client, username, password='password123'):
+    """注册并登录一个新用户"""
+    client.get('/logout')
+    response = client.post('/register', data={'username': username, 'password': password})
+    assert response.status_code == 302
+
+
+def login(client, username, password='password123'):
+    """登录已有用户（如模拟数据中的alice）"""
+    client.get('/logout')
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302
+
+
+def wait_for_jobs():
+    """等待后台导入和导出任务全部完成"""
+    import app as app_module
+    app_module.ingest_job_queue.join()
+    app_module.export_job_queue.join()
@@ -0,0 +1,100 @@
+"""账户快照：导出 → 导入 → 转换的往返"""
+
+import io
+
+from conftest import register, wait_for_jobs
+
+LOG_TEXT = '\n'.join([
+    '10/25 12:00 位置变动 Snapshot World #90001 friends+',
+    '10/25 12:01 玩家加入 tester',
+    '10/25 12:02 玩家加入 alice',
+    '10/25 12:03 玩家加入 Stranger One',
+    '10/25 12:30 玩家离开 alice',
+    '10/25 12:40 玩家离开 Stranger One',
+    '10/25 13:00 位置变动 Other World #90002 public',
+    '10/25 13:05 玩家加入 bob',
+    '10/25 13:20 玩家加入 Stranger Two',
+    '10/25 13:50 玩家离开 bob',
+])
+
+
+def event_count(username='tester'):
+    import app as app_module
+    with app_module.app.app_context():
+        user = app_module.User.query.filter_by(username=username).one()
+        return app_module.SharedEvent.query.filter_by(user_id=user.id).count()
+
+
+def convert(client):
+    response = client.post('/api/gamelog/convert')
+    assert response.status_code == 202
+    wait_for_jobs()
+
+
+def import_snapshot(client, snapshot):
+    response = client.post('/api/events/import/sqlite', data={
+        'snapshot': (io.BytesIO(snapshot), 'snapshot.sqlite')})
+    assert response.status_code == 200
+    return response.get_json()['imported']
+
+
+def export_converted_account(client):
+    register(client, 'tester')
+    response = client.post('/api/gamelog/bulk_import', data=LOG_TEXT,
+                           content_type='text/plain')
+    assert response.status_code == 202
+    wait_for_jobs()
+    convert(client)
+    return client.get('/api/events/export/sqlite').data
+
+
+def test_snapshot_round_trip_keeps_event_counts(client):
+    snapshot = export_converted_account(client)
+    events = event_count()
+    assert events > 0
+
+    # 导入到同一账户：事件和日志全部已存在
+    imported = import_snapshot(client, snapshot)
+    assert imported['events'] == 0
+    assert imported['events_skipped'] == events
+    assert imported['game_logs'] == 0
+    assert event_count() == events
+
+    # 快照中的日志不会被再次转换
+    convert(client)
+    assert event_count() == events
+
+    # 再次导入仍然不变
+    assert import_snapshot(client, snapshot)['events'] == 0
+    convert(client)
+    assert event_count() == events
+
+
+def test_snapshot_restores_into_new_account(client):
+    import app as app_module
+
+    snapshot = export_converted_account(client)
+    events = event_count()
+
+    register(client, 'restored')
+    imported = import_snapshot(client, snapshot)
+    assert imported['events'] == events
+    assert imported['game_logs'] == len(LOG_TEXT.splitlines())
+    convert(client)
+    assert event_count('restored') == events
+
+    with app_module.app.app_context():
+        restored = app_module.User.query.filter_by(username='restored').one()
+        alice = app_module.User.query.filter_by(username='alice').one()
+        # 好友名是注册用户的事件恢复了参与者和共同在场时长
+        event = app_module.SharedEvent.query.filter_by(
+            user_id=restored.id, friend_name='alice').one()
+        assert alice in event.participants.all()
+        edge = app_module.CoPresenceEdge.query.filter_by(
+            user_id=restored.id, neighbor_id=alice.id).one()
+        assert edge.shared_seconds == event.duration
+        # 日志草图与水位线
+        assert app_module.UniqueCountSketch.query.filter_by(user_id=restored.id).count()
+        state = app_module.GameLogConversionState.query.filter_by(
+            user_id=restored.id).one()
+        assert state.last_timestamp.hour == 13
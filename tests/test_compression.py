@@ -0,0 +1,20 @@
+"""导出响应的压缩协商"""
+
+import pytest
+
+from conftest import register
+
+
+@pytest.mark.parametrize('export_format, compressed', [
+    ('csv', True),
+    ('ndjson', True),
+    ('parquet', False),
+    ('arrow', False),
+])
+def test_only_text_exports_are_compressed(client, export_format, compressed):
+    pytest.importorskip('pyarrow')
+    register(client, 'tester')
+    response = client.get(f'/api/events/export?format={export_format}',
+                          headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert (response.headers.get('Content-Encoding') == 'gzip') == compressed
@@ -0,0 +1,48 @@
+"""世界同时在线人数：时间范围和分辨率"""
+
+from conftest import register, wait_for_jobs
+
+LOG_LINES = ['10/25 12:00 位置变动 Busy World #90201 public']
+LOG_LINES += [f'10/25 12:{minute:02d} 玩家加入 Player {minute}' for minute in range(1, 41)]
+LOG_LINES += [f'10/25 13:{minute:02d} 玩家离开 Player {minute + 1}' for minute in range(40)]
+
+
+def concurrency(client, **params):
+    query = '&'.join(f'{key}={value}' for key, value in params.items())
+    response = client.get(f'/api/gamelog/concurrency?{query}')
+    assert response.status_code == 200
+    return response.get_json()['data']
+
+
+def import_logs(client):
+    register(client, 'tester')
+    response = client.post('/api/gamelog/bulk_import', data='\n'.join(LOG_LINES),
+                           content_type='text/plain')
+    assert response.status_code == 202
+    wait_for_jobs()
+
+
+def test_series_is_capped_by_resolution(client):
+    import_logs(client)
+    full = concurrency(client)
+    (world,) = full['worlds']
+    assert world['peak'] == 41
+    assert len(world['series']) == len(LOG_LINES)
+    assert world['bucket_seconds'] is None
+
+    capped = concurrency(client, resolution=10)
+    (world,) = capped['worlds']
+    assert len(world['series']) <= 10
+    assert world['bucket_seconds'] is not None
+    # 按桶取峰值，峰值不会丢失
+    assert max(point['count'] for point in world['series']) == 41
+
+
+def test_range_starts_from_current_count(client):
+    import_logs(client)
+    data = concurrency(client, **{'from': '2026-10-25T12:30:00', 'to': '2026-10-25T12:35:00'})
+    (world,) = data['worlds']
+    # 范围起点时已有自己和29名玩家，范围内（含起点）又加入6名
+    assert world['series'][0] == {'time': '2026-10-25T12:30:00', 'count': 30}
+    assert world['peak'] == 36
+    assert all('12:30:00' <= point['time'][11:] <= '12:35:00' for point in world['series'])
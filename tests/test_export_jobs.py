@@ -0,0 +1,58 @@
+"""异步导出任务：原子领取和心跳超时后的重新领取"""
+
+from datetime import datetime
+
+import pytest
+
+from conftest import register, wait_for_jobs
+
+
+def create_job(client):
+    response = client.post('/api/events/export/jobs', json={'format': 'csv'})
+    assert response.status_code == 202
+    return response.get_json()['job']['id']
+
+
+def test_export_job_is_claimed_once(client):
+    import app as app_module
+
+    register(client, 'tester')
+    job_id = create_job(client)
+    wait_for_jobs()
+
+    with app_module.app.app_context():
+        job = app_module.db.session.get(app_module.ExportJob, job_id)
+        assert job.status == 'done'
+        # 已完成的任务不能再次领取
+        assert app_module.claim_job(app_module.ExportJob, job_id) is None
+
+
+def test_resume_only_reclaims_expired_leases(client):
+    import app as app_module
+
+    register(client, 'tester')
+    with app_module.app.app_context():
+        now = datetime.now()
+        user = app_module.User.query.filter_by(username='tester').one()
+        for job_id, heartbeat_at in (
+                ('alive', now),
+                ('stale', now - app_module.JOB_LEASE_TIMEOUT * 2)):
+            app_module.db.session.add(app_module.ExportJob(
+                id=job_id, user_id=user.id, export_format='csv', status='running',
+                lease_token='other-process', heartbeat_at=heartbeat_at))
+        app_module.db.session.commit()
+
+        app_module.resume_export_jobs()
+    wait_for_jobs()
+
+    with app_module.app.app_context():
+        # 其他进程仍在执行的任务保持不变，心跳超时的任务被重新执行
+        alive = app_module.db.session.get(app_module.ExportJob, 'alive')
+        assert (alive.status, alive.lease_token) == ('running', 'other-process')
+        assert app_module.db.session.get(app_module.ExportJob, 'stale').status == 'done'
+
+        # 原执行者的租约已被收回
+        with pytest.raises(app_module.JobLeaseLost):
+            with app_module.db.engine.begin() as connection:
+                app_module.heartbeat_job(
+                    connection, app_module.ExportJob, 'stale', 'other-process')
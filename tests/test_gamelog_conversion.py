@@ -0,0 +1,62 @@
+"""日志转换状态机：转换之后才上传的旧日志"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from app import replay_game_logs
+
+Log = namedtuple('Log', 'id timestamp event_type world_name world_id player_name is_friend')
+
+USERNAME = 'alice'
+
+
+def log(log_id, minute, event_type, player_name, world=('World A', '#1')):
+    return Log(log_id, datetime(2025, 1, 1, 12, minute), event_type,
+               world[0], world[1], player_name, False)
+
+
+def replay(logs, worlds=None, last_timestamp=None):
+    events = []
+
+    def on_event(world, player_name, start_time, end_time, is_friend):
+        events.append((player_name, start_time, end_time))
+
+    logs = sorted(logs, key=lambda row: (row.timestamp, row.id))
+    worlds, last_timestamp = replay_game_logs(
+        USERNAME, on_event, worlds or {}, logs, last_timestamp)
+    return events, worlds, last_timestamp
+
+
+def test_late_upload_is_replayed_separately():
+    # 第一次转换：bob在12:30加入后仍在世界中
+    events, worlds, last_timestamp = replay([
+        log(1, 20, '位置变动', USERNAME),
+        log(2, 30, '玩家加入', 'bob'),
+    ])
+    assert events == []
+    assert last_timestamp == datetime(2025, 1, 1, 12, 30)
+
+    # 之后上传了更早的日志：bob在12:05加入、12:10离开，以及新的离开
+    events, worlds, last_timestamp = replay([
+        log(3, 5, '玩家加入', 'bob'),
+        log(4, 10, '玩家离开', 'bob'),
+        log(5, 40, '玩家离开', 'bob'),
+    ], worlds, last_timestamp)
+
+    assert ('bob', datetime(2025, 1, 1, 12, 5), datetime(2025, 1, 1, 12, 10)) in events
+    assert ('bob', datetime(2025, 1, 1, 12, 30), datetime(2025, 1, 1, 12, 40)) in events
+    assert all(start <= end for _, start, end in events)
+    assert last_timestamp == datetime(2025, 1, 1, 12, 40)
+
+
+def test_late_leave_does_not_close_newer_session():
+    _, worlds, last_timestamp = replay([
+        log(1, 20, '位置变动', USERNAME),
+        log(2, 30, '玩家加入', 'bob'),
+    ])
+
+    # 只上传了更早的离开：不能与12:30的加入配对
+    events, worlds, _ = replay([log(3, 10, '玩家离开', 'bob')], worlds, last_timestamp)
+
+    assert events == []
+    assert 'bob' in worlds[('World A', '#1')].players
@@ -0,0 +1,61 @@
+"""日志去重哈希：同一分钟内内容相同的日志按出现次序编号"""
+
+from datetime import datetime
+
+from app import GameLogHasher
+from conftest import register, wait_for_jobs
+
+# 好友在同一分钟内跟随用户进入第二个世界，两条加入日志内容完全相同
+LOG_TEXT = '\n'.join([
+    '10/25 12:00 位置变动 World A #90301 public',
+    '10/25 12:00 玩家加入 Follower',
+    '10/25 12:00 玩家离开 Follower',
+    '10/25 12:00 位置变动 World B #90302 public',
+    '10/25 12:00 玩家加入 Follower',
+    '10/25 12:01 玩家加入 Follower',
+])
+
+
+def test_identical_lines_get_distinct_hashes():
+    hasher = GameLogHasher(1)
+    minute = datetime(2026, 10, 25, 12, 0)
+    first = hasher(minute, '玩家加入', 'Follower')
+    second = hasher(minute, '玩家加入', 'Follower')
+    assert first != second
+
+    # 重新按同样的顺序计算得到同样的哈希
+    again = GameLogHasher(1)
+    assert [again(minute, '玩家加入', 'Follower') for _ in range(2)] == [first, second]
+
+    # 时间变化后出现序号从0重新开始
+    next_minute = datetime(2026, 10, 25, 12, 1)
+    assert hasher(next_minute, '玩家加入', 'Follower') == \
+        GameLogHasher(1)(next_minute, '玩家加入', 'Follower')
+
+
+def bulk_import(client):
+    response = client.post('/api/gamelog/bulk_import', data=LOG_TEXT,
+                           content_type='text/plain')
+    assert response.status_code == 202
+    wait_for_jobs()
+    return client.get(response.get_json()['job']['status_url']).get_json()['job']
+
+
+def test_same_minute_duplicates_are_kept_and_reupload_is_skipped(client):
+    import app as app_module
+
+    register(client, 'tester')
+    job = bulk_import(client)
+    assert job['progress']['rows_inserted'] == 6
+    assert job['progress']['rows_skipped'] == 0
+
+    with app_module.app.app_context():
+        user = app_module.User.query.filter_by(username='tester').one()
+        joins = app_module.GameLog.query.filter_by(
+            user_id=user.id, player_name='Follower', event_type='玩家加入',
+            timestamp=datetime(datetime.now().year, 10, 25, 12, 0)).count()
+        assert joins == 2
+
+    job = bulk_import(client)
+    assert job['progress']['rows_inserted'] == 0
+    assert job['progress']['rows_skipped'] == 6
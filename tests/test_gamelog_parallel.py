@@ -0,0 +1,93 @@
+"""多进程解析：任意分块边界下与逐行解析的结果相同"""
+
+import pytest
+
+import app as app_module
+from app import (UniqueSketchAccumulator, iter_log_lines, iter_log_records,
+                 iter_parallel_log_records, parse_log_record)
+from conftest import register, wait_for_jobs
+
+YEAR = 2026
+
+
+def build_log():
+    lines = []
+    for hour in range(10, 14):
+        lines.append(f'10/25 {hour}:00 位置变动 メゾン荘 201号室 #{hour}0001 friends+')
+        # 跨行的记录：世界名称被换行截断
+        lines.append(f'10/25 {hour}:05 位置变动 折り返された')
+        lines.append(f'ワールド名 #{hour}0002 public')
+        for minute in range(10, 50, 7):
+            lines.append(f'10/25 {hour}:{minute} 玩家加入 💚 Player {minute}')
+            # 同一分钟内内容相同的日志
+            lines.append(f'10/25 {hour}:{minute} 玩家加入 💚 Player {minute}')
+            lines.append(f'10/25 {hour}:{minute + 5} 玩家离开 💚 Player {minute}')
+    return '\n'.join(lines) + '\n'
+
+
+def sequential_records(path):
+    with open(path, 'rb') as log_file:
+        records = [parse_log_record(line, YEAR)
+                   for line in iter_log_records(iter_log_lines(log_file))]
+    return [record for record in records if record]
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    path = tmp_path / 'output_log.txt'
+    path.write_text(build_log(), encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.parametrize('chunk_bytes', [7, 31, 64, 257, 100000])
+def test_parallel_parse_matches_sequential(log_path, monkeypatch, chunk_bytes):
+    monkeypatch.setitem(app_module.app.config, 'GAMELOG_PARSE_CHUNK_BYTES', chunk_bytes)
+
+    expected = sequential_records(log_path)
+    expected_sketches = UniqueSketchAccumulator(1, 'tester')
+    for record in expected:
+        expected_sketches.add(record['timestamp'], record['event_type'],
+                              record['world_name'], record['world_id'],
+                              record['player_name'])
+
+    records = []
+    sketches = UniqueSketchAccumulator(1, 'tester')
+    for chunk_records, chunk_sketches in iter_parallel_log_records(
+            log_path, YEAR, 1, 'tester', workers=2):
+        records.extend(chunk_records)
+        sketches.merge(chunk_sketches)
+
+    for record in records:
+        assert record.pop('user_id') == 1
+    assert records == expected
+    assert {key: sketch.to_bytes() for key, sketch in sketches.sketches.items()} == \
+        {key: sketch.to_bytes() for key, sketch in expected_sketches.sketches.items()}
+
+
+def imported_rows(username):
+    user = app_module.User.query.filter_by(username=username).one()
+    return sorted(
+        (log.timestamp, log.event_type, log.world_name or '', log.world_id or '',
+         log.player_name)
+        for log in app_module.GameLog.query.filter_by(user_id=user.id))
+
+
+def test_parallel_import_matches_streaming_import(client, monkeypatch):
+    text = build_log()
+
+    register(client, 'sequential')
+    client.post('/api/gamelog/bulk_import', data=text, content_type='text/plain')
+    wait_for_jobs()
+
+    monkeypatch.setitem(app_module.app.config, 'GAMELOG_PARALLEL_MIN_BYTES', 0)
+    monkeypatch.setitem(app_module.app.config, 'GAMELOG_PARSE_CHUNK_BYTES', 64)
+    monkeypatch.setitem(app_module.app.config, 'GAMELOG_PARSE_WORKERS', 2)
+    register(client, 'parallel')
+    client.post('/api/gamelog/bulk_import', data=text, content_type='text/plain')
+    wait_for_jobs()
+
+    with app_module.app.app_context():
+        sequential = imported_rows('sequential')
+        assert sequential
+        # 同一分钟内相同的日志在两种解析方式下都保留为两行
+        assert imported_rows('parallel') == sequential
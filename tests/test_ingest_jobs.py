@@ -0,0 +1,109 @@
+"""后台导入任务：进度、写入统计和重新提交"""
+
+from datetime import datetime
+
+from conftest import register, wait_for_jobs
+
+LOG_TEXT = '\n'.join([
+    '10/25 12:00 位置变动 Job World #90101 public',
+    '10/25 12:01 玩家加入 Someone',
+    '10/25 12:20 玩家离开 Someone',
+])
+
+
+def test_bulk_import_job_records_writer_stats(client):
+    register(client, 'tester')
+    response = client.post('/api/gamelog/bulk_import', data=LOG_TEXT,
+                           content_type='text/plain')
+    assert response.status_code == 202
+    status_url = response.get_json()['job']['status_url']
+    wait_for_jobs()
+
+    job = client.get(status_url).get_json()['job']
+    assert job['status'] == 'done'
+    assert job['stats']['rows'] == 3
+    assert job['stats']['skipped'] == 0
+    assert job['stats']['seconds'] >= 0
+
+    # 重复上传：全部跳过
+    response = client.post('/api/gamelog/bulk_import', data=LOG_TEXT,
+                           content_type='text/plain')
+    wait_for_jobs()
+    job = client.get(response.get_json()['job']['status_url']).get_json()['job']
+    assert job['stats']['rows'] == 0
+    assert job['stats']['skipped'] == 3
+
+
+def test_resume_leaves_jobs_with_live_heartbeat(client):
+    import app as app_module
+
+    register(client, 'tester')
+    with app_module.app.app_context():
+        now = datetime.now()
+        user = app_module.User.query.filter_by(username='tester').one()
+        for job_id, heartbeat_at in (
+                ('alive', now),
+                ('stale', now - app_module.JOB_LEASE_TIMEOUT * 2)):
+            app_module.db.session.add(app_module.IngestJob(
+                id=job_id, user_id=user.id, job_type='convert', status='running',
+                lease_token='other-process', heartbeat_at=heartbeat_at))
+        app_module.db.session.commit()
+
+        app_module.resume_ingest_jobs()
+    wait_for_jobs()
+
+    with app_module.app.app_context():
+        alive = app_module.db.session.get(app_module.IngestJob, 'alive')
+        assert (alive.status, alive.lease_token) == ('running', 'other-process')
+        stale = app_module.db.session.get(app_module.IngestJob, 'stale')
+        assert stale.status == 'done'
+        # 已完成的任务不能再次领取
+        assert app_module.claim_job(app_module.IngestJob, 'stale') is None
+
+
+def test_job_cancelled_while_queued_does_not_run(client):
+    import app as app_module
+
+    register(client, 'tester')
+    with app_module.app.app_context():
+        user = app_module.User.query.filter_by(username='tester').one()
+        app_module.db.session.add(app_module.IngestJob(
+            id='cancelled', user_id=user.id, job_type='convert', cancel_requested=True))
+        app_module.db.session.commit()
+
+        app_module.run_ingest_job('cancelled')
+        job = app_module.db.session.get(app_module.IngestJob, 'cancelled')
+        assert job.status == 'cancelled'
+        assert app_module.GameLogConversionState.query.filter_by(user_id=user.id).count() == 0
+
+
+def upload_files():
+    import os
+    import app as app_module
+    return os.listdir(app_module.get_upload_dir())
+
+
+def test_bulk_import_rejects_empty_raw_body(client):
+    register(client, 'tester')
+    before = upload_files()
+    response = client.post('/api/gamelog/bulk_import', data=b'',
+                           content_type='text/plain')
+    assert response.status_code == 400
+    assert upload_files() == before
+
+
+def test_spool_file_removed_when_job_is_not_committed(client, monkeypatch):
+    import app as app_module
+
+    register(client, 'tester')
+    before = upload_files()
+
+    def failing_commit():
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(app_module.db.session, 'commit', failing_commit)
+    response = client.post('/api/gamelog/bulk_import', data=LOG_TEXT,
+                           content_type='text/plain')
+    monkeypatch.undo()
+    assert response.status_code == 500
+    assert upload_files() == before
@@ -0,0 +1,92 @@
+"""全站排行榜：增量维护的结果与全量重建一致"""
+
+from datetime import datetime
+
+
+def leaderboard_rows():
+    import app as app_module
+    return sorted(
+        (entry.metric, entry.period_type, entry.period_key, entry.subject_id, entry.score)
+        for entry in app_module.LeaderboardEntry.query.all())
+
+
+def test_incremental_leaderboards_match_rebuild(client):
+    import app as app_module
+
+    with app_module.app.app_context():
+        db = app_module.db
+        SharedEvent = app_module.SharedEvent
+        # 删除一部分事件、把一部分改为私密，包括榜上时长最长的会话
+        longest = SharedEvent.query.order_by(SharedEvent.duration.desc()).limit(5).all()
+        for event in longest[:3]:
+            db.session.delete(event)
+        for event in longest[3:]:
+            event.privacy = 'private'
+        for event in SharedEvent.query.order_by(SharedEvent.id).limit(50).all():
+            db.session.delete(event)
+        db.session.commit()
+
+        incremental = leaderboard_rows()
+        app_module.rebuild_leaderboards()
+        assert leaderboard_rows() == incremental
+
+
+def test_social_score_counts_distinct_companions(client):
+    import app as app_module
+
+    with app_module.app.app_context():
+        db = app_module.db
+        SharedEvent = app_module.SharedEvent
+        alice = app_module.User.query.filter_by(username='alice').one()
+        world = app_module.World.query.first()
+        start = datetime(2027, 1, 15, 12, 0)
+        # 同一个玩家出现三次，另一个玩家一次
+        for minute, friend_name in ((0, 'Companion A'), (10, 'Companion A'),
+                                    (20, 'Companion A '), (30, 'Companion B')):
+            db.session.add(SharedEvent(
+                user_id=alice.id, world_id=world.id, friend_name=friend_name,
+                start_time=start.replace(minute=minute), duration=60))
+        db.session.commit()
+
+        def day_score():
+            entry = app_module.LeaderboardEntry.query.filter_by(
+                metric='social', period_type='day', period_key='2027-01-15',
+                subject_id=alice.id).first()
+            return entry.score if entry else 0
+
+        assert day_score() == 2
+
+        def delete_events(friend_name, count=None):
+            events = SharedEvent.query.filter_by(
+                user_id=alice.id, friend_name=friend_name).limit(count).all()
+            for event in events:
+                db.session.delete(event)
+            db.session.commit()
+
+        delete_events('Companion B')
+        assert day_score() == 1
+        # 同一玩家的其他事件仍在，得分不变
+        delete_events('Companion A', 1)
+        assert day_score() == 1
+        delete_events('Companion A')
+        delete_events('Companion A ')
+        assert day_score() == 0
+
+
+def test_init_db_rebuilds_leaderboards_once(client):
+    import app as app_module
+
+    with app_module.app.app_context():
+        db = app_module.db
+        expected = leaderboard_rows()
+        app_module.LeaderboardEntry.query.delete()
+        db.session.commit()
+
+        # 回填已记录完成：再次初始化不检查排行榜是否为空
+        app_module.init_db()
+        assert leaderboard_rows() == []
+
+        db.session.delete(db.session.get(app_module.DataMigration, 'leaderboards-v2'))
+        db.session.commit()
+        app_module.init_db()
+        assert leaderboard_rows() == expected
@@ -0,0 +1,112 @@
+"""增量同步：删除记录、分页和过期删除记录的全量重置"""
+
+from datetime import datetime, timedelta
+
+from conftest import login, register
+
+
+def sync(client, since=0, limit=None):
+    url = f'/api/sync/delta?since={since}'
+    if limit:
+        url += f'&limit={limit}'
+    response = client.get(url)
+    assert response.status_code == 200
+    return response.get_json()['data']
+
+
+def create_shared_event(owner_name, participant_names):
+    import app as app_module
+
+    with app_module.app.app_context():
+        db = app_module.db
+        users = {user.username: user for user in app_module.User.query.filter(
+            app_module.User.username.in_([owner_name] + participant_names))}
+        event = app_module.SharedEvent(
+            user_id=users[owner_name].id, world_id=app_module.World.query.first().id,
+            friend_name='Someone', start_time=datetime(2027, 1, 15, 12, 0),
+            duration=600)
+        event.custom_tags.append(app_module.EventTag(tag_name='sync-test'))
+        db.session.add(event)
+        for name in [owner_name] + participant_names:
+            event.participants.append(users[name])
+        db.session.commit()
+        return event.id, {user.id for user in users.values()}
+
+
+def test_delete_writes_tombstone_for_every_participant(client):
+    import app as app_module
+
+    register(client, 'tester')
+    event_id, audience = create_shared_event('tester', ['alice', 'bob'])
+
+    login(client, 'alice')
+    delta = sync(client)
+    assert event_id in {event['id'] for event in delta['events']}
+    version = delta['current_version']
+    empty = sync(client, version)
+    assert (empty['events'], empty['tags'], empty['deleted']) == ([], [], [])
+
+    login(client, 'tester')
+    assert client.post(f'/event/{event_id}/delete').status_code == 302
+    with app_module.app.app_context():
+        tombstones = app_module.SyncTombstone.query.filter_by(
+            table_name='shared_event', row_key=str(event_id)).all()
+        assert {tombstone.user_id for tombstone in tombstones} == audience
+
+    login(client, 'alice')
+    delta = sync(client, version)
+    assert [row['key'] for row in delta['deleted']
+            if row['table'] == 'shared_event'] == [str(event_id)]
+    # 使用返回的版本号再次同步没有任何变化
+    again = sync(client, delta['current_version'])
+    assert (again['events'], again['tags'], again['comments'], again['deleted']) == \
+        ([], [], [], [])
+    assert again['has_more'] is False
+
+
+def test_paged_sync_matches_full_sync(client):
+    register(client, 'tester')
+    for _ in range(4):
+        create_shared_event('tester', ['alice'])
+    login(client, 'alice')
+    full = sync(client)
+    assert full['has_more'] is False
+
+    pages = {'events': [], 'tags': [], 'comments': [], 'deleted': []}
+    since = 0
+    page_count = 0
+    while True:
+        page = sync(client, since, limit=3)
+        page_count += 1
+        for name, rows in pages.items():
+            rows.extend(page[name])
+        since = page['current_version']
+        if not page['has_more']:
+            break
+    assert page_count > 1
+    assert since == full['current_version']
+    for name, rows in pages.items():
+        assert sorted(str(row) for row in rows) == sorted(str(row) for row in full[name])
+
+
+def test_sync_resets_when_tombstones_were_pruned(client):
+    import app as app_module
+
+    register(client, 'tester')
+    event_id, _ = create_shared_event('tester', ['alice'])
+    login(client, 'alice')
+    version = sync(client)['current_version']
+
+    login(client, 'tester')
+    client.post(f'/event/{event_id}/delete')
+    with app_module.app.app_context():
+        app_module.SyncTombstone.query.update({
+            'deleted_at': datetime.now() - app_module.SYNC_TOMBSTONE_RETENTION -
+            timedelta(days=1)})
+        app_module.db.session.commit()
+        assert app_module.prune_sync_tombstones() > 0
+
+    login(client, 'alice')
+    delta = sync(client, version)
+    assert delta['reset'] is True
+    assert event_id not in {event['id'] for event in delta['events']}